@@ -0,0 +1,178 @@
+""" Benchmarks of the protocol hot paths.
+
+Runs without Bluetooth hardware, responses come from synthetic frames and the
+simulated peripheral in m365sim.
+
+    python benchmarks/bench_protocol.py --output results.json
+    python benchmarks/bench_protocol.py --baseline results.json --threshold 0.2
+
+With --baseline the exit status is 1 if any benchmark got slower than the
+baseline by more than threshold (a fraction of the baseline time).
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from m365py import m365message
+from m365py.m365message import Message, ReadWrite, RESPONSE_DIRECTION
+from m365py.m365decoder import get_decoder
+from m365py.m365py import M365, M365Delegate
+from m365py.m365sim import SimulatedPeripheral
+
+def read_messages():
+    """ Predefined read messages with a decoder for their response, by name. """
+    messages = {}
+    for name, message in sorted(m365message.predefined_messages().items()):
+        if message.read_write != ReadWrite.READ:
+            continue
+        decoder = get_decoder(RESPONSE_DIRECTION[message.direction], message.attribute)
+        if decoder is not None and decoder.size == bytearray(message.payload)[0]:
+            messages[name] = message
+    return messages
+
+def synthetic_response(message, rng):
+    """ Builds a response to message with a random payload the decoder accepts. """
+    decoder = get_decoder(RESPONSE_DIRECTION[message.direction], message.attribute)
+    payload = bytearray(rng.getrandbits(8) for _ in range(decoder.size))
+    if 'serial' in decoder.names:
+        payload[:20] = b'16132/00095292000000'
+    return Message()                                           \
+        .set_direction(RESPONSE_DIRECTION[message.direction])  \
+        .set_read_write(ReadWrite.READ)                        \
+        .set_attribute(message.attribute)                      \
+        .set_payload(bytes(payload))                           \
+        .build()
+
+def measure(func, number, repeat):
+    """ Returns the best of repeat runs of number calls, in seconds per call. """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_build(number, repeat):
+    message = m365message.motor_info
+    def build():
+        Message()                               \
+            .set_direction(message.direction)   \
+            .set_read_write(message.read_write) \
+            .set_attribute(message.attribute)   \
+            .set_payload(message.payload)       \
+            .build()
+    return {'message_build': measure(build, number, repeat)}
+
+def bench_parse(responses, number, repeat):
+    raw = responses['motor_info']._raw_bytes
+    return {'parse_from_bytes': measure(lambda: Message.parse_from_bytes(raw), number, repeat)}
+
+def bench_handle_message(responses, number, repeat):
+    m365 = M365('00:00:00:00:00:00', callback=lambda *args: None, peripheral=SimulatedPeripheral())
+    delegate = M365Delegate(m365)
+
+    results = {}
+    for name, response in sorted(responses.items()):
+        _, frame = Message.parse_from_bytes(response._raw_bytes)
+        results['handle_message.' + name] = measure(lambda: delegate.handle_message(frame), number, repeat)
+    return results
+
+def bench_reassembly(responses, number, repeat, fragment_size=20):
+    m365 = M365('00:00:00:00:00:00', callback=lambda *args: None, peripheral=SimulatedPeripheral())
+    delegate = M365Delegate(m365)
+
+    fragments = []
+    for response in responses.values():
+        raw = response._raw_bytes
+        fragments.extend(raw[i:i + fragment_size] for i in range(0, len(raw), fragment_size))
+
+    def feed():
+        for fragment in fragments:
+            delegate.handleNotification(0, fragment)
+    return {'reassembly.per_frame': measure(feed, max(number // len(fragments), 1), repeat) / len(responses)}
+
+def bench_request_latency(messages, number, repeat):
+    m365 = M365('00:00:00:00:00:00', peripheral=SimulatedPeripheral())
+    m365.connect()
+
+    request = lambda: m365.request(messages['motor_info']).result()
+    sweep_messages = list(messages.values())
+    def sweep():
+        pending = [m365.request(message) for message in sweep_messages]
+        for p in pending:
+            p.result()
+
+    results = {
+        'request_latency.motor_info': measure(request, number, repeat),
+        'request_sweep.all': measure(sweep, max(number // len(sweep_messages), 1), repeat),
+    }
+    m365.disconnect()
+    return results
+
+def run(number, repeat, seed=0):
+    rng = random.Random(seed)
+    messages = read_messages()
+    responses = dict((name, synthetic_response(message, rng)) for name, message in messages.items())
+
+    results = {}
+    results.update(bench_build(number, repeat))
+    results.update(bench_parse(responses, number, repeat))
+    results.update(bench_handle_message(responses, number, repeat))
+    results.update(bench_reassembly(responses, number, repeat))
+    results.update(bench_request_latency(messages, max(number // 10, 1), repeat))
+    return results
+
+def compare(results, baseline, threshold):
+    """ Returns list of (name, baseline, result) of benchmarks slower than threshold allows. """
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        before = baseline.get(name)
+        if before and seconds > before * (1.0 + threshold):
+            regressions.append((name, before, seconds))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark m365py protocol hot paths')
+    parser.add_argument('--number', type=int, default=2000, help='calls per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs, the best is kept')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown as a fraction of the baseline')
+    args = parser.parse_args(argv)
+
+    results = run(args.number, args.repeat)
+    report = {
+        'python':  platform.python_version(),
+        'machine': platform.machine(),
+        'unit':    'seconds per call',
+        'results': results,
+    }
+
+    for name, seconds in sorted(results.items()):
+        print('{:<40} {:>10.2f} us'.format(name, seconds * 1e6))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, seconds in regressions:
+            print('REGRESSION {}: {:.2f} us -> {:.2f} us'.format(name, before * 1e6, seconds * 1e6))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,13 +4,14 @@ import json
 from m365py import m365py
 from m365py import m365message
 
-# this sets debug level of m365py
+# m365py leaves logging setup to the application, this prints its debug output
 import logging
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logging.getLogger('m365py').setLevel(logging.DEBUG)
 
 # callback for received messages from scooter
 def handle_message(m365_peripheral, m365_message, value):
-    print('Received message => {}'.format(json.dumps(value, indent=4)))
+    print('Received message => {}'.format(json.dumps(value.to_dict(), indent=4)))
 
     # check for specific message
     if m365_message.attribute == m365message.Attribute.BATTERY_VOLTAGE:
@@ -44,14 +45,14 @@ received_within_timeout = scooter.waitForNotifications(2.0)
 # turn on cruise mode
 scooter.request(m365message.turn_on_cruise)
 # fetch value to confirm that the scooter cruise mode has been enabled
-scooter.request(m365message.cruise_status)
+print('Cruise on: {}'.format(scooter.request(m365message.cruise_status).result()['is_cruise_on']))
 # reset cruise mode
 scooter.request(m365message.turn_off_cruise)
 
 # lock scooter
 scooter.request(m365message.turn_on_lock)
 # fetch value to confirm that the scooter is locked
-scooter.request(m365message.lock_status)
+print('Locked: {}'.format(scooter.request(m365message.lock_status).result()['is_lock_on']))
 # unlock scooter
 scooter.request(m365message.turn_off_lock)
 
@@ -76,8 +77,11 @@ while True:
     scooter.request(m365message.cruise_status)
     scooter.request(m365message.supplementary)
 
+    # requests are pipelined, wait for the responses to arrive
+    scooter.wait_for_responses(update_interval_s)
+
     # m365py also stores a cached state of received values
-    print(json.dumps(scooter.cached_state, indent=4, sort_keys=True))
+    print(json.dumps(scooter.cached_state.to_dict(), indent=4, sort_keys=True))
 
     # try to consistently run loop every 5 seconds
     elapsed_time = time.time() - start_time
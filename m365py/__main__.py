@@ -1,12 +1,30 @@
-from bluepy.btle import Scanner
-
-""" Scans for available devices. """
-scan = Scanner()
-sec = 5
-print("Scanning for %s seconds" % sec)
-devs = scan.scan(sec)
-print("Scooters found:")
-for dev in devs:
-    localname = dev.getValueText(9)
-    if localname and localname.startswith("MIScooter"):
-        print("  %s, addr=%s, rssi=%d" % (localname, dev.addr, dev.rssi))
+""" Scans continuously for scooters in range, printing them as they appear and leave. """
+
+import argparse
+
+from .m365message import _clock
+from .m365discovery import Discovery
+
+parser = argparse.ArgumentParser(prog='python -m m365py', description='Lists Xiaomi M365 scooters in range.')
+parser.add_argument('--duration', type=float, default=None, help='seconds to scan, until interrupted by default')
+parser.add_argument('--iface', type=int, default=0, help='HCI adapter number')
+parser.add_argument('--expiry', type=float, default=30.0, help='seconds without advertisements before a scooter has left')
+args = parser.parse_args()
+
+def appeared(sighting):
+    print("  + %s, addr=%s, rssi=%d" % (sighting.name, sighting.mac_address, sighting.rssi))
+
+def left(sighting):
+    print("  - %s, addr=%s, last rssi=%d" % (sighting.name, sighting.mac_address, sighting.rssi))
+
+discovery = Discovery(iface=args.iface, expiry=args.expiry, on_appear=appeared, on_leave=left)
+print("Scanning for scooters, Ctrl-C to stop" if args.duration is None else "Scanning for %s seconds" % args.duration)
+try:
+    discovery.run(args.duration)
+except KeyboardInterrupt:
+    pass  # run() stops the scan
+
+print("Scooters in range:")
+for sighting in discovery.scooters():
+    print("  %s, addr=%s, rssi=%d, seen %.0f s ago" % (sighting.name, sighting.mac_address, sighting.rssi,
+                                                       _clock() - sighting.last_seen))
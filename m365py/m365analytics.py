@@ -0,0 +1,336 @@
+""" Online ride analytics over the decoded responses.
+
+Every sample updates a handful of accumulators in constant time and memory
+per scooter: energy integrated over time from battery voltage and current,
+speed statistics over a sliding window, cell voltage spread and the state of
+the current trip. Fields are picked up by name from whichever attribute
+carries them, e.g. speed_kmh from MOTOR_INFO or SPEED.
+
+RideAnalytics.write() has the signature of a sink, so the same analytics run
+live, attached to M365s or Fleets, or over a capture with
+m365capture.replay(path, analytics.write). Only differences between
+timestamps matter, live samples default to the monotonic clock and replayed
+ones carry the wall clock time they were received.
+"""
+
+import threading
+from collections import deque
+
+from .m365message import _clock
+
+# volts per unit of the decoded cell_voltages, which are millivolts / 100
+CELL_VOLTS = 0.1
+
+class TimeIntegral():
+    """ Trapezoidal integral of a value over time.
+
+    Intervals longer than max_gap seconds, e.g. while disconnected, are not integrated.
+    """
+    __slots__ = ('max_gap', 'positive', 'negative', '_timestamp', '_value')
+
+    def __init__(self, max_gap=10.0):
+        self.max_gap    = max_gap
+        self.positive   = 0.0  # integral of the value while above zero
+        self.negative   = 0.0  # integral of the value while below zero, as a positive number
+        self._timestamp = None
+        self._value     = None
+
+    def add(self, timestamp, value):
+        if self._timestamp is not None:
+            dt = timestamp - self._timestamp
+            if 0 < dt <= self.max_gap:
+                area = (self._value + value) * 0.5 * dt
+                if area >= 0:
+                    self.positive += area
+                else:
+                    self.negative -= area
+            elif dt <= 0:
+                return
+        self._timestamp = timestamp
+        self._value     = value
+
+class WindowStats():
+    """ Minimum, maximum and mean of the samples of the last window seconds.
+
+    At most capacity samples are kept, the oldest are evicted first. Minimum
+    and maximum are tracked with monotonic queues, so each sample costs
+    amortized constant time.
+    """
+    __slots__ = ('window', 'capacity', '_samples', '_sum', '_min', '_max', '_count')
+
+    def __init__(self, window=30.0, capacity=512):
+        self.window   = window
+        self.capacity = capacity
+        self._samples = deque()  # (sample number, timestamp, value)
+        self._sum     = 0.0
+        self._min     = deque()  # (sample number, value) of increasing values
+        self._max     = deque()  # (sample number, value) of decreasing values
+        self._count   = 0
+
+    def _evict(self):
+        number, _, value = self._samples.popleft()
+        self._sum -= value
+        if self._min[0][0] == number:
+            self._min.popleft()
+        if self._max[0][0] == number:
+            self._max.popleft()
+
+    def add(self, timestamp, value):
+        samples = self._samples
+        while samples and (len(samples) >= self.capacity or samples[0][1] <= timestamp - self.window):
+            self._evict()
+
+        self._count += 1
+        samples.append((self._count, timestamp, value))
+        self._sum += value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((self._count, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((self._count, value))
+
+    def __len__(self):
+        return len(self._samples)
+
+    @property
+    def minimum(self):
+        return self._min[0][1] if self._min else None
+
+    @property
+    def maximum(self):
+        return self._max[0][1] if self._max else None
+
+    @property
+    def mean(self):
+        return self._sum / len(self._samples) if self._samples else None
+
+class TripSummary():
+    __slots__ = ('mac_address', 'started', 'ended', 'duration_s', 'moving_s', 'distance_km', 'energy_wh',
+                 'regen_wh', 'wh_per_km', 'max_speed_kmh', 'average_speed_kmh', 'battery_percent_start',
+                 'battery_percent_end', 'max_cell_spread_v')
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return 'TripSummary({})'.format(', '.join('{}={!r}'.format(n, getattr(self, n)) for n in self.__slots__))
+
+class ScooterAnalytics():
+    """ Accumulators of one scooter, see RideAnalytics. """
+
+    def __init__(self, mac_address, analytics):
+        self.mac_address = mac_address
+        self._analytics  = analytics
+
+        self.power    = TimeIntegral(analytics.max_gap)  # watt seconds
+        self.speed    = WindowStats(analytics.window, analytics.capacity)
+        self.distance = TimeIntegral(analytics.max_gap)  # km/h seconds, used without an odometer
+
+        self.voltage         = None
+        self.current         = None
+        self.speed_kmh       = None
+        self.odometer_km     = None
+        self.battery_percent = None
+        self.cell_spread_v   = None
+        self.lowest_cell     = None
+        self.samples         = 0
+
+        self._trip        = None  # dict of the values at the start of the current trip
+        self._last_moving = None
+        self._last_speed  = None
+
+    @property
+    def energy_wh(self):
+        """ Energy drawn from the battery since the first sample. """
+        return self.power.positive / 3600.0
+
+    @property
+    def regen_wh(self):
+        """ Energy put back into the battery by regenerative braking. """
+        return self.power.negative / 3600.0
+
+    @property
+    def in_trip(self):
+        return self._trip is not None
+
+    def update(self, result, timestamp):
+        self.samples += 1
+        fields = result.keys()
+
+        if 'battery_voltage' in fields or 'battery_current' in fields:
+            if 'battery_voltage' in fields:
+                self.voltage = result['battery_voltage']
+            if 'battery_current' in fields:
+                self.current = result['battery_current']
+            if self.voltage is not None and self.current is not None:
+                self.power.add(timestamp, self.voltage * self.current)
+
+        if 'battery_percent' in fields:
+            self.battery_percent = result['battery_percent']
+        if 'odometer_km' in fields:
+            self.odometer_km = result['odometer_km']
+
+        if 'cell_voltages' in fields:
+            cells = result['cell_voltages']
+            lowest = min(cells)
+            self.cell_spread_v = (max(cells) - lowest) * CELL_VOLTS
+            self.lowest_cell   = cells.index(lowest)
+            if self._trip is not None:
+                self._trip['max_cell_spread_v'] = max(self._trip['max_cell_spread_v'] or 0.0, self.cell_spread_v)
+
+        if 'speed_kmh' in fields:
+            self._update_speed(result['speed_kmh'], timestamp)
+
+        self.check_idle(timestamp)
+
+    def _update_speed(self, speed, timestamp):
+        analytics = self._analytics
+        self.speed_kmh = speed
+        self.speed.add(timestamp, speed)
+        self.distance.add(timestamp, speed)
+
+        moving = abs(speed) >= analytics.trip_start_kmh
+        trip = self._trip
+        if trip is None and moving:
+            trip = self._trip = {
+                'started':               timestamp,
+                'odometer_km':           self.odometer_km,
+                'energy_wh':             self.energy_wh,
+                'regen_wh':              self.regen_wh,
+                'distance_kmh_s':        self.distance.positive,
+                'battery_percent_start': self.battery_percent,
+                'max_cell_spread_v':     self.cell_spread_v,
+                'max_speed_kmh':         0.0,
+                'moving_s':              0.0,
+            }
+        if trip is not None:
+            if moving:
+                if self._last_speed is not None and self._last_speed[1]:
+                    dt = timestamp - self._last_speed[0]
+                    if 0 < dt <= analytics.max_gap:
+                        trip['moving_s'] += dt
+                self._last_moving = timestamp
+                trip['max_speed_kmh'] = max(trip['max_speed_kmh'], abs(speed))
+        self._last_speed = (timestamp, moving)
+
+    def check_idle(self, timestamp):
+        """ Ends the current trip if the scooter has stood still for trip_idle_timeout. """
+        if self._trip is not None and timestamp - self._last_moving >= self._analytics.trip_idle_timeout:
+            self.end_trip()
+
+    def end_trip(self):
+        """ Ends the current trip at the last moving sample, returns its TripSummary or None. """
+        trip = self._trip
+        if trip is None:
+            return None
+        self._trip = None
+
+        if trip['odometer_km'] is not None and self.odometer_km is not None:
+            distance = self.odometer_km - trip['odometer_km']
+        else:
+            distance = (self.distance.positive - trip['distance_kmh_s']) / 3600.0
+        energy = self.energy_wh - trip['energy_wh']
+        moving = trip['moving_s']
+        summary = TripSummary(
+            mac_address           = self.mac_address,
+            started               = trip['started'],
+            ended                 = self._last_moving,
+            duration_s            = self._last_moving - trip['started'],
+            moving_s              = moving,
+            distance_km           = distance,
+            energy_wh             = energy,
+            regen_wh              = self.regen_wh - trip['regen_wh'],
+            wh_per_km             = energy / distance if distance > 0 else None,
+            max_speed_kmh         = trip['max_speed_kmh'],
+            average_speed_kmh     = distance / (moving / 3600.0) if moving > 0 else None,
+            battery_percent_start = trip['battery_percent_start'],
+            battery_percent_end   = self.battery_percent,
+            max_cell_spread_v     = trip['max_cell_spread_v'],
+        )
+        self._analytics._trip_ended(summary)
+        return summary
+
+    def to_dict(self):
+        """ Returns the live values. """
+        return {
+            'samples':          self.samples,
+            'speed_kmh':        self.speed_kmh,
+            'speed_min_kmh':    self.speed.minimum,
+            'speed_max_kmh':    self.speed.maximum,
+            'speed_mean_kmh':   self.speed.mean,
+            'battery_voltage':  self.voltage,
+            'battery_current':  self.current,
+            'battery_percent':  self.battery_percent,
+            'energy_wh':        self.energy_wh,
+            'regen_wh':         self.regen_wh,
+            'cell_spread_v':    self.cell_spread_v,
+            'lowest_cell':      self.lowest_cell,
+            'in_trip':          self.in_trip,
+        }
+
+class RideAnalytics():
+    """ Live analytics of one or more scooters.
+
+    window:            seconds of speed samples the windowed statistics cover
+    capacity:          speed samples kept per scooter at most
+    trip_start_kmh:    speed at which a trip starts
+    trip_idle_timeout: seconds below trip_start_kmh that end a trip
+    max_gap:           longest interval in seconds between samples that is integrated
+    max_trips:         trip summaries kept in trips
+    on_trip:           called with every TripSummary when its trip ends
+    """
+
+    def __init__(self, window=30.0, capacity=512, trip_start_kmh=2.0, trip_idle_timeout=60.0, max_gap=10.0,
+                 max_trips=100, on_trip=None):
+        self.window            = window
+        self.capacity          = capacity
+        self.trip_start_kmh    = trip_start_kmh
+        self.trip_idle_timeout = trip_idle_timeout
+        self.max_gap           = max_gap
+        self.on_trip           = on_trip
+        self.trips             = deque(maxlen=max_trips)
+
+        self._scooters = {}
+        self._lock     = threading.Lock()
+
+    def attach(self, *targets):
+        """ Analyses every decoded response of the given M365s or Fleets. """
+        for target in targets:
+            target.add_sink(self)
+
+    def detach(self, *targets):
+        for target in targets:
+            target.remove_sink(self)
+
+    def scooter(self, mac_address):
+        """ Returns the ScooterAnalytics of a scooter, created on first use. """
+        scooter = self._scooters.get(mac_address)
+        if scooter is None:
+            with self._lock:
+                scooter = self._scooters.setdefault(mac_address, ScooterAnalytics(mac_address, self))
+        return scooter
+
+    def write(self, mac_address, message, result, timestamp=None):
+        """ Adds a decoded result, the signature of a sink and a m365capture.replay() callback. """
+        if result is None:
+            return
+        self.scooter(mac_address).update(result, _clock() if timestamp is None else timestamp)
+
+    def live(self):
+        """ Returns mac address -> dict of live values. """
+        return dict((mac, scooter.to_dict()) for mac, scooter in list(self._scooters.items()))
+
+    def close(self):
+        """ Ends every open trip, e.g. at the end of a replay. """
+        for scooter in list(self._scooters.values()):
+            scooter.end_trip()
+
+    def _trip_ended(self, summary):
+        self.trips.append(summary)
+        if self.on_trip is not None:
+            self.on_trip(summary)
@@ -0,0 +1,191 @@
+""" asyncio front end for M365.
+
+bluepy is blocking, so every call into it is made from a dedicated I/O thread
+which processes notifications in between and hands results to the event loop.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+
+from .m365py import M365
+from .m365message import _clock
+
+log = logging.getLogger('m365py')
+
+# queued after the last message once disconnected, ends iteration
+_CLOSED = object()
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+def _set_exception(future, error):
+    if not future.done():
+        future.set_exception(error)
+
+class AsyncM365():
+    """ Asynchronous client for a single scooter.
+
+    Decoded messages can be consumed with `async for message, result in scooter`,
+    which ends once disconnected and the messages received until then are
+    consumed. When nobody consumes them, at most max_queued messages are kept
+    and the oldest are dropped first.
+
+    If the link fails for good, e.g. without auto_reconnect, pending requests
+    and calls fail with the error, iteration ends and the client is
+    disconnected. connect() may be called again.
+    """
+
+    def __init__(self, mac_address, auto_reconnect=True, poll_interval=0.05, max_queued=256, **kwargs):
+        self.mac_address   = mac_address
+        self.poll_interval = poll_interval
+        self.max_queued    = max_queued
+
+        self._m365 = M365(mac_address, callback=self._on_message, auto_reconnect=auto_reconnect, **kwargs)
+        self._loop     = None
+        self._thread   = None
+        self._calls    = queue.Queue()
+        self._messages = None  # created in the running loop, queues are bound to a loop before Python 3.10
+        self._stopping = False
+        self._connected = False
+        self._closed    = False
+
+    @property
+    def m365(self):
+        return self._m365
+
+    @property
+    def cached_state(self):
+        return self._m365.cached_state
+
+    async def connect(self):
+        self._start()
+        if self._closed:
+            # iteration ended when the link was lost, start over
+            self._messages = asyncio.Queue(self.max_queued)
+            self._closed   = False
+        await self._call(self._m365.connect)
+        self._connected = True
+
+    async def disconnect(self):
+        if self._thread is None:
+            return
+        self._connected = False
+        try:
+            await self._call(self._m365.disconnect)
+        finally:
+            self._stopping = True
+            await self._loop.run_in_executor(None, self._thread.join)
+            self._thread = None
+            self._close_messages()
+
+    async def request(self, message, timeout=None):
+        """ Sends message and returns the decoded response, or None for writes. """
+        future = self._loop.create_future()
+
+        def send():
+            pending = self._m365.request(message, timeout)
+            pending.add_done_callback(lambda p: self._loop.call_soon_threadsafe(self._transfer, p, future))
+
+        await self._call(send)
+        return await future
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._messages is None:
+            raise StopAsyncIteration
+        item = await self._messages.get()
+        if item is _CLOSED:
+            self._messages.put_nowait(_CLOSED)  # for the next call, or another consumer
+            raise StopAsyncIteration
+        return item
+
+    @staticmethod
+    def _transfer(pending, future):
+        try:
+            _set_result(future, pending.result())
+        except Exception as e:
+            _set_exception(future, e)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._messages = asyncio.Queue(self.max_queued)
+        self._closed   = False
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run_io, name='m365-io-{}'.format(self.mac_address))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _call(self, func, *args):
+        """ Runs func on the I/O thread, returns a future for its result. """
+        future = self._loop.create_future()
+        self._calls.put((func, args, future))
+        return future
+
+    def _run_call(self, call):
+        func, args, future = call
+        try:
+            result = func(*args)
+        except BaseException as e:
+            self._loop.call_soon_threadsafe(_set_exception, future, e)
+        else:
+            self._loop.call_soon_threadsafe(_set_result, future, result)
+
+    def _run_io(self):
+        while not self._stopping or not self._calls.empty():
+            try:
+                if self._connected:
+                    call = self._calls.get_nowait()
+                else:
+                    call = self._calls.get(timeout=self.poll_interval)
+            except queue.Empty:
+                call = None
+
+            if call is not None:
+                self._run_call(call)
+            elif self._connected:
+                try:
+                    self._m365.waitForNotifications(self.poll_interval)
+                    self._m365._expire_requests(_clock())
+                except Exception as e:
+                    self._link_lost(e)
+
+    def _link_lost(self, error):
+        # called on the I/O thread, which keeps running for later calls, e.g. connect()
+        log.error('Lost {}: {}'.format(self.mac_address, error))
+        self._connected = False
+        self._m365._fail_requests(error)
+        while True:
+            try:
+                _, _, future = self._calls.get_nowait()
+            except queue.Empty:
+                break
+            self._loop.call_soon_threadsafe(_set_exception, future, error)
+        self._loop.call_soon_threadsafe(self._close_messages)
+
+    def _on_message(self, m365, message, result):
+        # called on the I/O thread
+        self._loop.call_soon_threadsafe(self._enqueue, (message, result))
+
+    def _close_messages(self):
+        if not self._closed:
+            self._closed = True
+            self._enqueue(_CLOSED)
+
+    def _enqueue(self, item):
+        if self._messages.full():
+            self._messages.get_nowait()
+        self._messages.put_nowait(item)
@@ -0,0 +1,141 @@
+""" Vectorized decoding of captured frame streams with NumPy.
+
+Requires numpy, install with `pip install m365py[batch]`.
+"""
+
+import numpy as np
+
+from .m365message import HEADER_BYTES, FRAME_OVERHEAD
+from .m365decoder import get_decoder, _split_format
+
+# struct format code -> numpy type code, byte order is prepended
+_NUMPY_TYPES = {
+    'b': 'i1', 'B': 'u1', '?': '?',
+    'h': 'i2', 'H': 'u2',
+    'i': 'i4', 'I': 'u4', 'l': 'i4', 'L': 'u4',
+    'q': 'i8', 'Q': 'u8',
+    'e': 'f2', 'f': 'f4', 'd': 'f8',
+}
+
+def numpy_dtype(decoder):
+    """ Structured dtype with the same field layout as the decoder's struct. """
+    names, formats, offsets = [], [], []
+    for name in decoder.names:
+        offset, field_struct, count, _ = decoder.layout[name]
+        byte_order, tokens = _split_format(field_struct.format)
+        byte_order = '>' if byte_order in ('>', '!') else '<'
+        code = tokens[0][0]
+        if code.endswith('s'):
+            fmt = 'S' + (code[:-1] or '1')
+        else:
+            fmt = byte_order + _NUMPY_TYPES[code]
+        if count > 1:
+            fmt = (fmt, (count,))
+        names.append(name)
+        formats.append(fmt)
+        offsets.append(offset)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': decoder.size})
+
+def split_frames(buffer):
+    """ Finds the valid frames in a buffer of concatenated frames.
+
+    Returns arrays of start offsets and total lengths. Garbage between frames
+    and frames with invalid checksums are skipped.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    size = len(data)
+    if size < FRAME_OVERHEAD + 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    header = np.frombuffer(HEADER_BYTES, dtype=np.uint8)
+    starts = np.flatnonzero((data[:-2] == header[0]) & (data[1:-1] == header[1]))
+    lengths = data[starts + 2].astype(np.int64)
+    frame_lengths = lengths + FRAME_OVERHEAD
+    keep = (lengths >= 2) & (starts + frame_lengths <= size)
+    starts, frame_lengths = starts[keep], frame_lengths[keep]
+
+    # checksum covers length byte up to the payload end
+    ends = starts + frame_lengths
+    sums = np.concatenate(([0], np.cumsum(data, dtype=np.int64)))
+    checked = sums[ends - 2] - sums[starts + 2]
+    expected = data[ends - 2].astype(np.int64) | (data[ends - 1].astype(np.int64) << 8)
+    keep = ((checked ^ 0xffff) & 0xffff) == expected
+    starts, frame_lengths = starts[keep], frame_lengths[keep]
+
+    # a header inside a payload can pass the checksum, keep the first of overlapping frames
+    ends = starts + frame_lengths
+    if len(starts) > 1 and np.any(starts[1:] < ends[:-1]):
+        keep = np.zeros(len(starts), dtype=bool)
+        end = 0
+        for i, (start, frame_end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            if start >= end:
+                keep[i] = True
+                end = frame_end
+        starts, frame_lengths = starts[keep], frame_lengths[keep]
+
+    return starts, frame_lengths
+
+def _convert(column, field):
+    if field.scale is None and field.transform is None:
+        return column
+
+    if column.dtype.kind in 'iu':
+        column = column.astype(np.int64)  # transforms such as x - 20 must not wrap
+    if field.scale is not None:
+        column = column.astype(np.float64) / field.scale
+    if field.transform is not None:
+        try:
+            converted = field.transform(column)
+        except (AttributeError, TypeError, ValueError):
+            converted = None
+        if not isinstance(converted, np.ndarray) or converted.shape != column.shape:
+            # transforms on str or bytes only work on single values
+            converted = np.array([field.transform(v) for v in column.tolist()], dtype=object)
+        column = converted
+    return column
+
+class Batch():
+    """ Decoded frames of one (direction, attribute), columns[name] is an array per field. """
+    __slots__ = ('direction', 'attribute', 'offsets', 'columns')
+
+    def __init__(self, direction, attribute, offsets, columns):
+        self.direction = direction
+        self.attribute = attribute
+        self.offsets   = offsets
+        self.columns   = columns
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+def decode_batch(buffer):
+    """ Decodes every valid frame in a buffer of concatenated frames.
+
+    Returns dict of (direction, attribute) -> Batch, scaled and transformed like
+    the decoders in m365decoder. Frames without a registered decoder, or with
+    a payload length the decoder does not expect, are left out.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    starts, frame_lengths = split_frames(buffer)
+    payload_lengths = frame_lengths - FRAME_OVERHEAD - 2  # checksum
+    keys = (data[starts + 3].astype(np.int64) << 8) | data[starts + 5]
+
+    result = {}
+    for key in np.unique(keys).tolist():
+        direction, attribute = key >> 8, key & 0xff
+        decoder = get_decoder(direction, attribute)
+        if decoder is None:
+            continue
+        selected = starts[(keys == key) & (payload_lengths == decoder.size)]
+        if not len(selected):
+            continue
+
+        rows = data[selected[:, None] + FRAME_OVERHEAD + np.arange(decoder.size)]
+        records = np.ascontiguousarray(rows).view(numpy_dtype(decoder)).reshape(-1)
+        columns = {}
+        for field in decoder.fields:
+            columns[field.name] = _convert(records[field.name], field)
+        result[(direction, attribute)] = Batch(direction, attribute, selected, columns)
+    return result
@@ -0,0 +1,186 @@
+""" Recording of raw notifications and offline replay.
+
+A capture file starts with a header of
+
+    magic(8) clock offset(8)
+
+followed by records of
+
+    length(2) timestamp(8) id length(1) id(id length) data(length)
+
+all little endian, where timestamp is the monotonic time the notification was
+received and id is the UTF-8 encoded mac address of the M365, or whatever id
+it was given, e.g. 'esc' for a serial link. Records are length prefixed so a
+file can be scanned through mmap without parsing the data. The clock offset is
+the wall clock time minus the monotonic time when the file was created, so
+timestamp + clock offset is the time since the epoch.
+"""
+
+import mmap
+import struct
+import threading
+import time
+
+from .m365message import FrameReassembler, _clock
+from .m365decoder import get_decoder
+
+MAGIC = b'M365CAP\x01'
+
+_file_header   = struct.Struct('<8sd')
+_record_header = struct.Struct('<HdB')
+
+def _pack_id(mac_address):
+    packed = mac_address.encode('utf-8')
+    if len(packed) > 0xff:
+        raise ValueError('Capture ids are limited to 255 bytes, got {!r}'.format(mac_address))
+    return packed
+
+def _clock_offset():
+    return time.time() - _clock()
+
+class CaptureWriter():
+    """ Appends notifications to a capture file, safe to share between scooters.
+
+    Timestamps are monotonic times. Appending to a file created before the
+    monotonic clock restarted, e.g. before a reboot, shifts them onto the
+    file's clock offset.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+        self._macs = {}
+        offset = _clock_offset()
+        if self._file.tell() == 0:
+            self.clock_offset = offset
+            self._file.write(_file_header.pack(MAGIC, offset))
+        else:
+            with open(path, 'rb') as f:
+                magic, self.clock_offset = _file_header.unpack(f.read(_file_header.size))
+            if magic != MAGIC:
+                self._file.close()
+                raise ValueError('{} is not a m365py capture file'.format(path))
+        self._shift = offset - self.clock_offset
+
+    def write(self, mac_address, data, timestamp=None):
+        if timestamp is None:
+            timestamp = _clock()
+        timestamp += self._shift
+        packed = self._macs.get(mac_address)
+        if packed is None:
+            packed = self._macs[mac_address] = _pack_id(mac_address)
+        with self._lock:
+            self._file.write(_record_header.pack(len(data), timestamp, len(packed)))
+            self._file.write(packed)
+            self._file.write(data)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class CaptureReader():
+    """ Iterates (timestamp, mac address, data) records of a memory mapped capture file.
+
+    Timestamps are monotonic as recorded, add clock_offset for the wall clock time.
+
+    data is a memoryview into the mapping and is only valid until the reader is closed.
+    A truncated record at the end of the file, e.g. from a recording that was
+    interrupted, is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = None
+        self._view = memoryview(b'')
+        if self._file.seek(0, 2) > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        if len(self._view) < _file_header.size or self._view[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('{} is not a m365py capture file'.format(path))
+        self.clock_offset = _file_header.unpack_from(self._view, 0)[1]
+
+    def __iter__(self):
+        view = self._view
+        size = len(view)
+        header_size = _record_header.size
+        ids = {}
+
+        offset = _file_header.size
+        while offset + header_size <= size:
+            length, timestamp, id_length = _record_header.unpack_from(view, offset)
+            offset += header_size
+            if offset + id_length + length > size:
+                break
+            packed = bytes(view[offset:offset + id_length])
+            offset += id_length
+            mac_address = ids.get(packed)
+            if mac_address is None:
+                mac_address = ids[packed] = packed.decode('utf-8')
+            yield timestamp, mac_address, view[offset:offset + length]
+            offset += length
+
+    def close(self):
+        try:
+            self._view.release()
+            if self._map is not None:
+                self._map.close()
+        except BufferError:
+            pass  # records handed out are still referenced, the mapping is freed with them
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def replay(path, callback, paced=False, speed=1.0):
+    """ Reassembles and decodes the notifications of a capture file.
+
+    callback(mac_address, frame, result, timestamp) is called for every frame,
+    with result None if no decoder is registered for it and the wall clock time
+    the frame was received, like sinks stamp live rows. Frames are replayed as
+    fast as possible, or spaced like the original timestamps divided by speed
+    when paced. Returns the number of decoded frames.
+    """
+    reassemblers = {}
+    decoded = 0
+    first_timestamp = None
+    started_at = None
+
+    with CaptureReader(path) as reader:
+        clock_offset = reader.clock_offset
+        for timestamp, mac_address, data in reader:
+            if paced:
+                if first_timestamp is None:
+                    first_timestamp, started_at = timestamp, _clock()
+                delay = (timestamp - first_timestamp) / speed - (_clock() - started_at)
+                if delay > 0:
+                    time.sleep(delay)
+
+            reassembler = reassemblers.get(mac_address)
+            if reassembler is None:
+                reassembler = reassemblers[mac_address] = FrameReassembler()
+
+            for frame in reassembler.feed(data, timestamp):
+                decoder = get_decoder(frame.direction, frame.attribute)
+                result = None
+                if decoder is not None and len(frame.payload) == decoder.size:
+                    result = decoder.decode(frame.payload)
+                    decoded += 1
+                callback(mac_address, frame, result, timestamp + clock_offset)
+
+    return decoded
@@ -0,0 +1,150 @@
+""" Merges reads of adjacent registers into fewer requests. """
+
+import logging
+
+from .m365message import Frame, ReadWrite, RESPONSE_DIRECTION, read_registers
+from .m365py import PendingRequest
+
+log = logging.getLogger('m365py')
+
+# largest number of bytes merged into a single read
+MAX_READ_LENGTH = 0x40
+
+class ReadRange():
+    """ A register read spanning bytes [start, end) of a controller's register space. """
+    __slots__ = ('direction', 'start', 'end', 'members')
+
+    def __init__(self, direction, start, end, members):
+        self.direction = direction
+        self.start     = start
+        self.end       = end
+        self.members   = members
+
+    @property
+    def attribute(self):
+        return self.start // 2
+
+    @property
+    def length(self):
+        return self.end - self.start
+
+    def message(self):
+        return read_registers(self.direction, self.attribute, self.length)
+
+def _read_span(message):
+    start = message.attribute * 2
+    return start, start + bytearray(message.payload)[0]
+
+def is_register_read(message):
+    return message.read_write == ReadWrite.READ and len(message.payload) == 1 \
+        and message.direction in RESPONSE_DIRECTION
+
+def coalesce(messages, max_length=MAX_READ_LENGTH, max_gap=0):
+    """ Groups read messages into as few ReadRanges as possible.
+
+    Reads of the same controller are merged when they overlap or are at most
+    max_gap registers apart and the merged read is at most max_length bytes.
+    Each range's members are the messages it covers.
+    """
+    spans = sorted((message.direction,) + _read_span(message) + (i,) for i, message in enumerate(messages))
+
+    ranges = []
+    current = None
+    for direction, start, end, i in spans:
+        if current is not None and current.direction == direction \
+                and start <= current.end + max_gap * 2 \
+                and max(end, current.end) - current.start <= max_length:
+            current.end = max(end, current.end)
+            current.members.append(messages[i])
+        else:
+            current = ReadRange(direction, start, end, [messages[i]])
+            ranges.append(current)
+    return ranges
+
+class ReadCoalescer():
+    """ Queues requests and sends the reads among them as merged register ranges.
+
+    Each queued message gets its own PendingRequest, resolved from its slice of
+    the merged response. The slices are also decoded, cached and passed to the
+    M365 callback as if they had been requested on their own.
+    """
+
+    def __init__(self, m365, max_length=None, max_gap=0):
+        self.m365       = m365
+        self.max_length = max_length or MAX_READ_LENGTH
+        self.max_gap    = max_gap
+        self._queued    = []
+
+    def queue(self, message):
+        pending = PendingRequest(self.m365, message, None)
+        self._queued.append((message, pending))
+        return pending
+
+    def flush(self, timeout=None):
+        """ Sends the queued requests, returns the PendingRequests of the merged reads. """
+        queued, self._queued = self._queued, []
+
+        reads = []
+        for message, pending in queued:
+            if is_register_read(message):
+                reads.append(message)
+            else:
+                self.m365.request(message, timeout).add_done_callback(
+                    lambda p, pending=pending: self._forward(p, pending))
+
+        # the same message may be queued more than once
+        members = {}
+        for message, pending in queued:
+            members.setdefault(id(message), []).append(pending)
+
+        sent = []
+        for read_range in coalesce(reads, self.max_length, self.max_gap):
+            range_pending = [(message, members[id(message)].pop(0)) for message in read_range.members]
+            if len(range_pending) == 1:
+                message, pending = range_pending[0]
+                request = self.m365.request(message, timeout)
+                request.add_done_callback(lambda p, pending=pending: self._forward(p, pending))
+            else:
+                request = self.m365.request(read_range.message(), timeout)
+                request.add_done_callback(
+                    lambda p, read_range=read_range, range_pending=range_pending: self._split(p, read_range, range_pending))
+            for _, pending in range_pending:
+                pending._set_sent(request.sent_at)
+            sent.append(request)
+        return sent
+
+    @staticmethod
+    def _forward(request, pending):
+        try:
+            result = request.result()
+        except Exception as e:
+            pending._fail(e)
+        else:
+            pending._resolve(request.frame, result)
+
+    def _split(self, request, read_range, range_pending):
+        try:
+            merged = request.result()
+        except Exception as e:
+            for _, pending in range_pending:
+                pending._fail(e)
+            return
+
+        response = request.frame
+        for message, pending in range_pending:
+            start, end = _read_span(message)
+            if merged is not None and (start, end) == (read_range.start, read_range.end):
+                # the merged read is this message, it has already been handled
+                pending._resolve(response, merged)
+                merged = None
+                continue
+
+            payload = response.payload[start - read_range.start:end - read_range.start]
+            if len(payload) != end - start:
+                pending._fail(ValueError('Response to register read at {:#04x} is too short'.format(read_range.attribute)))
+                continue
+
+            # a slice must not complete a separate request for the same attribute still in flight
+            frame = Frame(response.direction, response.read_write, message.attribute, payload, None)
+            result = self.m365._delegate.dispatch_message(frame)
+            pending._resolve(frame, result)
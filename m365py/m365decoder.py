@@ -0,0 +1,323 @@
+import re
+import struct
+from array import array
+from collections.abc import Mapping
+
+from .m365message import Direction, Attribute
+
+class Field():
+    """ A named value unpacked from a payload.
+
+    scale:     raw value is divided by scale (e.g. 100 turns 1234 into 12.34)
+    transform: callable applied after scaling (e.g. convert to bool or str)
+    count:     number of consecutive struct values collected into a list
+    """
+
+    def __init__(self, name, scale=None, transform=None, count=1):
+        self.name      = name
+        self.scale     = scale
+        self.transform = transform
+        self.count     = count
+
+    def converter(self):
+        scale     = self.scale
+        transform = self.transform
+
+        if scale is None:
+            return transform
+        if transform is None:
+            return lambda x: float(x) / scale
+        return lambda x: transform(float(x) / scale)
+
+_format_token = re.compile(r'(\d*)([xcbB?hHiIlLqQnNefdspP])')
+
+def _split_format(fmt):
+    """ Splits a struct format into byte order and (token, value count) pairs. """
+    byte_order = fmt[0] if fmt[:1] in ('@', '=', '<', '>', '!') else ''
+    tokens = []
+    for count, code in _format_token.findall(fmt[len(byte_order):]):
+        if code == 'x':
+            tokens.append((count + code, 0))
+        elif code in 'sp':
+            tokens.append((count + code, 1))
+        else:
+            tokens.extend([(code, 1)] * (int(count) if count else 1))
+    return byte_order, tokens
+
+class Record(Mapping):
+    """ Decoded fields of one response, read as attributes or like a read-only dict.
+
+    Record types are made per decoder with a slot per field, see record_type().
+    Use to_dict() where a real dict is needed, e.g. for json.dumps.
+    """
+    __slots__ = ()
+
+    _fields    = ()
+    _field_set = frozenset()
+
+    def __getitem__(self, name):
+        if name in self._field_set:
+            return getattr(self, name)
+        raise KeyError(name)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __contains__(self, name):
+        return name in self._field_set
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self._fields)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self._fields))
+
+# struct codes whose values can be kept in an array of the same type code
+_ARRAY_CODES = set('bBhHiIlLqQfd')
+
+def _array_property(slot, convert):
+    if convert is None:
+        return property(lambda self: list(getattr(self, slot)))
+    return property(lambda self: [convert(v) for v in getattr(self, slot)])
+
+def record_type(name, fields, array_codes=None):
+    """ Creates a Record subclass with a slot per field.
+
+    array_codes maps names of multi value fields to the array type code their
+    raw values are kept in. Reading such a field converts the values, e.g.
+    scales them, into a new list.
+    """
+    array_codes = array_codes or {}
+    slots = []
+    namespace = {}
+    for field in fields:
+        if field.name in array_codes:
+            slots.append('_' + field.name)
+            namespace[field.name] = _array_property('_' + field.name, field.converter())
+        else:
+            slots.append(field.name)
+    namespace['__slots__']  = tuple(slots)
+    namespace['_fields']    = tuple(field.name for field in fields)
+    namespace['_field_set'] = frozenset(namespace['_fields'])
+    return type(name, (Record,), namespace)
+
+class Decoder():
+    """ Decodes a payload with a precompiled struct into a Record of fields.
+
+    record names the Record type made for the decoder, available as decoder.record.
+    """
+
+    def __init__(self, fmt, fields, record='Record'):
+        self.struct = struct.Struct(fmt)
+        self.fields = tuple(fields)
+        self.names  = tuple(field.name for field in self.fields)
+
+        self._plan = []
+        index = 0
+        for field in self.fields:
+            self._plan.append((field.name, index, field.count, field.converter()))
+            index += field.count
+
+        if index != len(self.struct.unpack(b'\x00' * self.struct.size)):
+            raise ValueError('Fields do not match struct format {}'.format(fmt))
+
+        # most payloads are plain integers, skip the conversion loop for these
+        self._plain = all(count == 1 and convert is None for _, _, count, convert in self._plan)
+
+        # name -> (byte offset, struct, count, converter), to decode single fields in place
+        self.layout = {}
+        # multi value fields of a single numeric type keep their raw values in an array
+        array_codes = {}
+        byte_order, tokens = _split_format(fmt)
+        prefix = byte_order
+        position = 0
+        for name, _, count, convert in self._plan:
+            while tokens[position][1] == 0:  # padding
+                prefix += tokens[position][0]
+                position += 1
+            field_tokens = ''.join(token for token, _ in tokens[position:position + count])
+            offset = struct.calcsize(prefix + field_tokens) - struct.calcsize(byte_order + field_tokens)
+            self.layout[name] = (offset, struct.Struct(byte_order + field_tokens), count, convert)
+            codes = set(token for token, _ in tokens[position:position + count])
+            if count > 1 and len(codes) == 1 and codes <= _ARRAY_CODES:
+                array_codes[name] = codes.pop()
+            prefix += field_tokens
+            position += count
+
+        self.record = record_type(record, self.fields, array_codes)
+
+        # slot setters in field order, with index, count, converter and array type code
+        self._record_plan = []
+        for name, index, count, convert in self._plan:
+            slot = '_' + name if name in array_codes else name
+            setter = getattr(self.record, slot).__set__
+            self._record_plan.append((setter, index, count, convert, array_codes.get(name)))
+        self._setters = tuple(setter for setter, _, _, _, _ in self._record_plan)
+
+    @property
+    def size(self):
+        return self.struct.size
+
+    def decode(self, payload):
+        values = self.struct.unpack(payload)
+        record = object.__new__(self.record)
+        if self._plain:
+            for setter, value in zip(self._setters, values):
+                setter(record, value)
+            return record
+
+        for setter, index, count, convert, typecode in self._record_plan:
+            if count == 1:
+                value = values[index]
+                setter(record, convert(value) if convert else value)
+            elif typecode is not None:
+                setter(record, array(typecode, values[index:index + count]))
+            else:
+                value = values[index:index + count]
+                setter(record, [convert(v) for v in value] if convert else list(value))
+        return record
+
+    def decode_field(self, name, buffer, offset=0):
+        """ Decodes a single field of a payload starting at offset in buffer. """
+        field_offset, field_struct, count, convert = self.layout[name]
+        values = field_struct.unpack_from(buffer, offset + field_offset)
+        if count == 1:
+            return convert(values[0]) if convert else values[0]
+        return [convert(v) for v in values] if convert else list(values)
+
+# (direction, attribute) -> Decoder
+_decoders = {}
+# incremented whenever _decoders changes so derived indexes can be rebuilt
+_revision = 0
+
+def register_decoder(direction, attribute, decoder):
+    """ Registers decoder for responses with given direction and attribute,
+    replacing any existing decoder. """
+    global _revision
+    _decoders[(direction, attribute)] = decoder
+    _revision += 1
+
+def unregister_decoder(direction, attribute):
+    global _revision
+    _decoders.pop((direction, attribute), None)
+    _revision += 1
+
+def registered_decoders():
+    """ Returns list of ((direction, attribute), decoder) pairs. """
+    return list(_decoders.items())
+
+def registry_revision():
+    return _revision
+
+def get_decoder(direction, attribute):
+    return _decoders.get((direction, attribute))
+
+def _register_builtin(attribute, decoder):
+    # The protocol notes this library is based on do not pin every attribute to
+    # one controller, so built-in decoders accept responses from either one.
+    for direction in (Direction.MOTOR_TO_MASTER, Direction.BATTERY_TO_MASTER):
+        register_decoder(direction, attribute, decoder)
+    return decoder.record
+
+def _equals(expected):
+    return lambda x: x == expected
+
+def _minus(offset):
+    return lambda x: x - offset
+
+def _decode_utf8(x):
+    return x.decode('utf-8')
+
+def _format_version(x):
+    return 'V' + '.'.join('{:02x}'.format(x))  # V1.3.8
+
+DistanceLeft = _register_builtin(Attribute.DISTANCE_LEFT, Decoder('<H', [
+    Field('distance_left_km', scale=100),                      # km
+], record='DistanceLeft'))
+
+Speed = _register_builtin(Attribute.SPEED, Decoder('<h', [
+    Field('speed_kmh', scale=100),                             # km/h
+], record='Speed'))
+
+TripDistance = _register_builtin(Attribute.TRIP_DISTANCE, Decoder('<H', [
+    Field('trip_distance_m'),
+], record='TripDistance'))
+
+TailLight = _register_builtin(Attribute.TAIL_LIGHT, Decoder('<H', [
+    Field('is_tail_light_on', transform=_equals(0x02)),        # bool
+], record='TailLight'))
+
+Cruise = _register_builtin(Attribute.CRUISE, Decoder('<H', [
+    Field('is_cruise_on', transform=_equals(0x01)),            # bool
+], record='Cruise'))
+
+LockStatus = _register_builtin(Attribute.GET_LOCK, Decoder('<H', [
+    Field('is_lock_on', transform=_equals(0x02)),              # bool
+], record='LockStatus'))
+
+BatteryInfo = _register_builtin(Attribute.BATTERY_INFO, Decoder('<HHhHBB', [
+    Field('battery_capacity', scale=1000),                     # Ah
+    Field('battery_percent'),
+    Field('battery_current', scale=100),                       # A
+    Field('battery_voltage', scale=100),                       # V
+    Field('battery_temperature_1', transform=_minus(20)),      # C
+    Field('battery_temperature_2', transform=_minus(20)),      # C
+], record='BatteryInfo'))
+
+BatteryVoltage = _register_builtin(Attribute.BATTERY_VOLTAGE, Decoder('<H', [
+    Field('battery_voltage', scale=100),                       # V
+], record='BatteryVoltage'))
+
+BatteryCurrent = _register_builtin(Attribute.BATTERY_CURRENT, Decoder('<h', [
+    Field('battery_current', scale=100),                       # A
+], record='BatteryCurrent'))
+
+BatteryPercent = _register_builtin(Attribute.BATTERY_PERCENT, Decoder('<H', [
+    Field('battery_percent'),
+], record='BatteryPercent'))
+
+#          [                      SERIAL                          ][          PIN         ][ VER  ]
+# payload: /x31/x36/x31/x33/x32/x2f/x30/x30/x30/x39/x35/x32/x39/x32/x30/x30/x30/x30/x30/x30/x38/x01
+GeneralInfo = _register_builtin(Attribute.GENERAL_INFO, Decoder('<14s6sH', [
+    Field('serial', transform=_decode_utf8),                   # str
+    Field('pin', transform=_decode_utf8),                      # str
+    Field('version', transform=_format_version),               # str
+], record='GeneralInfo'))
+
+# 'error warning flags workmode' are skipped
+MotorInfo = _register_builtin(Attribute.MOTOR_INFO, Decoder('<xxxxxxxxHhHIhhhxxxxxxxx', [
+    Field('battery_percent'),
+    Field('speed_kmh', scale=100),                             # km/h
+    Field('speed_average_kmh', scale=100),                     # km/h
+    Field('odometer_km', scale=1000),                          # km
+    Field('trip_distance_m'),
+    Field('uptime_s'),
+    Field('frame_temperature', scale=10),                      # C
+], record='MotorInfo'))
+
+#          [uptime][]
+# payload: xec/x00 /x00/x00/x00/x00/x00/x00/xe6/x00
+TripInfo = _register_builtin(Attribute.TRIP_INFO, Decoder('<HIxxh', [
+    Field('uptime_s'),
+    Field('trip_distance_m'),
+    Field('frame_temperature', scale=10),                      # C
+], record='TripInfo'))
+
+#          [cell1 ][cell2 ]                     ...                                [cell10][           ???            ]
+# payload: /x2d/x10/x2e/x10/x1d/x10/x2f/x10/x34/x10/x34/x10/x3a/x10/x3a/x10/x2e/x10/x2f/x10/x00/x00/x00/x00/x00/x00/x00
+CellVoltages = _register_builtin(Attribute.BATTERY_CELL_VOLTAGES, Decoder('<HHHHHHHHHHxxxxxxx', [
+    Field('cell_voltages', scale=100, count=10),               # mV / 100, 41.41 is 4.141 V
+], record='CellVoltages'))
+
+# TODO:  Proper states for kers mode instead of byte value
+#          [ kers ] [cruise] [taillight]
+# payload: /x00/x00 /x00/x00 /x00/x00
+Supplementary = _register_builtin(Attribute.SUPPLEMENTARY, Decoder('<HHH', [
+    Field('kers_mode'),
+    Field('is_cruise_on', transform=_equals(0x01)),            # bool
+    Field('is_tail_light_on', transform=_equals(0x02)),        # bool
+], record='Supplementary'))
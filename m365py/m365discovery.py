@@ -0,0 +1,220 @@
+""" Continuous discovery of scooters in range.
+
+A Discovery keeps scanning in the background and indexes the scooters it
+hears, with a smoothed RSSI and the time each was last seen. Scooters not
+heard for expiry seconds are dropped from the index. Listeners are told when a
+scooter appears or leaves, e.g. a Fleet only connects to scooters in range.
+
+Scanning is done by a backend with
+
+    start()          starts scanning
+    poll(timeout)    returns the (mac address, name or None, rssi) advertisements
+                     heard within timeout seconds
+    stop()           stops scanning
+
+BluepyScanner by default, m365sim.SimulatedScanner stands in for testing.
+"""
+
+import logging
+import threading
+
+from .m365message import _clock
+
+log = logging.getLogger('m365py')
+
+SCOOTER_NAME_PREFIX = 'MIScooter'
+
+# advertising data type of the complete local name
+COMPLETE_LOCAL_NAME = 9
+
+class BluepyScanner():
+    """ Scans continuously with bluepy's Scanner on HCI adapter iface. """
+
+    def __init__(self, iface=0, passive=False):
+        self.iface    = iface
+        self.passive  = passive
+        self._scanner = None
+        self._heard   = []
+
+    def start(self):
+        from bluepy.btle import Scanner
+        self._scanner = Scanner(self.iface).withDelegate(self)
+        self._scanner.clear()
+        self._scanner.start(passive=self.passive)
+
+    def poll(self, timeout):
+        self._heard = []
+        self._scanner.process(timeout)
+        return self._heard
+
+    def stop(self):
+        if self._scanner is not None:
+            self._scanner.stop()
+            self._scanner = None
+
+    # bluepy delegate interface, called for every advertisement
+    def handleDiscovery(self, scanEntry, isNewDev, isNewData):
+        self._heard.append((scanEntry.addr.upper(), scanEntry.getValueText(COMPLETE_LOCAL_NAME), scanEntry.rssi))
+
+class Sighting():
+    """ A scooter in range. rssi is smoothed, timestamps use the monotonic clock. """
+    __slots__ = ('mac_address', 'name', 'rssi', 'first_seen', 'last_seen', 'advertisements')
+
+    def __init__(self, mac_address, name, rssi, now):
+        self.mac_address    = mac_address
+        self.name           = name
+        self.rssi           = float(rssi)
+        self.first_seen     = now
+        self.last_seen      = now
+        self.advertisements = 1
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return 'Sighting({}, {!r}, rssi={:.1f})'.format(self.mac_address, self.name, self.rssi)
+
+class Discovery():
+    """ Index of the scooters in range, kept up to date by a background scan.
+
+    scanner:       scanning backend, a BluepyScanner on iface by default
+    name_prefix:   advertised name of the devices to index
+    known:         MAC addresses to index regardless of their name, e.g. a fleet's,
+                   if given only these are indexed
+    expiry:        seconds without an advertisement after which a scooter has left
+    rssi_alpha:    weight of a new RSSI reading in the moving average
+    poll_interval: seconds of advertisements processed at once
+    on_appear:     called with the Sighting of a scooter coming into range
+    on_leave:      called with the last Sighting of a scooter that left
+    """
+
+    def __init__(self, scanner=None, iface=0, name_prefix=SCOOTER_NAME_PREFIX, known=None, expiry=30.0,
+                 rssi_alpha=0.3, poll_interval=1.0, on_appear=None, on_leave=None):
+        self.scanner       = scanner if scanner is not None else BluepyScanner(iface)
+        self.name_prefix   = name_prefix
+        self.known         = set(mac.upper() for mac in known) if known is not None else None
+        self.expiry        = expiry
+        self.rssi_alpha    = rssi_alpha
+        self.poll_interval = poll_interval
+
+        self.advertisements = 0
+
+        self._index     = {}  # mac address -> Sighting
+        self._listeners = []  # (on_appear, on_leave)
+        self._lock      = threading.Lock()
+        self._thread    = None
+        self._stopping  = threading.Event()
+        if on_appear is not None or on_leave is not None:
+            self.add_listener(on_appear, on_leave)
+
+    def add_listener(self, on_appear=None, on_leave=None):
+        """ Calls on_appear(sighting) and on_leave(sighting) from the scanning thread. """
+        self._listeners.append((on_appear, on_leave))
+
+    def in_range(self, mac_address):
+        return mac_address.upper() in self._index
+
+    def get(self, mac_address):
+        """ Returns the Sighting of a scooter in range, None if it is not. """
+        return self._index.get(mac_address.upper())
+
+    def scooters(self):
+        """ Returns the Sightings of the scooters in range, strongest signal first. """
+        with self._lock:
+            sightings = list(self._index.values())
+        return sorted(sightings, key=lambda s: s.rssi, reverse=True)
+
+    def poll(self, timeout=None):
+        """ Processes one batch of advertisements and expires scooters that left.
+        Called by the background thread, or directly to scan without one. """
+        heard = self.scanner.poll(self.poll_interval if timeout is None else timeout)
+        now = _clock()
+        index = self._index
+        alpha = self.rssi_alpha
+        appeared = []
+
+        for mac_address, name, rssi in heard:
+            self.advertisements += 1
+            sighting = index.get(mac_address)
+            if sighting is not None:
+                # most advertisements repeat a scooter already indexed
+                sighting.rssi += alpha * (rssi - sighting.rssi)
+                sighting.last_seen = now
+                sighting.advertisements += 1
+                continue
+
+            if self.known is not None:
+                if mac_address not in self.known:
+                    continue
+            elif not name or not name.startswith(self.name_prefix):
+                continue
+            sighting = Sighting(mac_address, name, rssi, now)
+            with self._lock:
+                index[mac_address] = sighting
+            appeared.append(sighting)
+
+        left = []
+        deadline = now - self.expiry
+        for mac_address, sighting in list(index.items()):
+            if sighting.last_seen < deadline:
+                with self._lock:
+                    del index[mac_address]
+                left.append(sighting)
+
+        for sighting in appeared:
+            log.info('Scooter {} in range, rssi {}'.format(sighting.mac_address, sighting.rssi))
+            self._notify(0, sighting)
+        for sighting in left:
+            log.info('Scooter {} out of range'.format(sighting.mac_address))
+            self._notify(1, sighting)
+
+    def _notify(self, event, sighting):
+        for listener in self._listeners:
+            callback = listener[event]
+            if callback is None:
+                continue
+            try:
+                callback(sighting)
+            except Exception:
+                log.exception('Discovery listener failed for {}'.format(sighting.mac_address))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self.scanner.start()
+        self._thread = threading.Thread(target=self._run, name='m365-discovery')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self, duration=None):
+        """ Scans for duration seconds, or until stopped if None. """
+        self.start()
+        try:
+            self._stopping.wait(duration)
+        finally:
+            self.stop()
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                try:
+                    self.poll()
+                except Exception:
+                    log.exception('Scanning failed')
+                    self._stopping.wait(self.poll_interval)
+        finally:
+            self.scanner.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
@@ -0,0 +1,277 @@
+""" Concurrent polling of many scooters spread over several HCI adapters. """
+
+import heapq
+import itertools
+import logging
+import threading
+
+from . import m365message
+from .m365message import _clock
+from .m365py import M365
+from .m365metrics import prometheus_text
+
+log = logging.getLogger('m365py')
+
+DEFAULT_MESSAGES = [
+    m365message.motor_info,
+    m365message.battery_info,
+    m365message.trip_info,
+]
+
+class ScooterStats():
+    __slots__ = ('adapter', 'polls', 'failures', 'consecutive_failures', 'connects', 'last_poll', 'last_error')
+
+    def __init__(self):
+        self.adapter    = None
+        self.polls      = 0
+        self.failures   = 0
+        self.consecutive_failures = 0
+        self.connects   = 0
+        self.last_poll  = None
+        self.last_error = None
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+class Fleet():
+    """ Polls a fleet of scooters with a pool of worker threads.
+
+    Every interval seconds each scooter is connected through the least loaded
+    adapter with a free connection slot, sent messages and given
+    response_timeout seconds to answer. When all scooters fit within the
+    adapters' connection limits the connections are kept open between polls,
+    otherwise scooters take turns and are disconnected after each poll. Forcing
+    keep_connected beyond those limits raises a ValueError. Scooters
+    that keep failing are polled less often, following their M365.reconnect_policy.
+
+    callback(mac_address, message, result) receives every decoded message of
+    every scooter. Calls are serialized, but made from the worker threads.
+
+    With a m365discovery.Discovery only scooters in range are connected to,
+    scooters coming into range are polled right away.
+    """
+
+    def __init__(self, mac_addresses, callback=None, messages=None, interval=5.0, adapters=(0,),
+                 connections_per_adapter=5, workers=None, keep_connected=None, response_timeout=5.0,
+                 peripheral_factory=None, discovery=None, **m365_kwargs):
+        self.mac_addresses    = list(mac_addresses)
+        self.messages         = list(messages) if messages is not None else list(DEFAULT_MESSAGES)
+        self.interval         = interval
+        self.adapters         = list(adapters)
+        self.response_timeout = response_timeout
+        self.connections_per_adapter = connections_per_adapter
+
+        capacity = len(self.adapters) * connections_per_adapter
+        self.workers = workers or max(1, min(capacity, len(self.mac_addresses)))
+        if keep_connected is None:
+            keep_connected = len(self.mac_addresses) <= capacity
+        elif keep_connected and len(self.mac_addresses) > capacity:
+            # scooters without a connection slot would never be polled
+            raise ValueError('keep_connected needs a connection for each of the {} scooters, the adapters have {}'
+                             .format(len(self.mac_addresses), capacity))
+        self.keep_connected = keep_connected
+
+        self._callback      = callback
+        self._callback_lock = threading.Lock()
+
+        self.discovery = discovery
+        if discovery is not None:
+            discovery.add_listener(on_appear=self._on_appear)
+
+        # a fleet retries on its own schedule instead of blocking a worker on reconnects
+        m365_kwargs.setdefault('auto_reconnect', False)
+        self._scooters = {}
+        self._stats    = {}
+        for mac_address in self.mac_addresses:
+            peripheral = peripheral_factory(mac_address) if peripheral_factory else None
+            self._scooters[mac_address] = M365(mac_address, self._on_message, peripheral=peripheral, **m365_kwargs)
+            self._stats[mac_address] = ScooterStats()
+
+        self._condition    = threading.Condition()
+        self._adapter_load = dict((adapter, 0) for adapter in self.adapters)
+        self._connected    = {}  # mac address -> adapter
+        self._schedule     = []  # heap of (due time, sequence, mac address)
+        self._sequence     = itertools.count()
+        self._threads      = []
+        self._stopping     = False
+
+    @classmethod
+    def simulated(cls, count, latency=0.0, simulator=None, **kwargs):
+        """ Fleet of count simulated scooters for load testing without hardware.
+
+        simulator is a dict of extra SimulatedPeripheral arguments, e.g. fault rates.
+        """
+        from .m365sim import SimulatedPeripheral, simulated_mac_addresses
+        simulator = dict(simulator or {}, latency=latency)
+        return cls(simulated_mac_addresses(count),
+                   peripheral_factory=lambda mac_address: SimulatedPeripheral(**simulator),
+                   **kwargs)
+
+    def scooter(self, mac_address):
+        return self._scooters[mac_address]
+
+    def set_publisher(self, publisher):
+        """ Publishes every scooter's responses, see M365.set_publisher(). """
+        for scooter in self._scooters.values():
+            scooter.set_publisher(publisher)
+
+    def add_sink(self, sink):
+        """ Writes every scooter's responses to sink, see M365.add_sink(). """
+        for scooter in self._scooters.values():
+            scooter.add_sink(sink)
+
+    def remove_sink(self, sink):
+        for scooter in self._scooters.values():
+            scooter.remove_sink(sink)
+
+    def stats(self):
+        """ Returns dict of mac address -> dict of poll statistics. """
+        with self._condition:
+            return dict((mac, stats.to_dict()) for mac, stats in self._stats.items())
+
+    def prometheus(self):
+        """ Returns every scooter's metrics in Prometheus text format, labelled by MAC address. """
+        return prometheus_text(({'mac': mac}, scooter.metrics) for mac, scooter in sorted(self._scooters.items()))
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping = False
+        now = _clock()
+        with self._condition:
+            self._schedule = []
+            for i, mac_address in enumerate(self.mac_addresses):
+                # spread the first polls over one interval
+                due = now + self.interval * i / max(len(self.mac_addresses), 1)
+                heapq.heappush(self._schedule, (due, next(self._sequence), mac_address))
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='m365-fleet-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        for mac_address in list(self._connected):
+            self._disconnect(mac_address)
+
+    def run(self, duration):
+        """ Polls the fleet for duration seconds. """
+        self.start()
+        try:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopping, duration)
+        finally:
+            self.stop()
+
+    def _on_message(self, m365, message, result):
+        if self._callback:
+            with self._callback_lock:
+                self._callback(m365.mac_address, message, result)
+
+    def _on_appear(self, sighting):
+        # poll a scooter coming into range now instead of at its next due time
+        mac_address = next((mac for mac in self._scooters if mac.upper() == sighting.mac_address), None)
+        if mac_address is None:
+            return
+        with self._condition:
+            now = _clock()
+            self._schedule = [(min(due, now), sequence, mac) if mac == mac_address else (due, sequence, mac)
+                              for due, sequence, mac in self._schedule]
+            heapq.heapify(self._schedule)
+            self._condition.notify()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    now = _clock()
+                    if self._schedule and self._schedule[0][0] <= now:
+                        break
+                    timeout = self._schedule[0][0] - now if self._schedule else None
+                    self._condition.wait(timeout)
+                if self._stopping:
+                    return
+                due, _, mac_address = heapq.heappop(self._schedule)
+
+            try:
+                if self.discovery is None or self.discovery.in_range(mac_address):
+                    self._poll(mac_address)
+                elif mac_address in self._connected:
+                    self._disconnect(mac_address)
+            finally:
+                with self._condition:
+                    # skip polls that were missed instead of bursting to catch up
+                    now = _clock()
+                    due = max(due + self.interval, now)
+                    # back off from scooters that keep failing, e.g. out of range
+                    failures = self._stats[mac_address].consecutive_failures
+                    if failures:
+                        due = max(due, now + self._scooters[mac_address].reconnect_policy.delay(failures))
+                    heapq.heappush(self._schedule, (due, next(self._sequence), mac_address))
+                    self._condition.notify()
+
+    def _acquire_adapter(self):
+        """ Waits for a free connection slot, returns None if the fleet is stopping. """
+        with self._condition:
+            while not self._stopping:
+                adapter = min(self.adapters, key=lambda a: self._adapter_load[a])
+                if self._adapter_load[adapter] < self.connections_per_adapter:
+                    self._adapter_load[adapter] += 1
+                    return adapter
+                self._condition.wait()
+            return None
+
+    def _release_adapter(self, adapter):
+        with self._condition:
+            self._adapter_load[adapter] -= 1
+            self._condition.notify_all()
+
+    def _disconnect(self, mac_address):
+        adapter = self._connected.pop(mac_address, None)
+        try:
+            self._scooters[mac_address].disconnect()
+        except Exception as e:
+            log.debug('Disconnecting {} failed: {}'.format(mac_address, e))
+        if adapter is not None:
+            self._release_adapter(adapter)
+
+    def _poll(self, mac_address):
+        scooter = self._scooters[mac_address]
+        stats   = self._stats[mac_address]
+
+        try:
+            if mac_address not in self._connected:
+                adapter = self._acquire_adapter()
+                if adapter is None:
+                    return
+                self._connected[mac_address] = adapter
+                stats.adapter = adapter
+                scooter.iface = adapter
+                scooter.connect()
+                stats.connects += 1
+
+            pending = [scooter.request(message, self.response_timeout) for message in self.messages]
+            for request in pending:
+                request.result()
+
+        except Exception as e:
+            log.warning('Polling {} failed: {}'.format(mac_address, e))
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            stats.last_error = str(e)
+            self._disconnect(mac_address)
+            return
+
+        stats.polls += 1
+        stats.consecutive_failures = 0
+        stats.last_poll = _clock()
+        if not self.keep_connected:
+            self._disconnect(mac_address)
@@ -1,10 +1,33 @@
 import binascii
+import collections
 import struct
+import sys
+import time
+import logging
+
+log = logging.getLogger('m365py')
+# handlers are left to the application
+log.addHandler(logging.NullHandler())
 
 def phex(s):
     return binascii.hexlify(s)
 
 HEADER = 0xAA55
+HEADER_BYTES = struct.pack('<H', HEADER)
+
+# frame = header(2) + length(1) + direction, read_write, attribute(3) + payload + checksum(2)
+# where length = len(payload) + 2
+FRAME_OVERHEAD = 6
+
+_frame_header   = struct.Struct('<HBBBB')
+_frame_checksum = struct.Struct('<H')
+
+_clock = getattr(time, 'monotonic', time.time)
+
+def checksum(payload, direction, read_write, attribute):
+    """ Checksum of a frame, payload is an iterable of byte values. """
+    total = direction + read_write + attribute + len(payload) + 2 + sum(payload)
+    return (total ^ 0xffff) & 0xffff
 
 class Direction():
     MASTER_TO_MOTOR      = 0x20
@@ -12,6 +35,12 @@ class Direction():
     MOTOR_TO_MASTER      = 0x23
     BATTERY_TO_MASTER    = 0x25
 
+# direction a controller answers on for each request direction
+RESPONSE_DIRECTION = {
+    Direction.MASTER_TO_MOTOR:   Direction.MOTOR_TO_MASTER,
+    Direction.MASTER_TO_BATTERY: Direction.BATTERY_TO_MASTER,
+}
+
 class ReadWrite():
     READ  = 0x01
     WRITE = 0x03
@@ -72,27 +101,7 @@ class Message:
         return self
 
     def _calc_checksum(self):
-        checksum = 0
-        checksum += self.direction
-        checksum += self.read_write
-        checksum += self.attribute
-
-        # NOTE: python2x and python3x does not have compliant byte literals
-        try:
-            # python 2.7
-            for byte in self.payload:
-                byte_val = struct.unpack('>B', byte)[0]
-                checksum += byte_val
-        except:
-            # python 3.x
-            for byte_val in self.payload:
-                checksum += byte_val
-
-        checksum += len(self.payload) + 2
-        checksum ^= 0xffff
-        checksum &= 0xffff
-
-        self._checksum = checksum
+        self._checksum = checksum(bytearray(self.payload), self.direction, self.read_write, self.attribute)
 
     def build(self):
         self._calc_checksum()
@@ -113,179 +122,213 @@ class Message:
 
     @staticmethod
     def parse_from_bytes(message):
-        message_length = len(message)
-        payload_start = 6
-        header, length, direction, read_write, attribute = struct.unpack('<HBBBB', message[:payload_start])
-        payload_end = payload_start + length - 2
-
-        if header != HEADER:              return ParseStatus.INVALID_HEADER , None
-        if payload_end > message_length:  return ParseStatus.DISJOINTED     , None
+        """ Parses and validates a frame without copying it.
+
+        Returns parse status and a Frame whose payload is a view into message.
+        """
+        view = memoryview(message)
+        message_length = len(view)
+        if message_length < FRAME_OVERHEAD:
+            if HEADER_BYTES.startswith(view[:2].tobytes()):
+                return ParseStatus.DISJOINTED, None
+            return ParseStatus.INVALID_HEADER, None
+
+        header, length, direction, read_write, attribute = _frame_header.unpack_from(view)
+        if header != HEADER:             return ParseStatus.INVALID_HEADER , None
+
+        payload_end = FRAME_OVERHEAD + length - 2
+        if payload_end + 2 > message_length: return ParseStatus.DISJOINTED , None
+
+        # length byte, direction, read_write, attribute and payload are summed
+        expected, = _frame_checksum.unpack_from(view, payload_end)
+        if (sum(view[2:payload_end]) ^ 0xffff) & 0xffff != expected:
+            return ParseStatus.INVALID_CHECKSUM, None
 
-        payload    = message[payload_start:payload_end]
+        frame = Frame(direction, read_write, attribute,
+                      view[FRAME_OVERHEAD:payload_end], view[:payload_end + 2])
+        return ParseStatus.OK, frame
 
-        result = Message()              \
-            .set_direction(direction)   \
-            .set_read_write(read_write) \
-            .set_attribute(attribute)   \
-            .set_payload(payload)       \
-            .build()
+class Frame():
+    """ A received frame.
 
-        if message[:-2] !=  result._raw_bytes[:-2]:
-            return ParseStatus.INVALID_CHECKSUM, None
-
-        return ParseStatus.OK, result
-
-battery_voltage = Message()                          \
-    .set_direction(Direction.MASTER_TO_BATTERY)      \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.BATTERY_VOLTAGE)        \
-    .set_payload(b'\x02')                            \
-    .build()
-
-battery_ampere = Message()                           \
-    .set_direction(Direction.MASTER_TO_BATTERY)      \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.BATTERY_CURRENT)        \
-    .set_payload(b'\x02')                            \
-    .build()
-
-battery_percentage = Message()                       \
-    .set_direction(Direction.MASTER_TO_BATTERY)      \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.BATTERY_PERCENT)        \
-    .set_payload(b'\x02')                            \
-    .build()
-
-battery_cell_voltages = Message()                    \
-    .set_direction(Direction.MASTER_TO_BATTERY)      \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.BATTERY_CELL_VOLTAGES)  \
-    .set_payload(b'\x1B')                            \
-    .build()
-
-trip_distance = Message()                            \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.TRIP_DISTANCE)          \
-    .set_payload(b'\x02')                            \
-    .build()
-
-distance_left = Message()                            \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.DISTANCE_LEFT)          \
-    .set_payload(b'\x02')                            \
-    .build()
-
-speed = Message()                                    \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.SPEED)                  \
-    .set_payload(b'\x02')                            \
-    .build()
-
-tail_light_status = Message()                        \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.TAIL_LIGHT)             \
-    .set_payload(b'\x02')                            \
-    .build()
-
-turn_on_tail_light = Message()                       \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.WRITE)                 \
-    .set_attribute(Attribute.TAIL_LIGHT)             \
-    .set_payload(b'\x02\x00')                        \
-    .build()
-
-turn_off_tail_light = Message()                      \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.WRITE)                 \
-    .set_attribute(Attribute.TAIL_LIGHT)             \
-    .set_payload(b'\x00\x00')                        \
-    .build()
-
-cruise_status = Message()                            \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.CRUISE)                 \
-    .set_payload(b'\x02')                            \
-    .build()
-
-turn_on_cruise = Message()                           \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.WRITE)                 \
-    .set_attribute(Attribute.CRUISE)                 \
-    .set_payload(b'\x01\x00')                        \
-    .build()
-
-turn_off_cruise = Message()                          \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.WRITE)                 \
-    .set_attribute(Attribute.CRUISE)                 \
-    .set_payload(b'\x00\x00')                        \
-    .build()
-
-turn_on_lock = Message()                             \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.WRITE)                 \
-    .set_attribute(Attribute.SET_LOCK)               \
-    .set_payload(b'\x01\x00')                        \
-    .build()
-
-turn_off_lock = Message()                            \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.WRITE)                 \
-    .set_attribute(Attribute.UNSET_LOCK)             \
-    .set_payload(b'\x01\x00')                        \
-    .build()
-
-lock_status = Message()                              \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.GET_LOCK)               \
-    .set_payload(b'\x02')                            \
-    .build()
-
-general_info = Message()                             \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.GENERAL_INFO)           \
-    .set_payload(b'\x16')                            \
-    .build()
-
-general_info_extended = Message()                    \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.GENERAL_INFO)           \
-    .set_payload(b'\x22')                            \
-    .build()
-
-trip_info = Message()                                \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.TRIP_INFO)              \
-    .set_payload(b'\x0A')                            \
-    .build()
-
-motor_info = Message()                               \
-    .set_direction(Direction.MASTER_TO_MOTOR)        \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.MOTOR_INFO)             \
-    .set_payload(b'\x20')                            \
-    .build()
-
-battery_info = Message()                             \
-    .set_direction(Direction.MASTER_TO_BATTERY)      \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.BATTERY_INFO)           \
-    .set_payload(b'\x0A')                            \
-    .build()
-
-supplementary = Message()                            \
-    .set_direction(Direction.MASTER_TO_BATTERY)      \
-    .set_read_write(ReadWrite.READ)                  \
-    .set_attribute(Attribute.SUPPLEMENTARY)          \
-    .set_payload(b'\x06')                            \
-    .build()
+    payload and raw are memoryviews into the received bytes, use bytes(frame.payload)
+    where an owned copy is needed.
+    """
+    __slots__ = ('direction', 'read_write', 'attribute', 'payload', 'raw')
 
+    def __init__(self, direction, read_write, attribute, payload, raw):
+        self.direction  = direction
+        self.read_write = read_write
+        self.attribute  = attribute
+        self.payload    = payload
+        self.raw        = raw
+
+    def __repr__(self):
+        return 'Frame(direction={:#04x}, read_write={:#04x}, attribute={:#04x}, payload={})'.format(
+            self.direction, self.read_write, self.attribute, phex(self.payload))
+
+class FrameReassembler():
+    """ Incrementally reassembles frames from a fragmented byte stream.
+
+    Bytes are appended to a bounded buffer which is scanned for the frame header.
+    Complete frames are parsed and returned as soon as their last byte arrives.
+    Garbage and frames with invalid checksums are skipped by resuming the scan one
+    byte past the rejected header.
+
+    max_buffer_size:  bytes kept while waiting for the rest of a frame
+    max_fragment_age: seconds an incomplete frame is kept before it is dropped,
+                      None keeps it until it is completed or overwritten
+    """
+
+    def __init__(self, max_buffer_size=512, max_fragment_age=2.0):
+        self.max_buffer_size  = max_buffer_size
+        self.max_fragment_age = max_fragment_age
+
+        self.discarded_bytes   = 0
+        self.invalid_checksums = 0
+        self.stale_fragments   = 0
+
+        self._buffer    = bytearray()
+        self._last_feed = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def reset(self):
+        self.discarded_bytes += len(self._buffer)
+        del self._buffer[:]
+
+    def feed(self, data, now=None):
+        """ Appends data to the stream and returns list of completed messages. """
+        if now is None:
+            now = _clock()
+
+        buf = self._buffer
+        if buf and self.max_fragment_age is not None \
+                and now - self._last_feed > self.max_fragment_age:
+            self.stale_fragments += 1
+            self.reset()
+        self._last_feed = now
+
+        # Frames are parsed in place from an immutable bytes object so that the
+        # returned messages can keep views into it. Only when a fragment is
+        # pending do we pay for joining it with the new data.
+        if buf:
+            buf.extend(data)
+            stream = bytes(buf)
+            del buf[:]
+        else:
+            stream = bytes(data)
+        view = memoryview(stream)
+        stream_length = len(stream)
+
+        messages = []
+        pos = 0
+        while True:
+            start = stream.find(HEADER_BYTES, pos)
+            if start < 0:
+                # a trailing header byte could be the start of the next frame,
+                # unless it already belongs to a frame parsed above
+                keep = 1 if pos < stream_length and stream[-1:] == HEADER_BYTES[:1] else 0
+                self.discarded_bytes += stream_length - keep - pos
+                pos = stream_length - keep
+                break
+
+            self.discarded_bytes += start - pos
+            pos = start
+            if stream_length - start < 3:
+                break  # length byte has not arrived yet
+
+            length = view[start + 2]
+            if length < 2:
+                pos = start + 1
+                continue
+
+            frame_end = start + length + FRAME_OVERHEAD
+            if frame_end > stream_length:
+                break  # wait for the rest of the frame
+
+            parse_status, message = Message.parse_from_bytes(view[start:frame_end])
+            if parse_status == ParseStatus.OK:
+                messages.append(message)
+                pos = frame_end
+            else:
+                log.warning('Received packet with invalid checksum')
+                self.invalid_checksums += 1
+                pos = start + 1
+
+        buf.extend(view[pos:])
+
+        overflow = len(buf) - self.max_buffer_size
+        if overflow > 0:
+            self.discarded_bytes += overflow
+            del buf[:overflow]
+
+        return messages
+
+def predefined_messages():
+    """ Returns dict of name -> predefined message of this module. """
+    module = globals()
+    return dict((name, module[name] if name in module else _build_predefined(name)) for name in _PREDEFINED)
+
+def read_registers(direction, start, length):
+    """ Builds a request reading length bytes of registers, starting at register start.
+
+    Registers are 16-bit words addressed by attribute, so a read of 0x0A bytes at
+    0x31 covers registers 0x31 to 0x35.
+    """
+    return Message()                        \
+        .set_direction(direction)           \
+        .set_read_write(ReadWrite.READ)     \
+        .set_attribute(start)               \
+        .set_payload(struct.pack('<B', length)) \
+        .build()
+
+# name -> (direction, read_write, attribute, payload) of the predefined messages,
+# each is built into a Message and kept as a module attribute on first access
+_PREDEFINED = collections.OrderedDict([
+    ('battery_voltage',       (Direction.MASTER_TO_BATTERY,  ReadWrite.READ,  Attribute.BATTERY_VOLTAGE,            b'\x02')),
+    ('battery_ampere',        (Direction.MASTER_TO_BATTERY,  ReadWrite.READ,  Attribute.BATTERY_CURRENT,            b'\x02')),
+    ('battery_percentage',    (Direction.MASTER_TO_BATTERY,  ReadWrite.READ,  Attribute.BATTERY_PERCENT,            b'\x02')),
+    ('battery_cell_voltages', (Direction.MASTER_TO_BATTERY,  ReadWrite.READ,  Attribute.BATTERY_CELL_VOLTAGES,      b'\x1B')),
+    ('trip_distance',         (Direction.MASTER_TO_MOTOR,    ReadWrite.READ,  Attribute.TRIP_DISTANCE,              b'\x02')),
+    ('distance_left',         (Direction.MASTER_TO_MOTOR,    ReadWrite.READ,  Attribute.DISTANCE_LEFT,              b'\x02')),
+    ('speed',                 (Direction.MASTER_TO_MOTOR,    ReadWrite.READ,  Attribute.SPEED,                      b'\x02')),
+    ('tail_light_status',     (Direction.MASTER_TO_MOTOR,    ReadWrite.READ,  Attribute.TAIL_LIGHT,                 b'\x02')),
+    ('turn_on_tail_light',    (Direction.MASTER_TO_MOTOR,    ReadWrite.WRITE, Attribute.TAIL_LIGHT,                 b'\x02\x00')),
+    ('turn_off_tail_light',   (Direction.MASTER_TO_MOTOR,    ReadWrite.WRITE, Attribute.TAIL_LIGHT,                 b'\x00\x00')),
+    ('cruise_status',         (Direction.MASTER_TO_MOTOR,    ReadWrite.READ,  Attribute.CRUISE,                     b'\x02')),
+    ('turn_on_cruise',        (Direction.MASTER_TO_MOTOR,    ReadWrite.WRITE, Attribute.CRUISE,                     b'\x01\x00')),
+    ('turn_off_cruise',       (Direction.MASTER_TO_MOTOR,    ReadWrite.WRITE, Attribute.CRUISE,                     b'\x00\x00')),
+    ('turn_on_lock',          (Direction.MASTER_TO_MOTOR,    ReadWrite.WRITE, Attribute.SET_LOCK,                   b'\x01\x00')),
+    ('turn_off_lock',         (Direction.MASTER_TO_MOTOR,    ReadWrite.WRITE, Attribute.UNSET_LOCK,                 b'\x01\x00')),
+    ('lock_status',           (Direction.MASTER_TO_MOTOR,    ReadWrite.READ,  Attribute.GET_LOCK,                   b'\x02')),
+    ('general_info',          (Direction.MASTER_TO_MOTOR,    ReadWrite.READ,  Attribute.GENERAL_INFO,               b'\x16')),
+    ('general_info_extended', (Direction.MASTER_TO_MOTOR,    ReadWrite.READ,  Attribute.GENERAL_INFO,               b'\x22')),
+    ('trip_info',             (Direction.MASTER_TO_MOTOR,    ReadWrite.READ,  Attribute.TRIP_INFO,                  b'\x0A')),
+    ('motor_info',            (Direction.MASTER_TO_MOTOR,    ReadWrite.READ,  Attribute.MOTOR_INFO,                 b'\x20')),
+    ('battery_info',          (Direction.MASTER_TO_BATTERY,  ReadWrite.READ,  Attribute.BATTERY_INFO,               b'\x0A')),
+    ('supplementary',         (Direction.MASTER_TO_BATTERY,  ReadWrite.READ,  Attribute.SUPPLEMENTARY,              b'\x06')),
+])
+
+def _build_predefined(name):
+    direction, read_write, attribute, payload = _PREDEFINED[name]
+    message = Message()                     \
+        .set_direction(direction)           \
+        .set_read_write(read_write)         \
+        .set_attribute(attribute)           \
+        .set_payload(payload)               \
+        .build()
+    # kept as a module attribute so later lookups no longer reach __getattr__,
+    # setdefault keeps the first one if two threads race to build it
+    return globals().setdefault(name, message)
+
+def __getattr__(name):
+    if name in _PREDEFINED:
+        return _build_predefined(name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+if sys.version_info < (3, 7):
+    # no module __getattr__, build them up front
+    for _name in _PREDEFINED:
+        _build_predefined(_name)
@@ -0,0 +1,178 @@
+""" Counters and latency histograms of an M365 connection.
+
+Updating a metric is a few integer additions, nothing is formatted until a
+snapshot or the Prometheus text is asked for.
+"""
+
+from bisect import bisect_left
+
+# seconds, upper bounds of the histogram buckets
+LATENCY_BUCKETS  = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CALLBACK_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+class Histogram():
+    """ Counts of observed values per bucket, like a Prometheus histogram. """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts  = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def cumulative(self):
+        """ Returns list of (upper bound, observations <= bound), ending with +Inf. """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def snapshot(self):
+        return {
+            'count':   self.count,
+            'sum':     self.sum,
+            'mean':    self.sum / self.count if self.count else None,
+            'buckets': self.cumulative(),
+        }
+
+class Metrics():
+    """ Instrumentation of one M365, available as m365.metrics.
+
+    frames_received:    frames that passed the checksum
+    bytes_received:     raw bytes of all notifications
+    reassembly_hits:    notifications that completed at least one frame
+    reassembly_misses:  notifications that only added to a partial frame
+    unhandled:          (direction, attribute) -> frames without a decoder
+    requests_sent:      requests written to the transport
+    timeouts:           attribute -> requests that expired without a response
+    latency:            attribute -> Histogram of request to response seconds
+    callback_seconds:   Histogram of time spent in the user callback
+    reconnects:         reconnects after a link failure
+    connect_failures:   failed connection attempts
+
+    Checksum failures, discarded bytes and stale fragments are counted by the
+    reassembler, see snapshot().
+    """
+
+    def __init__(self, reassembler=None):
+        self.reassembler = reassembler
+
+        self.frames_received   = 0
+        self.bytes_received    = 0
+        self.reassembly_hits   = 0
+        self.reassembly_misses = 0
+        self.unhandled         = {}
+        self.requests_sent     = 0
+        self.timeouts          = {}
+        self.latency           = {}
+        self.callback_seconds  = Histogram(CALLBACK_BUCKETS)
+        self.reconnects        = 0
+        self.connect_failures  = 0
+
+    def observe_latency(self, attribute, seconds):
+        histogram = self.latency.get(attribute)
+        if histogram is None:
+            histogram = self.latency[attribute] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+
+    def count_unhandled(self, direction, attribute):
+        key = (direction, attribute)
+        self.unhandled[key] = self.unhandled.get(key, 0) + 1
+
+    def count_timeout(self, attribute):
+        self.timeouts[attribute] = self.timeouts.get(attribute, 0) + 1
+
+    def snapshot(self):
+        """ Returns a dict of every metric, attributes are formatted like '0xb0'. """
+        reassembler = self.reassembler
+        counted = reassembler is not None  # an empty reassembler is falsy
+        return {
+            'frames_received':   self.frames_received,
+            'bytes_received':    self.bytes_received,
+            'checksum_failures': reassembler.invalid_checksums if counted else 0,
+            'discarded_bytes':   reassembler.discarded_bytes if counted else 0,
+            'stale_fragments':   reassembler.stale_fragments if counted else 0,
+            'reassembly_hits':   self.reassembly_hits,
+            'reassembly_misses': self.reassembly_misses,
+            'unhandled':         dict(('{:#04x}/{:#04x}'.format(*key), count) for key, count in self.unhandled.items()),
+            'requests_sent':     self.requests_sent,
+            'timeouts':          dict(('{:#04x}'.format(a), count) for a, count in self.timeouts.items()),
+            'latency':           dict(('{:#04x}'.format(a), h.snapshot()) for a, h in self.latency.items()),
+            'callback_seconds':  self.callback_seconds.snapshot(),
+            'reconnects':        self.reconnects,
+            'connect_failures':  self.connect_failures,
+        }
+
+    def prometheus(self, labels=None):
+        """ Returns the metrics in Prometheus text exposition format. """
+        return prometheus_text([(labels or {}, self)])
+
+# name, help, function of a snapshot returning list of (extra labels, value)
+_COUNTERS = [
+    ('frames_received_total',   'Frames received with a valid checksum',         lambda s: [({}, s['frames_received'])]),
+    ('bytes_received_total',    'Raw bytes received',                            lambda s: [({}, s['bytes_received'])]),
+    ('checksum_failures_total', 'Frames dropped for an invalid checksum',        lambda s: [({}, s['checksum_failures'])]),
+    ('discarded_bytes_total',   'Bytes dropped while looking for a frame',       lambda s: [({}, s['discarded_bytes'])]),
+    ('stale_fragments_total',   'Partial frames dropped for being too old',      lambda s: [({}, s['stale_fragments'])]),
+    ('reassembly_hits_total',   'Notifications completing at least one frame',   lambda s: [({}, s['reassembly_hits'])]),
+    ('reassembly_misses_total', 'Notifications only adding to a partial frame',  lambda s: [({}, s['reassembly_misses'])]),
+    ('unhandled_frames_total',  'Frames without a registered decoder',
+        lambda s: [(dict(zip(('direction', 'attribute'), key.split('/'))), v) for key, v in sorted(s['unhandled'].items())]),
+    ('requests_sent_total',     'Requests sent',                                 lambda s: [({}, s['requests_sent'])]),
+    ('request_timeouts_total',  'Requests that expired without a response',
+        lambda s: [({'attribute': a}, v) for a, v in sorted(s['timeouts'].items())]),
+    ('reconnects_total',        'Reconnects after a link failure',               lambda s: [({}, s['reconnects'])]),
+    ('connect_failures_total',  'Failed connection attempts',                    lambda s: [({}, s['connect_failures'])]),
+]
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+def _histogram_lines(name, labels, histogram):
+    lines = []
+    for bound, count in histogram['buckets']:
+        lines.append('{}_bucket{} {}'.format(name, _format_labels(dict(labels, le=_format_bound(bound))), count))
+    lines.append('{}_sum{} {!r}'.format(name, _format_labels(labels), histogram['sum']))
+    lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram['count']))
+    return lines
+
+def prometheus_text(items, prefix='m365_'):
+    """ Returns Prometheus text for an iterable of (labels, Metrics), e.g. one
+    per scooter labelled with its MAC address. """
+    snapshots = [(labels, metrics.snapshot()) for labels, metrics in items]
+
+    lines = []
+    for name, description, values in _COUNTERS:
+        lines.append('# HELP {}{} {}'.format(prefix, name, description))
+        lines.append('# TYPE {}{} counter'.format(prefix, name))
+        for labels, snapshot in snapshots:
+            for extra, value in values(snapshot):
+                lines.append('{}{}{} {}'.format(prefix, name, _format_labels(dict(labels, **extra)), value))
+
+    name = prefix + 'request_latency_seconds'
+    lines.append('# HELP {} Seconds from sending a request to receiving its response'.format(name))
+    lines.append('# TYPE {} histogram'.format(name))
+    for labels, snapshot in snapshots:
+        for attribute, histogram in sorted(snapshot['latency'].items()):
+            lines.extend(_histogram_lines(name, dict(labels, attribute=attribute), histogram))
+
+    name = prefix + 'callback_seconds'
+    lines.append('# HELP {} Seconds spent in the user callback'.format(name))
+    lines.append('# TYPE {} histogram'.format(name))
+    for labels, snapshot in snapshots:
+        lines.extend(_histogram_lines(name, labels, snapshot['callback_seconds']))
+
+    return '\n'.join(lines) + '\n'
@@ -1,234 +1,409 @@
 from .m365message import *
+from .m365message import _clock
+from .m365decoder import Decoder, Field, Record, register_decoder, unregister_decoder, get_decoder, registry_revision
+from .m365shadow import RegisterShadow
+from .m365metrics import Metrics
+from . import m365message, m365transport
+from .m365transport import BluepyTransport
 
-from collections import namedtuple
+from collections import deque
 
-import struct
 import time
-import json
+import random
 import logging
-
-from bluepy.btle import Peripheral, Characteristic, UUID, DefaultDelegate, ADDR_TYPE_RANDOM
+import threading
 
 log = logging.getLogger('m365py')
 
+def __getattr__(name):
+    # predefined messages are built on first access, see m365message
+    return getattr(m365message, name)
+
 class KersMode():
     WEAK   = 0x00
     MEDIUM = 0x01
     STRONG = 0x02
 
-class M365Delegate(DefaultDelegate):
-    def __init__(self, m365):
-        DefaultDelegate.__init__(self)
+class RequestTimeoutError(Exception):
+    pass
+
+class ReconnectPolicy():
+    """ Jittered exponential backoff between connection attempts.
+
+    initial_delay: seconds before the first retry
+    max_delay:     longest delay between attempts
+    multiplier:    growth of the delay per failed attempt
+    jitter:        fraction of each delay that is randomized, so scooters failing
+                   together do not retry in lockstep
+    max_attempts:  attempts before giving up, None never gives up
+    max_duration:  seconds of retrying before giving up, None never gives up
+    """
+
+    def __init__(self, initial_delay=0.5, max_delay=30.0, multiplier=2.0, jitter=0.5,
+                 max_attempts=None, max_duration=None):
+        self.initial_delay = initial_delay
+        self.max_delay     = max_delay
+        self.multiplier    = multiplier
+        self.jitter        = jitter
+        self.max_attempts  = max_attempts
+        self.max_duration  = max_duration
+
+    def delay(self, failures):
+        """ Seconds to wait after failures consecutive failed attempts. """
+        delay = min(self.initial_delay * self.multiplier ** max(failures - 1, 0), self.max_delay)
+        return delay * (1.0 - self.jitter * random.random())
+
+    def give_up(self, failures, elapsed):
+        if self.max_attempts is not None and failures >= self.max_attempts:
+            return True
+        return self.max_duration is not None and elapsed >= self.max_duration
+
+class PendingRequest():
+    """ Handle for a sent request, resolved when the matching response is decoded.
+
+    Responses are matched on (response direction, attribute). Requests that
+    expect no response, e.g. writes, are resolved as soon as they are sent.
+    """
+
+    # longest time spent in a single waitForNotifications call while waiting
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, m365, message, timeout):
+        self.message  = message
+        self.frame    = None
+        self.sent_at  = None
+        self.deadline = None
+        self.timeout  = timeout
+
+        response_direction = RESPONSE_DIRECTION.get(message.direction)
+        if message.read_write == ReadWrite.READ and response_direction is not None:
+            self.key = (response_direction, message.attribute)
+        else:
+            self.key = None
+
+        self._m365   = m365
+        self._resolved_at = None
+        self._result = None
+        self._error  = None
+        self._event  = threading.Event()
+        self._done_callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def add_done_callback(self, fn):
+        """ Calls fn(pending) once resolved, on the thread processing notifications. """
+        if self._event.is_set():
+            fn(self)
+        else:
+            self._done_callbacks.append(fn)
+
+    @property
+    def latency(self):
+        """ Seconds between sending the request and receiving the response. """
+        if self.frame is None or self.sent_at is None:
+            return None
+        return self._resolved_at - self.sent_at
+
+    def result(self, timeout=None):
+        """ Waits for the response and returns the decoded dict.
+
+        Notifications are processed while waiting unless another thread is
+        already doing so. Raises RequestTimeoutError if the request expired or
+        timeout seconds passed, whichever comes first.
+        """
+        wait_until = None if timeout is None else _clock() + timeout
+        while not self._event.is_set():
+            now = _clock()
+            self._m365._expire_requests(now)
+            if self._event.is_set():
+                break
+
+            remaining = self.POLL_INTERVAL
+            if wait_until is not None:
+                if now >= wait_until:
+                    raise RequestTimeoutError('No response to attribute {:#04x} within {}s'.format(
+                        self.message.attribute, timeout))
+                remaining = min(remaining, wait_until - now)
+
+            if not self._m365._pump(remaining):
+                self._event.wait(remaining)
+
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _set_sent(self, now):
+        self.sent_at = now
+        if self.timeout is not None:
+            self.deadline = now + self.timeout
+
+    def _resolve(self, frame, result, now=None):
+        self.frame = frame
+        self._resolved_at = _clock() if now is None else now
+        self._result = result
+        self._event.set()
+        self._run_done_callbacks()
+
+    def _fail(self, error):
+        self._error = error
+        self._event.set()
+        self._run_done_callbacks()
+
+    def _follow(self, request):
+        # resolves a placeholder shared by get() callers like the request sent for it
+        if request._error is not None:
+            self._fail(request._error)
+        else:
+            self._resolve(request.frame, request._result, request._resolved_at)
+
+    def _run_done_callbacks(self):
+        callbacks, self._done_callbacks = self._done_callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+class Subscription():
+    """ Calls callback(m365, field, value, previous) when a field changes.
+
+    Numbers must move more than deadband from the last value passed to the
+    callback, so slow drifts are reported once they add up. Other values,
+    including booleans, are reported on any change. The first value is
+    always reported, with previous None.
+    """
+
+    def __init__(self, m365, field, callback, deadband=0.0):
+        self.field    = field
+        self.callback = callback
+        self.deadband = deadband
+        self.value    = None  # last value passed to the callback
+
+        self._m365    = m365
+        self._notified = False
+
+    def cancel(self):
+        self._m365.unsubscribe(self)
+
+    def _changed(self, value):
+        if not self._notified:
+            return True
+        last = self.value
+        if isinstance(value, bool) or not isinstance(value, (int, float, list)):
+            return value != last
+        if isinstance(value, list):
+            return len(value) != len(last) or any(abs(a - b) > self.deadband for a, b in zip(value, last))
+        return abs(value - last) > self.deadband
+
+    def _update(self, value):
+        if self._changed(value):
+            previous, self.value, self._notified = self.value, value, True
+            self.callback(self._m365, self.field, value, previous)
+
+_field_messages = {}
+_field_messages_revision = None
+
+def message_for_field(name):
+    """ Returns the predefined read message with the shortest response that contains field name. """
+    global _field_messages, _field_messages_revision
+    if _field_messages_revision != registry_revision():
+        field_messages = {}
+        for message in predefined_messages().values():
+            if message.read_write != ReadWrite.READ or message.direction not in RESPONSE_DIRECTION:
+                continue
+            decoder = get_decoder(RESPONSE_DIRECTION[message.direction], message.attribute)
+            if decoder is None or decoder.size != bytearray(message.payload)[0]:
+                continue
+            for field in decoder.names:
+                best = field_messages.get(field)
+                if best is None or decoder.size < get_decoder(RESPONSE_DIRECTION[best.direction], best.attribute).size:
+                    field_messages[field] = message
+        _field_messages = field_messages
+        _field_messages_revision = registry_revision()
+
+    message = _field_messages.get(name)
+    if message is None:
+        raise KeyError('No predefined message reads {}'.format(name))
+    return message
+
+class M365Delegate():
+    def __init__(self, m365, reassembler=None):
         self._m365 = m365
-        self._disjointed_messages = []
-
-    @staticmethod
-    def unpack_to_dict(fields, unpacked_tuple):
-        result = namedtuple('namedtuple', fields)
-        result = result._make(unpacked_tuple) # insert unpacked values
-        result = result._asdict()             # convert to OrderedDict
-        result = dict(result)                 # convert to regular dict
-        return result
+        self._reassembler = reassembler if reassembler is not None else FrameReassembler()
+
+    def reset(self):
+        """ Drops partial frames, e.g. after reconnecting. """
+        self._reassembler.reset()
 
     def handle_message(self, message):
-        log.debug("Received message: {}".format(message.__dict__))
-        log.debug("Payload: {}".format(phex(message.payload)))
-
-        result = {}
-        if message.attribute == Attribute.DISTANCE_LEFT:
-            result = M365Delegate.unpack_to_dict(
-                'distance_left_km',
-                struct.unpack('<H', message.payload)
-            )
-
-        elif message.attribute == Attribute.SPEED:
-            result = M365Delegate.unpack_to_dict(
-                'speed_kmh',
-                struct.unpack('<h', message.payload)
-            )
-
-        elif message.attribute == Attribute.TRIP_DISTANCE:
-            result = M365Delegate.unpack_to_dict(
-                'trip_distance_m',
-                struct.unpack('<H', message.payload)
-            )
-
-        elif message.attribute == Attribute.TAIL_LIGHT:
-            result = M365Delegate.unpack_to_dict(
-                'is_tail_light_on',
-                struct.unpack('<H', message.payload)
-            )
-
-        elif message.attribute == Attribute.CRUISE:
-            result = M365Delegate.unpack_to_dict(
-                'is_cruise_on',
-                struct.unpack('<H', message.payload)
-            )
-
-        elif message.attribute == Attribute.GET_LOCK:
-            result = M365Delegate.unpack_to_dict(
-                'is_lock_on',
-                struct.unpack('<H', message.payload)
-            )
-
-        elif message.attribute == Attribute.BATTERY_INFO:
-            result = M365Delegate.unpack_to_dict(
-                'battery_capacity battery_percent battery_current battery_voltage battery_temperature_1 battery_temperature_2',
-                struct.unpack('<HHhHBB', message.payload)
-            )
-
-        elif message.attribute == Attribute.BATTERY_VOLTAGE:
-            result = M365Delegate.unpack_to_dict(
-                'battery_voltage',
-                struct.unpack('<H', message.payload)
-            )
-
-        elif message.attribute == Attribute.BATTERY_CURRENT:
-            result = M365Delegate.unpack_to_dict(
-                'battery_current',
-                struct.unpack('<h', message.payload)
-            )
-
-        elif message.attribute == Attribute.BATTERY_PERCENT:
-            result = M365Delegate.unpack_to_dict(
-                'battery_percent',
-                struct.unpack('<H', message.payload)
-            )
-
-        elif message.attribute == Attribute.GENERAL_INFO:
-            #          [                      SERIAL                          ][          PIN         ][ VER  ]
-            # payload: /x31/x36/x31/x33/x32/x2f/x30/x30/x30/x39/x35/x32/x39/x32/x30/x30/x30/x30/x30/x30/x38/x01
-            result = M365Delegate.unpack_to_dict(
-                'serial pin version',
-                struct.unpack('<14s6sH', message.payload)
-            )
-
-        elif message.attribute == Attribute.MOTOR_INFO:
-            result = M365Delegate.unpack_to_dict(
-                # 'error warning flags workmode battery_percent speed_kmh speed_average_kmh odometer_km trip_distance_m uptime_s frame_temperature',
-                'battery_percent speed_kmh speed_average_kmh odometer_km trip_distance_m uptime_s frame_temperature',
-                struct.unpack('<xxxxxxxxHhHIhhhxxxxxxxx', message.payload)
-            )
-
-        elif message.attribute == Attribute.TRIP_INFO:
-            #          [uptime][]
-            # payload: xec/x00 /x00/x00/x00/x00/x00/x00/xe6/x00
-            result = M365Delegate.unpack_to_dict(
-                'uptime_s trip_distance_m frame_temperature',
-                struct.unpack('<HIxxh', message.payload)
-            )
-
-        elif message.attribute == Attribute.BATTERY_CELL_VOLTAGES:
-            #          [cell1 ][cell2 ]                     ...                                [cell10][           ???            ]
-            # payload: /x2d/x10/x2e/x10/x1d/x10/x2f/x10/x34/x10/x34/x10/x3a/x10/x3a/x10/x2e/x10/x2f/x10/x00/x00/x00/x00/x00/x00/x00
-            cell_voltages_tuple = struct.unpack('<HHHHHHHHHHxxxxxxx', message.payload)
-
-            result['cell_voltages'] = []
-
-            for voltage in cell_voltages_tuple:
-                result['cell_voltages'].append(float(voltage) / 100) # V
-
-        elif message.attribute == Attribute.SUPPLEMENTARY:
-            # TODO:  Proper states for kers mode instead of byte value
-            #          [ kers ] [cruise] [taillight]
-            # payload: /x00/x00 /x00/x00 /x00/x00
-            result = M365Delegate.unpack_to_dict(
-                'kers_mode is_cruise_on is_tail_light_on',
-                struct.unpack('<HHH', message.payload)
-            )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Received message: {}".format(message))
 
-        else:
-            log.warning('Unhandled message!')
+        # requests echoed back by a half-duplex serial bus
+        if message.direction in RESPONSE_DIRECTION:
             return
 
-        def try_update_field(result, key, func):
-            if key in result:
-                new_val = func(result[key])
-                result[key] = new_val
-
-        # Convert raw bytes to corresponing type
-        try_update_field(result, 'serial',                lambda x: x.decode('utf-8')) # str
-        try_update_field(result, 'pin',                   lambda x: x.decode('utf-8')) # str
-        try_update_field(result, 'speed_kmh',             lambda x: float(x) / 100)  # km/h
-        try_update_field(result, 'speed_average_kmh',     lambda x: float(x) / 100)  # km/h
-        try_update_field(result, 'distance_left_km',      lambda x: float(x) / 100)  # km
-        try_update_field(result, 'frame_temperature',     lambda x: float(x) / 10)   # C
-        try_update_field(result, 'odometer_km',           lambda x: float(x) / 1000) # km
-        try_update_field(result, 'battery_capacity',      lambda x: float(x) / 1000) # Ah
-        try_update_field(result, 'battery_current',       lambda x: float(x) / 100)  # A
-        try_update_field(result, 'battery_voltage',       lambda x: float(x) / 100)  # V
-        try_update_field(result, 'battery_temperature_1', lambda x: x - 20)   # C
-        try_update_field(result, 'battery_temperature_2', lambda x: x - 20)   # C
-        try_update_field(result, 'is_tail_light_on',      lambda x: x == 0x02)   # bool
-        try_update_field(result, 'is_lock_on',            lambda x: x == 0x02)   # bool
-        try_update_field(result, 'is_cruise_on',          lambda x: x == 0x01)   # bool
-
-        if 'version' in result:
-            result['version'] = '{:02x}'.format(result['version'])
-            result['version'] = 'V' + '.'.join(result['version'])  # V1.3.8
-
-        # write result to m365 cached state
-        for key, value in result.items():
-            # hacky way of writing key and value to state
-            self._m365.cached_state[key] = value
-
-        # call user callback
-        if self._m365._callback:
-            self._m365._callback(self._m365, message, result)
+        # free the in-flight slot first, callbacks may send requests of their own
+        pending = self._m365._take_request(message)
+        try:
+            result = self.dispatch_message(message)
+        except Exception as e:
+            if pending is not None:
+                pending._fail(e)
+            raise
+        if pending is not None:
+            self._m365._complete_request(pending, message, result)
+        return result
 
+    def dispatch_message(self, message):
+        """ Caches, decodes and delivers a response to subscriptions, sinks and the
+        callback without completing the request waiting for it, e.g. for the
+        slices of a coalesced read. Returns the decoded result, None if there
+        is no decoder for it. """
+        # keep a raw copy of every register read
+        if message.read_write == ReadWrite.READ:
+            self._m365.cached_state.write(message.direction, message.attribute, message.payload)
+
+        decoder = get_decoder(message.direction, message.attribute)
+        if decoder is None:
+            self._m365.metrics.count_unhandled(message.direction, message.attribute)
+            log.warning('Unhandled message!')
+            return None
+
+        if len(message.payload) != decoder.size:
+            # raw register range, e.g. from read_registers(), the requester splits it
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('Register read of {} bytes at {:#04x}'.format(len(message.payload), message.attribute))
+            return None
+
+        result = decoder.decode(message.payload)
+
+        if self._m365._publisher is not None:
+            self._m365._publisher.publish(self._m365.mac_address, message.direction, message.attribute,
+                                          message.payload)
+        for sink in self._m365._sinks:
+            sink.write(self._m365.mac_address, message, result)
+
+        subscriptions = self._m365._subscriptions
+        if subscriptions:
+            for name in decoder.names:
+                for subscription in subscriptions.get(name, ()):
+                    subscription._update(result[name])
+
+        # call user callback, or hand the result to its worker thread
+        if self._m365.callback_worker is not None:
+            self._m365.callback_worker.submit(self._m365, message, result)
+        elif self._m365._callback:
+            started = _clock()
+            self._m365._callback(self._m365, message, result)
+            self._m365.metrics.callback_seconds.observe(_clock() - started)
+        return result
 
     def handleNotification(self, cHandle, data):
         data = bytes(data)
-        log.debug('Got raw bytes: {}'.format(phex(data)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Got raw bytes: {}'.format(phex(data)))
 
         # sometimes we receive empty payload, ignore these
         if len(data) == 0: return
-        parse_status, message = Message.parse_from_bytes(data)
-
-        if parse_status == ParseStatus.OK:
-            self.handle_message(message)
-
-        elif parse_status == ParseStatus.DISJOINTED:
-            self._disjointed_messages.append(data)
 
-        elif parse_status == ParseStatus.INVALID_HEADER:
-            # This could mean we got rest of disjointed message
-            # TODO: if no matching message was found... warn the user
-            for i, prev_data in enumerate(self._disjointed_messages):
-                combined_data = bytearray()
-                combined_data.extend(prev_data)
-                combined_data.extend(data)
-                combined_data = bytes(combined_data)
+        metrics = self._m365.metrics
+        metrics.bytes_received += len(data)
 
-                # try parse combined data
-                parse_status, message = Message.parse_from_bytes(combined_data)
-                if parse_status == ParseStatus.OK:
-                    self.handle_message(message)
-                    del self._disjointed_messages[i]
+        recorder = self._m365._recorder
+        if recorder is not None:
+            try:
+                recorder.write(self._m365.mac_address, data)
+            except Exception:
+                # a failing recording must not look like a link failure
+                log.exception('Recording notifications of {} failed, recording stopped'.format(self._m365.mac_address))
+                self._m365._recorder = None
+
+        # notifications may hold a fraction of a frame, let the reassembler buffer them
+        messages = self._reassembler.feed(data)
+        if messages:
+            metrics.reassembly_hits += 1
+            metrics.frames_received += len(messages)
+        else:
+            metrics.reassembly_misses += 1
 
-        elif parse_status == ParseStatus.INVALID_CHECKSUM:
-            log.warning('Received packet with invalid checksum')
+        for message in messages:
+            self.handle_message(message)
 
 
-class M365(Peripheral):
-    RX_CHARACTERISTIC = UUID('6e400003-b5a3-f393-e0a9-e50e24dcca9e')
-    TX_CHARACTERISTIC = UUID('6e400002-b5a3-f393-e0a9-e50e24dcca9e')
+class M365():
+    RX_CHARACTERISTIC = m365transport.RX_CHARACTERISTIC
+    TX_CHARACTERISTIC = m365transport.TX_CHARACTERISTIC
 
-    def __init__(self, mac_address, callback=None, auto_reconnect=True):
-        Peripheral.__init__(self)
+    def __init__(self, mac_address, callback=None, auto_reconnect=True, max_in_flight=4, request_timeout=2.0,
+                 iface=None, peripheral=None, transport=None, reconnect_policy=None, handle_cache=None,
+                 callback_worker=None):
         self.mac_address = mac_address
         self._auto_reconnect = auto_reconnect
-
-        self.cached_state = {}
+        # backoff and give up policy of auto_reconnect
+        self.reconnect_policy = reconnect_policy if reconnect_policy is not None else ReconnectPolicy()
+
+        # link to the scooter, see m365transport. Defaults to BLE through bluepy where
+        # peripheral is anything implementing the bluepy Peripheral interface,
+        # e.g. m365sim.SimulatedPeripheral, iface the HCI adapter number and handle_cache
+        # a m365transport.HandleCache to keep characteristic handles in
+        if transport is None:
+            transport = BluepyTransport(mac_address, iface, peripheral, handle_cache)
+        self._transport = transport
+        self._delegate = M365Delegate(self)
+        self.metrics = Metrics(self._delegate._reassembler)
+
+        # requests awaiting a response, (response direction, attribute) -> deque of PendingRequest
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self._pending = {}
+        self._in_flight = 0
+        self._io_lock = threading.RLock()
+
+        # incremented on every successful (re)connect
+        self.connection_count = 0
+
+        # register shadow, also a mapping of field name -> latest decoded value
+        self.cached_state = RegisterShadow()
+        # message -> PendingRequest shared by concurrent get() calls
+        self._shared_requests = {}
+        self._shared_lock = threading.Lock()
         self._callback = callback
+        # field name -> list of Subscription, replaced rather than modified so it can be read without a lock
+        self._subscriptions = {}
+        self._subscriptions_lock = threading.Lock()
+        # m365worker.CallbackWorker calling the callback off the I/O thread, None calls it inline
+        self.callback_worker = callback_worker
+        if callback_worker is not None and callback_worker.callback is None:
+            callback_worker.callback = callback
         self._disconnected_callback = None
         self._connected_callback = None
-
-        stream_handler = logging.StreamHandler()
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        stream_handler.setFormatter(formatter)
-
-        log.addHandler(stream_handler)
+        self._recorder = None
+        self._publisher = None
+        self._sinks = ()
+
+    def __getattr__(self, name):
+        # M365 used to subclass bluepy's Peripheral, keep the rest of its API available
+        peripheral = getattr(self.__dict__.get('_transport'), 'peripheral', None)
+        if peripheral is None:
+            raise AttributeError(name)
+        return getattr(peripheral, name)
+
+    @property
+    def transport(self):
+        return self._transport
+
+    @property
+    def peripheral(self):
+        """ The bluepy Peripheral of a BLE transport, otherwise None. """
+        return getattr(self._transport, 'peripheral', None)
+
+    @property
+    def iface(self):
+        """ HCI adapter number to connect through, None uses the default adapter. """
+        return getattr(self._transport, 'iface', None)
+
+    @iface.setter
+    def iface(self, iface):
+        self._transport.iface = iface
 
     def set_connected_callback(self, cb):
         self._connected_callback = cb
@@ -236,43 +411,57 @@ class M365(Peripheral):
     def set_disconnected_callback(self, cb):
         self._disconnected_callback = cb
 
-    @staticmethod
-    def _find_characteristic(uuid, chars):
-        results = filter(lambda x: x.uuid == uuid, chars)
-        for result in results:  # return the first match
-            return result
-        return None
+    def set_recorder(self, recorder):
+        """ Records every raw notification with recorder.write(mac_address, data),
+        e.g. a m365capture.CaptureWriter. None stops recording. """
+        self._recorder = recorder
+
+    def set_publisher(self, publisher):
+        """ Publishes every decoded response with publisher.publish(mac_address,
+        direction, attribute, payload), e.g. a m365shm.SharedStateWriter. None stops it. """
+        self._publisher = publisher
+
+    def add_sink(self, sink):
+        """ Writes every decoded response with sink.write(mac_address, message, result),
+        e.g. a m365sink.SQLiteSink. """
+        self._sinks = self._sinks + (sink,)
+
+    def remove_sink(self, sink):
+        self._sinks = tuple(s for s in self._sinks if s is not sink)
 
     def _try_connect(self):
-        log.info('Attempting to {}connect to Scooter: {}'.format('indefinitely ' if self._auto_reconnect else '',
-                                                                  self.mac_address))
+        log.info('Attempting to connect to Scooter: {}'.format(self.mac_address))
 
+        policy   = self.reconnect_policy
+        started  = _clock()
+        failures = 0
         while True:
             try:
-                Peripheral.connect(self, self.mac_address, addrType=ADDR_TYPE_RANDOM)
+                self._transport.connect()
                 log.info('Successfully connected to Scooter: ' + self.mac_address)
-                if self._connected_callback:
-                    self._connected_callback(self)
-
-                # Attach delegate
-                self.withDelegate(M365Delegate(self))
 
-                # Turn on notifications, otherwise there won't be any notification
-                self.writeCharacteristic(0xc,  b'\x01\x00', True)
-                self.writeCharacteristic(0x12, b'\x01\x00', True)
+                # partial frames from the previous connection are never completed
+                self._delegate.reset()
 
-                self._all_characteristics = self.getCharacteristics()
-                self._tx_char = M365._find_characteristic(M365.TX_CHARACTERISTIC, self._all_characteristics)
-                self._rx_char = M365._find_characteristic(M365.RX_CHARACTERISTIC, self._all_characteristics)
+                self.connection_count += 1
+                if self._connected_callback:
+                    self._connected_callback(self)
                 break
 
             except Exception as e:
-                if self._auto_reconnect == True:
-                    log.warning('{}, retrying'.format(e))
-                else:
+                self.metrics.connect_failures += 1
+                failures += 1
+                if self._auto_reconnect != True:
+                    raise e
+                if policy.give_up(failures, _clock() - started):
+                    log.error('Giving up connecting to Scooter: {} after {} attempts'.format(self.mac_address, failures))
                     raise e
+                delay = policy.delay(failures)
+                log.warning('{}, retrying in {:.1f}s'.format(e, delay))
+                time.sleep(delay)
 
     def _try_reconnect(self):
+        self.metrics.reconnects += 1
         try:
             self.disconnect()
         except:
@@ -284,28 +473,203 @@ class M365(Peripheral):
     def connect(self):
         self._try_connect()
 
-    def request(self, message):
-        while True:
+    def scheduler(self, rates, **kwargs):
+        """ Returns a PollScheduler polling messages at the given rates, see m365scheduler. """
+        from .m365scheduler import PollScheduler
+        return PollScheduler(self, rates, **kwargs)
+
+    def disconnect(self):
+        self._transport.disconnect()
+
+    def request(self, message, timeout=None):
+        """ Sends message and returns a PendingRequest for its response.
+
+        Up to max_in_flight read requests may await a response at once, further
+        requests process notifications until a slot is free. timeout defaults
+        to request_timeout, which waits indefinitely when it is None.
+        """
+        if timeout is None:
+            timeout = self.request_timeout
+        pending = PendingRequest(self, message, timeout)
+
+        if pending.key is not None:
+            self._wait_for_window()
+
+        with self._io_lock:
+            if pending.key is not None:
+                self._pending.setdefault(pending.key, deque()).append(pending)
+                self._in_flight += 1
+
+            while True:
+                try:
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug('Sending message: {}'.format([v for (k,v) in message.__dict__.items()]))
+                        log.debug('Sending bytes: {}'.format(phex(message._raw_bytes)))
+                    pending._set_sent(_clock())
+                    self._transport.send_frame(message._raw_bytes)
+                    self.metrics.requests_sent += 1
+                    break
+                except Exception as e:
+                    if self._auto_reconnect != True:
+                        self._remove_request(pending)
+                        raise e
+                    log.warning('{}, reconnecting'.format(e))
+                    try:
+                        self._try_reconnect()
+                    except Exception:
+                        # gave up reconnecting, free the in-flight slot
+                        self._remove_request(pending)
+                        raise
+
+        if pending.key is None:
+            pending._resolve(None, None)
+        return pending
+
+    def get(self, name, max_age=None, timeout=None):
+        """ Returns field name of cached_state, first requesting it if its value is
+        older than max_age seconds or missing. None accepts any cached value.
+
+        Concurrent callers waiting for the same field share one request.
+        """
+        age = self.cached_state.age(name)
+        if age is not None and (max_age is None or age <= max_age):
+            return self.cached_state[name]
+
+        message = message_for_field(name)
+        # only the lookup is locked, request() may run callbacks that call get() again
+        with self._shared_lock:
+            pending = self._shared_requests.get(id(message))
+            owner = pending is None or pending.done()
+            if owner:
+                pending = self._shared_requests[id(message)] = PendingRequest(self, message, timeout)
+        if owner:
             try:
-                log.debug('Sending message: {}'.format([v for (k,v) in message.__dict__.items()]))
-                log.debug('Sending bytes: {}'.format(phex(message._raw_bytes)))
-                self._tx_char.write(message._raw_bytes)
-                self._rx_char.read()
+                request = self.request(message, timeout)
+            except Exception as e:
+                pending._fail(e)
+                raise
+            request.add_done_callback(pending._follow)
+        pending.result()
+        return self.cached_state[name]
+
+    def subscribe(self, field, callback, deadband=0.0):
+        """ Calls callback(m365, field, value, previous) whenever a received response
+        changes field by more than deadband, see Subscription. Returns the
+        Subscription, cancel() it to stop.
+
+        Callbacks run on the thread processing notifications.
+        """
+        subscription = Subscription(self, field, callback, deadband)
+        with self._subscriptions_lock:
+            self._subscriptions[field] = self._subscriptions.get(field, []) + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._subscriptions_lock:
+            remaining = [s for s in self._subscriptions.get(subscription.field, []) if s is not subscription]
+            if remaining:
+                self._subscriptions[subscription.field] = remaining
+            else:
+                self._subscriptions.pop(subscription.field, None)
+
+    def read_registers(self, direction, start, length, timeout=None):
+        """ Reads length bytes of registers starting at start, see m365message.read_registers.
+
+        The returned PendingRequest resolves to None, the bytes are in its frame.payload.
+        """
+        return self.request(read_registers(direction, start, length), timeout)
+
+    def request_coalesced(self, messages, timeout=None, max_length=None):
+        """ Sends messages with adjacent or overlapping reads merged into single
+        requests, returns a PendingRequest per message in the same order. """
+        from .m365coalesce import ReadCoalescer
+        coalescer = ReadCoalescer(self, max_length=max_length)
+        pending = [coalescer.queue(message) for message in messages]
+        coalescer.flush(timeout)
+        return pending
+
+    def wait_for_responses(self, timeout=None):
+        """ Processes notifications until every pending request is resolved or
+        has expired. Returns False if timeout seconds passed first. """
+        wait_until = None if timeout is None else _clock() + timeout
+        while self._in_flight:
+            now = _clock()
+            self._expire_requests(now)
+            if wait_until is not None and now >= wait_until:
+                return self._in_flight == 0
+            self.waitForNotifications(PendingRequest.POLL_INTERVAL)
+        return True
+
+    def _wait_for_window(self):
+        while self._in_flight >= self.max_in_flight:
+            self._expire_requests(_clock())
+            if self._in_flight < self.max_in_flight:
                 break
+            if not self._pump(PendingRequest.POLL_INTERVAL):
+                time.sleep(PendingRequest.POLL_INTERVAL)
+
+    def _pump(self, timeout):
+        """ Processes notifications unless another thread is already doing so. """
+        if not self._io_lock.acquire(False):
+            return False
+        try:
+            self.waitForNotifications(timeout)
+        finally:
+            self._io_lock.release()
+        return True
+
+    def _take_request(self, message):
+        """ Removes and returns the request a response answers, None if there is none. """
+        queue = self._pending.get((message.direction, message.attribute))
+        if not queue:
+            return None
+        self._in_flight -= 1
+        return queue.popleft()
+
+    def _complete_request(self, pending, message, result):
+        now = _clock()
+        if pending.sent_at is not None:
+            self.metrics.observe_latency(message.attribute, now - pending.sent_at)
+        pending._resolve(message, result, now)
+
+    def _remove_request(self, pending):
+        queue = self._pending.get(pending.key)
+        if queue and pending in queue:
+            queue.remove(pending)
+            self._in_flight -= 1
+
+    def _fail_requests(self, error):
+        """ Fails every request awaiting a response, e.g. once the link is lost for good. """
+        with self._io_lock:
+            for queue in self._pending.values():
+                while queue:
+                    self._in_flight -= 1
+                    queue.popleft()._fail(error)
+
+    def _expire_requests(self, now):
+        if not self._in_flight:
+            return
+        with self._io_lock:
+            for queue in self._pending.values():
+                while queue and queue[0].deadline is not None and queue[0].deadline <= now:
+                    pending = queue.popleft()
+                    self._in_flight -= 1
+                    self.metrics.count_timeout(pending.message.attribute)
+                    pending._fail(RequestTimeoutError('No response to attribute {:#04x} within {}s'.format(
+                        pending.message.attribute, pending.timeout)))
+
+    def waitForNotifications(self, timeout):
+        """ Processes bytes received within timeout seconds, returns False if there were none. """
+        with self._io_lock:
+            try:
+                data = self._transport.receive_bytes(timeout)
+                if not data:
+                    return False
+                self._delegate.handleNotification(None, data)
+                return True
             except Exception as e:
                 if self._auto_reconnect == True:
                     log.warning('{}, reconnecting'.format(e))
                     self._try_reconnect()
                 else:
                     raise e
-
-    def waitForNotifications(self, timeout):
-        try:
-            Peripheral.waitForNotifications(self, timeout)
-        except Exception as e:
-            if self._auto_reconnect == True:
-                log.warning('{}, reconnecting'.format(e))
-                self._try_reconnect()
-            else:
-                raise e
-
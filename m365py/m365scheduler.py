@@ -0,0 +1,166 @@
+""" Polls messages at individual rates over a single connection. """
+
+import heapq
+import itertools
+import logging
+
+from . import m365message
+from .m365message import _clock
+
+log = logging.getLogger('m365py')
+
+# rate for messages that are requested once per connection
+ONCE = 0
+
+# seconds between retries of ONCE messages when the M365 has no request_timeout
+DEFAULT_RETRY_INTERVAL = 2.0
+
+def _predefined_names():
+    return dict((id(value), name) for name, value in m365message.predefined_messages().items())
+
+class _Entry():
+    __slots__ = ('name', 'message', 'rate', 'period', 'backoff', 'pending', 'done_once',
+                 'sent', 'received', 'timeouts', 'skipped')
+
+    def __init__(self, name, message, rate):
+        self.name      = name
+        self.message   = message
+        self.rate      = rate
+        self.period    = 1.0 / rate if rate else None
+        self.backoff   = 1
+        self.pending   = None
+        self.done_once = False
+
+        self.sent     = 0
+        self.received = 0
+        self.timeouts = 0
+        self.skipped  = 0
+
+class PollScheduler():
+    """ Interleaves requests for messages polled at different rates.
+
+    rates maps a predefined message, or its name in m365message, to a rate in Hz,
+    e.g. {'speed': 5.0, 'battery_info': 1.0, 'general_info': ONCE}. ONCE requests
+    the message after every (re)connect.
+
+    Requests are sent from a deadline heap. A message whose previous request is
+    still unanswered is skipped for that cycle, and every timeout doubles its
+    period up to max_backoff times the target period until a response arrives.
+    ONCE messages are sent again every retry_interval seconds, backing off the
+    same way, until one is answered. retry_interval defaults to the M365's
+    request_timeout, or DEFAULT_RETRY_INTERVAL if it waits indefinitely.
+    """
+
+    def __init__(self, m365, rates, max_backoff=8, retry_interval=None):
+        self.m365        = m365
+        self.max_backoff = max_backoff
+        if retry_interval is None:
+            retry_interval = m365.request_timeout if m365.request_timeout is not None else DEFAULT_RETRY_INTERVAL
+        self.retry_interval = retry_interval
+
+        names = None
+        self._entries = []
+        for message, rate in rates.items():
+            if isinstance(message, str):
+                name, message = message, getattr(m365message, message)
+            else:
+                if names is None:
+                    names = _predefined_names()
+                name = names.get(id(message), '{:#04x}'.format(message.attribute))
+            self._entries.append(_Entry(name, message, rate))
+
+        self._heap       = []
+        self._sequence   = itertools.count()
+        self._connection = None
+        self._started_at = None
+        self._running    = False
+
+    def stop(self):
+        self._running = False
+
+    def run(self, duration=None):
+        """ Polls until stop() is called or duration seconds have passed. """
+        now = _clock()
+        if self._started_at is None:
+            self._started_at = now
+        self._reset_schedule(now)
+
+        run_until = None if duration is None else now + duration
+        self._running = True
+        while self._running:
+            now = _clock()
+            if run_until is not None and now >= run_until:
+                break
+
+            if self._connection != self.m365.connection_count:
+                self._reset_schedule(now)
+
+            while self._heap and self._heap[0][0] <= now:
+                due, _, entry = heapq.heappop(self._heap)
+                self._send(entry, due, now)
+
+            # process notifications until the next deadline
+            timeout = self._heap[0][0] - now if self._heap else 0.1
+            if run_until is not None:
+                timeout = min(timeout, run_until - now)
+            self.m365.waitForNotifications(max(timeout, 0.0))
+            self.m365._expire_requests(_clock())
+
+    def stats(self):
+        """ Returns dict of message name -> dict with target and achieved rate. """
+        elapsed = _clock() - self._started_at if self._started_at is not None else 0.0
+        result = {}
+        for entry in self._entries:
+            result[entry.name] = {
+                'target_hz':   entry.rate,
+                'achieved_hz': entry.received / elapsed if elapsed > 0 else 0.0,
+                'sent':        entry.sent,
+                'received':    entry.received,
+                'timeouts':    entry.timeouts,
+                'skipped':     entry.skipped,
+                'backoff':     entry.backoff,
+            }
+        return result
+
+    def _reset_schedule(self, now):
+        self._connection = self.m365.connection_count
+        self._heap = []
+        for entry in self._entries:
+            entry.backoff = 1
+            entry.done_once = False
+            self._push(entry, now)
+
+    def _push(self, entry, due):
+        heapq.heappush(self._heap, (due, next(self._sequence), entry))
+
+    def _send(self, entry, due, now):
+        if entry.period is None and entry.done_once:
+            return
+
+        if entry.pending is not None and not entry.pending.done():
+            entry.skipped += 1
+        else:
+            entry.sent += 1
+            entry.pending = self.m365.request(entry.message)
+            entry.pending.add_done_callback(lambda pending: self._on_done(entry, pending))
+
+        if entry.period is None:
+            if not entry.done_once:
+                # retry once-per-connection messages until one is answered
+                self._push(entry, now + self.retry_interval * entry.backoff)
+            return
+
+        # skip missed deadlines instead of bursting to catch up
+        self._push(entry, max(due + entry.period * entry.backoff, now))
+
+    def _on_done(self, entry, pending):
+        try:
+            pending.result()
+        except Exception:
+            entry.timeouts += 1
+            entry.backoff = min(entry.backoff * 2, self.max_backoff)
+            log.debug('{} timed out, backing off to {}x period'.format(entry.name, entry.backoff))
+            return
+        entry.received += 1
+        entry.backoff = 1
+        entry.done_once = True
@@ -0,0 +1,148 @@
+""" Shadow copy of the scooter's register space. """
+
+from array import array
+
+from collections.abc import Mapping
+
+from .m365message import Direction, _clock
+from .m365decoder import get_decoder, registered_decoders, registry_revision
+
+# controllers are addressed by the direction they answer on
+CONTROLLERS = (Direction.MOTOR_TO_MASTER, Direction.BATTERY_TO_MASTER)
+
+# attributes are single byte register addresses
+REGISTER_COUNT = 0x100
+
+class RegisterView():
+    """ Lazily decoded fields of one attribute, e.g. view.speed_kmh. """
+
+    def __init__(self, shadow, direction, attribute, decoder):
+        self._shadow    = shadow
+        self._direction = direction
+        self._attribute = attribute
+        self._decoder   = decoder
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._decoder.layout:
+            raise AttributeError(name)
+        return self._decoder.decode_field(name, self._shadow.raw(self._direction), self._attribute * 2)
+
+    @property
+    def timestamp(self):
+        """ Time the oldest register of the attribute was updated, 0.0 if never. """
+        first = self._attribute
+        last  = min(first + (self._decoder.size + 1) // 2, REGISTER_COUNT)
+        return min(self._shadow.updated[self._direction][first:last])
+
+    def to_dict(self):
+        return self._decoder.decode(self._shadow.raw(self._direction)[self._attribute * 2:][:self._decoder.size]).to_dict()
+
+class RegisterShadow(Mapping):
+    """ Raw 16-bit registers of each controller with the time each was last updated.
+
+    Every response is written in as is and fields are only decoded when read.
+    As a mapping it holds field name -> value, taken from whichever registered
+    decoder's copy of the field was updated last, so fields with the same name
+    in different attributes (e.g. trip_distance_m in TRIP_INFO and MOTOR_INFO)
+    never overwrite each other.
+
+    Words are stored in wire (little endian) byte order and timestamps use the
+    same monotonic clock as the rest of the library.
+    """
+
+    def __init__(self):
+        self.words   = dict((d, array('H', [0]) * REGISTER_COUNT) for d in CONTROLLERS)
+        self.updated = dict((d, array('d', [0.0]) * REGISTER_COUNT) for d in CONTROLLERS)
+        self._raw    = dict((d, memoryview(words).cast('B')) for d, words in self.words.items())
+
+        self._index          = {}
+        self._index_revision = None
+
+    def raw(self, direction):
+        """ Returns a byte view of a controller's registers. """
+        return self._raw[direction]
+
+    def write(self, direction, attribute, payload, now=None):
+        """ Writes payload read from register attribute onwards, returns False for
+        directions that do not belong to a controller. """
+        raw = self._raw.get(direction)
+        if raw is None:
+            return False
+        if now is None:
+            now = _clock()
+
+        start = attribute * 2
+        end   = min(start + len(payload), len(raw))
+        raw[start:end] = payload[:end - start]
+
+        last = (end + 1) // 2
+        self.updated[direction][attribute:last] = array('d', [now]) * (last - attribute)
+        return True
+
+    def view(self, direction, attribute):
+        """ Returns a RegisterView of the attribute's fields. """
+        decoder = get_decoder(direction, attribute)
+        if decoder is None or direction not in self._raw:
+            raise KeyError('No decoder registered for attribute {:#04x}'.format(attribute))
+        return RegisterView(self, direction, attribute, decoder)
+
+    def field(self, name):
+        """ Returns (value, timestamp) of the most recently updated copy of a field. """
+        source, timestamp = self._freshest(name)
+        if source is None:
+            raise KeyError(name)
+        direction, attribute, decoder, _, _ = source
+        return decoder.decode_field(name, self._raw[direction], attribute * 2), timestamp
+
+    def timestamp(self, name):
+        """ Time the field was last updated, 0.0 if never. """
+        return self._freshest(name)[1]
+
+    def age(self, name, now=None):
+        """ Seconds since the field was last updated, None if never. """
+        timestamp = self.timestamp(name)
+        if not timestamp:
+            return None
+        return (_clock() if now is None else now) - timestamp
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __getitem__(self, name):
+        return self.field(name)[0]
+
+    def __contains__(self, name):
+        return self.timestamp(name) > 0.0
+
+    def __iter__(self):
+        for name in self._get_index():
+            if name in self:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def _get_index(self):
+        # name -> list of (direction, attribute, decoder, first register, end register)
+        if self._index_revision != registry_revision():
+            index = {}
+            for (direction, attribute), decoder in registered_decoders():
+                if direction not in self._raw:
+                    continue
+                for name, (offset, field_struct, _, _) in decoder.layout.items():
+                    first = attribute + offset // 2
+                    last  = attribute + (offset + field_struct.size + 1) // 2
+                    if last <= REGISTER_COUNT:
+                        index.setdefault(name, []).append((direction, attribute, decoder, first, last))
+            self._index = index
+            self._index_revision = registry_revision()
+        return self._index
+
+    def _freshest(self, name):
+        best, best_timestamp = None, 0.0
+        for source in self._get_index().get(name, ()):
+            direction, _, _, first, last = source
+            timestamp = min(self.updated[direction][first:last])
+            if timestamp > best_timestamp:
+                best, best_timestamp = source, timestamp
+        return best, best_timestamp
@@ -0,0 +1,293 @@
+""" Publication of the latest responses of scooters in shared memory.
+
+One process keeps the connections and writes every decoded response into a
+multiprocessing.shared_memory block, other processes, e.g. a dashboard or an
+alerting job, map the block and read consistent snapshots from it without
+syscalls or serialization. Python 3.8+.
+
+The block starts with a header and a table of the published attributes
+
+    magic(8) version(2) section count(2) slot count(4)
+    direction(1) attribute(1) payload size(2)    per section
+
+followed by one fixed size slot per scooter
+
+    sequence(4) mac address(20)
+    timestamp(8) payload(size)                   per section
+
+all little endian. Payloads are stored as received, so the field layout is
+that of the registered Decoder and readers decode them with the same structs
+as M365. Timestamps use the library's monotonic clock, 0.0 for sections not
+received yet.
+
+Each slot is guarded by a seqlock: the writer makes the sequence odd while it
+updates the slot and even again when done, readers copy the slot and retry
+when the sequence was odd or changed during the copy.
+"""
+
+import struct
+import threading
+
+from .m365message import Direction, Attribute, _clock
+from .m365decoder import get_decoder
+
+MAGIC   = b'M365SHM\x01'
+VERSION = 1
+
+# (direction, attribute) of the responses published by default
+DEFAULT_SECTIONS = [
+    (Direction.MOTOR_TO_MASTER,   Attribute.MOTOR_INFO),
+    (Direction.MOTOR_TO_MASTER,   Attribute.TRIP_INFO),
+    (Direction.BATTERY_TO_MASTER, Attribute.BATTERY_INFO),
+    (Direction.BATTERY_TO_MASTER, Attribute.BATTERY_CELL_VOLTAGES),
+    (Direction.BATTERY_TO_MASTER, Attribute.SUPPLEMENTARY),  # supplementary is read from the battery
+]
+
+_header      = struct.Struct('<8sHHI')
+_section     = struct.Struct('<BBH')
+_slot_header = struct.Struct('<I20s')
+_sequence    = struct.Struct('<I')
+_timestamp   = struct.Struct('<d')
+
+def _slot_size(sizes):
+    size = _slot_header.size + sum(_timestamp.size + s for s in sizes)
+    return (size + 7) & ~7  # keep slots 8 byte aligned
+
+def _attach(name):
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13 an attaching process registers the block with its
+        # resource tracker, which would unlink it when that process exits. The
+        # tracker may be shared with the writer, so skip registering rather
+        # than unregistering afterwards.
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: rtype == 'shared_memory' or register(name, rtype)
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+class SharedStateWriter():
+    """ Publishes responses of up to slots scooters into a new shared memory block.
+
+    name:     name of the block, a random one if None, see writer.name
+    slots:    number of scooters the block has room for
+    sections: (direction, attribute) pairs to publish, each needs a registered decoder
+
+    Pass it to M365.set_publisher() or Fleet.set_publisher(). A scooter gets a
+    slot on its first response, responses of scooters beyond slots are dropped
+    and counted in overflows. The block is removed by unlink().
+    """
+
+    def __init__(self, name=None, slots=16, sections=None):
+        from multiprocessing import shared_memory
+
+        sections = list(sections if sections is not None else DEFAULT_SECTIONS)
+        sizes = []
+        for direction, attribute in sections:
+            decoder = get_decoder(direction, attribute)
+            if decoder is None:
+                raise ValueError('No decoder registered for attribute {:#04x}'.format(attribute))
+            sizes.append(decoder.size)
+
+        self.sections  = sections
+        self.slots     = slots
+        self.slot_size = _slot_size(sizes)
+        self.overflows = 0
+
+        table = _header.size + _section.size * len(sections)
+        self._first_slot = (table + 7) & ~7
+        self._memory = shared_memory.SharedMemory(name=name, create=True,
+                                                  size=self._first_slot + slots * self.slot_size)
+        self._buffer = self._memory.buf
+
+        _header.pack_into(self._buffer, 0, MAGIC, VERSION, len(sections), slots)
+        # (direction, attribute) -> (offset in slot, payload size)
+        self._layout = {}
+        offset = _slot_header.size
+        for i, ((direction, attribute), size) in enumerate(zip(sections, sizes)):
+            _section.pack_into(self._buffer, _header.size + i * _section.size, direction, attribute, size)
+            self._layout[(direction, attribute)] = (offset, size)
+            offset += _timestamp.size + size
+
+        self._lock  = threading.Lock()
+        self._bases = {}  # mac address -> byte offset of its slot
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    def _claim(self, mac_address):
+        with self._lock:
+            base = self._bases.get(mac_address)
+            if base is not None or len(self._bases) >= self.slots:
+                return base
+            base = self._first_slot + len(self._bases) * self.slot_size
+            _slot_header.pack_into(self._buffer, base, 1, mac_address.encode('utf-8')[:20])
+            _sequence.pack_into(self._buffer, base, 2)
+            self._bases[mac_address] = base
+            return base
+
+    def publish(self, mac_address, direction, attribute, payload, timestamp=None):
+        """ Writes payload into the scooter's slot, returns False if it is not published. """
+        section = self._layout.get((direction, attribute))
+        if section is None:
+            return False
+        offset, size = section
+        if len(payload) != size:
+            return False
+
+        base = self._bases.get(mac_address)
+        if base is None:
+            base = self._claim(mac_address)
+            if base is None:
+                self.overflows += 1
+                return False
+        if timestamp is None:
+            timestamp = _clock()
+
+        # each slot has a single writer, the I/O thread of its M365
+        buffer = self._buffer
+        sequence = _sequence.unpack_from(buffer, base)[0]
+        _sequence.pack_into(buffer, base, (sequence + 1) & 0xffffffff)
+        start = base + offset
+        _timestamp.pack_into(buffer, start, timestamp)
+        buffer[start + _timestamp.size:start + _timestamp.size + size] = payload
+        _sequence.pack_into(buffer, base, (sequence + 2) & 0xffffffff)
+        return True
+
+    def close(self):
+        self._buffer = None
+        self._memory.close()
+
+    def unlink(self):
+        """ Removes the block, readers that mapped it keep their mapping. """
+        self._memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        self.unlink()
+
+class Snapshot():
+    """ Consistent copy of one scooter's slot.
+
+    records are decoded on access with the registered decoders, sections not
+    received yet are None.
+    """
+
+    def __init__(self, mac_address, sequence, data, layout):
+        self.mac_address = mac_address
+        self.sequence    = sequence
+        self._data       = data
+        self._layout     = layout
+
+    def timestamp(self, direction, attribute):
+        """ Time the section was last written, 0.0 if never. """
+        offset, _, _ = self._layout[(direction, attribute)]
+        return _timestamp.unpack_from(self._data, offset)[0]
+
+    def record(self, direction, attribute):
+        """ Returns the decoded Record of the section, None if never written. """
+        offset, size, decoder = self._layout[(direction, attribute)]
+        if not _timestamp.unpack_from(self._data, offset)[0]:
+            return None
+        start = offset + _timestamp.size
+        return decoder.decode(self._data[start:start + size])
+
+    def to_dict(self):
+        """ Returns field name -> value, from the most recently written section
+        when several have the same field. """
+        result = {}
+        written = sorted((self.timestamp(*key), key) for key in self._layout)
+        for timestamp, key in written:
+            if timestamp:
+                result.update(self.record(*key).to_dict())
+        return result
+
+class SharedStateReader():
+    """ Maps a block published by a SharedStateWriter, possibly in another process.
+
+    retries: times a snapshot is copied again while the writer updates the slot
+             before giving up with an IOError
+    """
+
+    def __init__(self, name, retries=1000):
+        self.name    = name
+        self.retries = retries
+        self._memory = _attach(name)
+        self._buffer = self._memory.buf
+
+        magic, version, section_count, slots = _header.unpack_from(self._buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('{} is not a m365py shared state block'.format(name))
+
+        self.sections = []
+        self._layout  = {}  # (direction, attribute) -> (offset in slot, size, decoder)
+        sizes  = []
+        offset = _slot_header.size
+        for i in range(section_count):
+            direction, attribute, size = _section.unpack_from(self._buffer, _header.size + i * _section.size)
+            decoder = get_decoder(direction, attribute)
+            if decoder is None or decoder.size != size:
+                self.close()
+                raise ValueError('Section {:#04x} does not match the registered decoder'.format(attribute))
+            self.sections.append((direction, attribute))
+            self._layout[(direction, attribute)] = (offset, size, decoder)
+            sizes.append(size)
+            offset += _timestamp.size + size
+
+        self.slots       = slots
+        self.slot_size   = _slot_size(sizes)
+        self._first_slot = (_header.size + _section.size * section_count + 7) & ~7
+        self._indexes    = {}  # mac address -> slot index
+
+    def _read_slot(self, index):
+        buffer = self._buffer
+        base   = self._first_slot + index * self.slot_size
+        end    = base + self.slot_size
+        for _ in range(self.retries):
+            sequence = _sequence.unpack_from(buffer, base)[0]
+            if sequence & 1:
+                continue
+            data = bytes(buffer[base:end])
+            if _sequence.unpack_from(buffer, base)[0] == sequence:
+                return data
+        raise IOError('Slot {} of {} kept changing'.format(index, self.name))
+
+    def snapshots(self):
+        """ Returns mac address -> Snapshot of every scooter published so far. """
+        result = {}
+        for index in range(self.slots):
+            data = self._read_slot(index)
+            sequence, mac_address = _slot_header.unpack_from(data, 0)
+            if not mac_address.rstrip(b'\x00'):
+                break  # slots are claimed in order
+            mac_address = mac_address.rstrip(b'\x00').decode('utf-8')
+            self._indexes[mac_address] = index
+            result[mac_address] = Snapshot(mac_address, sequence, data, self._layout)
+        return result
+
+    def snapshot(self, mac_address):
+        """ Returns the scooter's Snapshot, None if it has not been published. """
+        index = self._indexes.get(mac_address)
+        if index is None:
+            return self.snapshots().get(mac_address)
+        data = self._read_slot(index)
+        return Snapshot(mac_address, _sequence.unpack_from(data, 0)[0], data, self._layout)
+
+    def close(self):
+        self._buffer = None
+        self._memory.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
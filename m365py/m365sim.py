@@ -0,0 +1,425 @@
+""" Simulated scooter for testing without Bluetooth hardware.
+
+SimulatedPeripheral implements the parts of bluepy's Peripheral that M365 uses and
+answers requests from an in-memory register file, so it can be passed to M365 as
+its peripheral. The registers follow the V1.3.8 layout the decoders expect and
+are kept up to date by a simple ride model, and faults seen on real links
+(slow or lost responses, corrupted checksums, disconnects) can be injected.
+"""
+
+import os
+import random
+import select
+import struct
+import time
+from collections import deque
+
+from .m365message import Message, FrameReassembler, ParseStatus, Direction, ReadWrite, Attribute, RESPONSE_DIRECTION, _clock
+from .m365transport import RX_CHARACTERISTIC, TX_CHARACTERISTIC
+
+def simulated_mac_addresses(count):
+    """ Returns count distinct locally administered MAC addresses. """
+    return ['C2:00:00:{:02X}:{:02X}:{:02X}'.format((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+            for i in range(count)]
+
+class SimulatedCharacteristic():
+    def __init__(self, peripheral, uuid, handle):
+        self.peripheral = peripheral
+        self.uuid       = uuid
+        self.handle     = handle
+
+    def getHandle(self):
+        return self.handle
+
+    def write(self, val, withResponse=False):
+        self.peripheral._receive(bytes(val))
+
+    def read(self):
+        return b''
+
+class _FileDescriptorWriter():
+    def __init__(self, fd):
+        self.fd = fd
+
+    def handleNotification(self, cHandle, data):
+        os.write(self.fd, data)
+
+class RideModel():
+    """ State of a scooter being ridden, advanced in time by SimulatedPeripheral.
+
+    Speed follows a bounded random walk, the battery drains with the distance
+    covered and pack voltage, cell voltages and temperatures follow from it.
+    """
+
+    CELLS          = 10
+    CAPACITY_MAH   = 7800
+    MAX_SPEED_KMH  = 25.0
+    WH_PER_KM      = 12.0
+
+    def __init__(self, rng, riding=True):
+        self.rng    = rng
+        self.riding = riding
+
+        self.speed_kmh      = 0.0
+        self.odometer_m     = rng.uniform(100.0, 2000.0) * 1000
+        self.trip_m         = 0.0
+        self.uptime_s       = 0.0
+        self.charge         = rng.uniform(0.5, 1.0)  # fraction of capacity left
+        self.cell_offsets   = [rng.uniform(-0.02, 0.02) for _ in range(self.CELLS)]
+        self.ambient        = rng.uniform(10.0, 25.0)
+
+        self.locked     = False
+        self.cruise     = False
+        self.tail_light = False
+        self.kers_mode  = 0
+
+    def advance(self, seconds):
+        if seconds <= 0:
+            return
+        self.uptime_s += seconds
+
+        if self.riding and not self.locked:
+            step = self.rng.gauss(0.0, 2.0) * min(seconds, 1.0)
+            self.speed_kmh = min(max(self.speed_kmh + step, 0.0), self.MAX_SPEED_KMH)
+        else:
+            self.speed_kmh = 0.0
+
+        meters = self.speed_kmh / 3.6 * seconds
+        self.odometer_m += meters
+        self.trip_m     += meters
+        pack_wh = self.CAPACITY_MAH / 1000.0 * 36.0
+        self.charge = max(self.charge - self.WH_PER_KM * meters / 1000.0 / pack_wh, 0.0)
+
+    @property
+    def cell_voltage(self):
+        return 3.3 + 0.9 * self.charge
+
+    @property
+    def voltage(self):
+        return self.cell_voltage * self.CELLS
+
+    @property
+    def current(self):
+        return self.speed_kmh * 0.6  # A, roughly 300W at full speed
+
+    @property
+    def temperature(self):
+        return self.ambient + self.speed_kmh * 0.4
+
+    @property
+    def percent(self):
+        return int(round(self.charge * 100))
+
+    def motor_registers(self):
+        """ Returns list of (attribute, data) of the motor controller. """
+        speed    = int(self.speed_kmh * 100)
+        uptime   = int(self.uptime_s) & 0xffff
+        trip     = int(self.trip_m) & 0xffff
+        frame_t  = int(self.temperature * 10)
+        return [
+            (Attribute.DISTANCE_LEFT, struct.pack('<H', int(self.charge * self.CAPACITY_MAH / 1000.0 * 36.0
+                                                           / self.WH_PER_KM * 100))),
+            (Attribute.TRIP_INFO,     struct.pack('<HIxxh', uptime, int(self.trip_m), frame_t)),
+            (Attribute.SUPPLEMENTARY, self.supplementary()),
+            (Attribute.MOTOR_INFO,    struct.pack('<HHHHHhHIHHhxxxxxxxx',
+                0, 0, 0x02 if self.locked else 0x00, 0, self.percent, speed, speed // 2,
+                int(self.odometer_m), trip, uptime, frame_t)),
+        ]
+
+    def battery_registers(self):
+        """ Returns list of (attribute, data) of the battery management system. """
+        temperature = int(self.temperature) + 20
+        cells = [int((self.cell_voltage + offset) * 1000) for offset in self.cell_offsets]
+        return [
+            (Attribute.BATTERY_INFO, struct.pack('<HHhHBB',
+                int(self.charge * self.CAPACITY_MAH), self.percent, int(self.current * 100),
+                int(self.voltage * 100), temperature, temperature)),
+            (Attribute.BATTERY_CELL_VOLTAGES, struct.pack('<10H', *cells)),
+            (Attribute.SUPPLEMENTARY, self.supplementary()),
+        ]
+
+    def supplementary(self):
+        return struct.pack('<HHH', self.kers_mode, 0x01 if self.cruise else 0x00, 0x02 if self.tail_light else 0x00)
+
+    def write(self, attribute, data):
+        """ Applies a write request, returns False for attributes the model does not own. """
+        value = struct.unpack_from('<H', data.ljust(2, b'\x00'))[0]
+        if attribute == Attribute.SET_LOCK:
+            self.locked = True
+        elif attribute == Attribute.UNSET_LOCK:
+            self.locked = False
+        elif attribute == Attribute.CRUISE:
+            self.cruise = value == 0x01
+        elif attribute == Attribute.TAIL_LIGHT:
+            self.tail_light = value == 0x02
+        elif attribute == Attribute.SUPPLEMENTARY:
+            self.kers_mode = value
+        else:
+            return False
+        return True
+
+class SimulatedPeripheral():
+    """ Stand-in for bluepy's Peripheral.
+
+    latency:         seconds between a request and its response
+    latency_jitter:  up to this many seconds are added to latency at random
+    connect_latency: seconds connect() blocks
+    discovery_latency: seconds getCharacteristics() blocks
+    mtu:             ATT MTU, responses are split into notifications of mtu - 3 bytes
+    fragment_size:   overrides the notification size derived from mtu
+    riding:          registers follow a RideModel that is moving, otherwise it stands still
+    corrupt_rate:    fraction of responses sent with a wrong checksum
+    drop_rate:       fraction of requests that are never answered
+    disconnect_rate: fraction of requests after which the link is lost
+    connect_failure_rate: fraction of connect() calls that fail
+    seed:            seed for the random faults and ride model
+    """
+
+    REGISTER_FILE_SIZE = 0x200  # bytes, 0x100 16-bit registers
+
+    RX_HANDLE = 0x0b
+    TX_HANDLE = 0x0e
+
+    def __init__(self, latency=0.0, connect_latency=0.0, fragment_size=None, mtu=23, latency_jitter=0.0,
+                 riding=True, corrupt_rate=0.0, drop_rate=0.0, disconnect_rate=0.0, connect_failure_rate=0.0,
+                 seed=None, discovery_latency=0.0):
+        self.latency         = latency
+        self.latency_jitter  = latency_jitter
+        self.connect_latency = connect_latency
+        self.discovery_latency = discovery_latency
+        self.fragment_size   = fragment_size if fragment_size is not None else mtu - 3
+
+        self.corrupt_rate         = corrupt_rate
+        self.drop_rate            = drop_rate
+        self.disconnect_rate      = disconnect_rate
+        self.connect_failure_rate = connect_failure_rate
+
+        self.addr     = None
+        self.iface    = None
+        self.delegate = None
+
+        self.requests    = 0
+        self.responses   = 0
+        self.corrupted   = 0
+        self.dropped     = 0
+        self.disconnects = 0
+        self.connects    = 0
+        self.discoveries = 0
+
+        self._rng   = random.Random(seed)
+        self.model  = RideModel(self._rng, riding)
+
+        # request direction -> register file of the controller it addresses
+        self.registers = {
+            Direction.MASTER_TO_MOTOR:   bytearray(self.REGISTER_FILE_SIZE),
+            Direction.MASTER_TO_BATTERY: bytearray(self.REGISTER_FILE_SIZE),
+        }
+        self.write_register(Direction.MASTER_TO_MOTOR, Attribute.GENERAL_INFO,
+                            struct.pack('<14s6sH', b'SIM00/00000000', b'000000', 0x138))
+
+        self._connected     = False
+        self._notifying     = False  # enabled through the RX characteristic's CCCD
+        self._notifications = deque()  # (due time, data)
+        self._updated_at    = _clock()
+        self._update_registers(self._updated_at)
+
+    def write_register(self, direction, attribute, data):
+        offset = attribute * 2
+        self.registers[direction][offset:offset + len(data)] = data
+
+    def read_register(self, direction, attribute, length):
+        offset = attribute * 2
+        return bytes(self.registers[direction][offset:offset + length]).ljust(length, b'\x00')
+
+    def drop_connection(self):
+        """ Loses the link as if the scooter went out of range. """
+        if self._connected:
+            self.disconnects += 1
+        self._connected = False
+        self._notifications.clear()
+
+    def connect(self, deviceAddr, addrType=None, iface=None):
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+        if self.connect_failure_rate and self._rng.random() < self.connect_failure_rate:
+            raise IOError('Simulated connection to {} failed'.format(deviceAddr))
+        self.addr  = deviceAddr
+        self.iface = iface
+        self._connected = True
+        self._notifying = False
+        self.connects += 1
+
+    def disconnect(self):
+        self._connected = False
+        self._notifications.clear()
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        if not self._connected:
+            raise IOError('Simulated peripheral is not connected')
+        if handle == self.TX_HANDLE:
+            self._receive(bytes(val))
+        elif handle == self.RX_HANDLE + 1:
+            self._notifying = bytes(val) == b'\x01\x00'
+
+    def getCharacteristics(self):
+        if self.discovery_latency:
+            time.sleep(self.discovery_latency)
+        self.discoveries += 1
+        return [
+            SimulatedCharacteristic(self, RX_CHARACTERISTIC, self.RX_HANDLE),
+            SimulatedCharacteristic(self, TX_CHARACTERISTIC, self.TX_HANDLE),
+        ]
+
+    def waitForNotifications(self, timeout):
+        if not self._connected:
+            raise IOError('Simulated peripheral is not connected')
+
+        now = _clock()
+        if self._notifications and self._notifications[0][0] <= now + timeout:
+            due, data = self._notifications.popleft()
+            if due > now:
+                time.sleep(due - now)
+            if self.delegate is not None and self._notifying:
+                self.delegate.handleNotification(self.RX_HANDLE, data)
+            return True
+
+        time.sleep(timeout)
+        return False
+
+    def serve_fd(self, fd, stop=None, poll_interval=0.01):
+        """ Answers frames arriving on a file descriptor, e.g. the far end of a
+        PtyTransport or a SocketTransport connection.
+
+        Runs until stop (a threading.Event) is set, the descriptor is closed or
+        a simulated disconnect happens.
+        """
+        reassembler = FrameReassembler()
+        self._connected = True
+        self._notifying = True
+        self.withDelegate(_FileDescriptorWriter(fd))
+        try:
+            while self._connected and (stop is None or not stop.is_set()):
+                timeout = poll_interval
+                if self._notifications:
+                    timeout = min(max(self._notifications[0][0] - _clock(), 0.0), poll_interval)
+
+                readable, _, _ = select.select([fd], [], [], timeout)
+                if readable:
+                    data = os.read(fd, 512)
+                    if not data:
+                        break
+                    for frame in reassembler.feed(data):
+                        self._receive(bytes(frame.raw))
+
+                while self._connected and self._notifications and self._notifications[0][0] <= _clock():
+                    self.waitForNotifications(0)
+        except OSError:
+            pass  # closed by the other end
+        finally:
+            self.disconnect()
+
+    def _update_registers(self, now):
+        self.model.advance(now - self._updated_at)
+        self._updated_at = now
+        for attribute, data in self.model.motor_registers():
+            self.write_register(Direction.MASTER_TO_MOTOR, attribute, data)
+        for attribute, data in self.model.battery_registers():
+            self.write_register(Direction.MASTER_TO_BATTERY, attribute, data)
+
+    def _notify(self, data, due):
+        # notifications are delivered in order, a response never overtakes an earlier one
+        if self._notifications:
+            due = max(due, self._notifications[-1][0])
+        for i in range(0, len(data), self.fragment_size):
+            self._notifications.append((due, data[i:i + self.fragment_size]))
+
+    def _receive(self, data):
+        if not self._connected:
+            raise IOError('Simulated peripheral is not connected')
+        self.requests += 1
+
+        parse_status, frame = Message.parse_from_bytes(data)
+        if parse_status != ParseStatus.OK or frame.direction not in self.registers:
+            return
+
+        now = _clock()
+        if frame.read_write == ReadWrite.READ:
+            self._update_registers(now)
+            payload = self.read_register(frame.direction, frame.attribute, frame.payload[0])
+            response = Message()                                       \
+                .set_direction(RESPONSE_DIRECTION[frame.direction])    \
+                .set_read_write(ReadWrite.READ)                        \
+                .set_attribute(frame.attribute)                        \
+                .set_payload(payload)                                  \
+                .build()
+            raw = response._raw_bytes
+
+            if self.drop_rate and self._rng.random() < self.drop_rate:
+                self.dropped += 1
+            else:
+                if self.corrupt_rate and self._rng.random() < self.corrupt_rate:
+                    raw = raw[:-1] + bytes(bytearray([raw[-1] ^ 0xff]))
+                    self.corrupted += 1
+                latency = self.latency + (self._rng.uniform(0.0, self.latency_jitter) if self.latency_jitter else 0.0)
+                self._notify(raw, now + latency)
+                self.responses += 1
+
+        elif frame.read_write == ReadWrite.WRITE:
+            payload = bytes(frame.payload)
+            if self.model.write(frame.attribute, payload):
+                self._update_registers(now)
+            else:
+                self.write_register(frame.direction, frame.attribute, payload)
+
+        if self.disconnect_rate and self._rng.random() < self.disconnect_rate:
+            self.drop_connection()
+
+class SimulatedScanner():
+    """ Stand-in scanning backend for m365discovery.Discovery.
+
+    Devices in in_range advertise every advertising_interval seconds with an
+    RSSI around rssi, the others are silent. Scooters, named like real ones,
+    move in and out of range with set_in_range(). Other devices, e.g. with
+    unrelated names, can be added with add_device().
+    """
+
+    def __init__(self, mac_addresses=(), rssi=-65.0, rssi_jitter=5.0, advertising_interval=0.1, seed=None):
+        self.rssi        = rssi
+        self.rssi_jitter = rssi_jitter
+        self.advertising_interval = advertising_interval
+
+        self.names    = {}  # mac address -> advertised name
+        self.in_range = set()
+        self.scanning = False
+        self._rng     = random.Random(seed)
+        for mac_address in mac_addresses:
+            self.set_in_range(mac_address)
+
+    def add_device(self, mac_address, name, in_range=True):
+        self.names[mac_address] = name
+        self.set_in_range(mac_address, in_range)
+
+    def set_in_range(self, mac_address, in_range=True):
+        self.names.setdefault(mac_address, 'MIScooter' + mac_address.replace(':', '')[-4:])
+        if in_range:
+            self.in_range.add(mac_address)
+        else:
+            self.in_range.discard(mac_address)
+
+    def start(self):
+        self.scanning = True
+
+    def poll(self, timeout):
+        if timeout:
+            time.sleep(timeout)
+        repeats = max(1, int(timeout / self.advertising_interval))
+        rng = self._rng
+        return [(mac_address, self.names[mac_address], int(self.rssi + rng.uniform(-1, 1) * self.rssi_jitter))
+                for mac_address in sorted(self.in_range) for _ in range(repeats)]
+
+    def stop(self):
+        self.scanning = False
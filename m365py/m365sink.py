@@ -0,0 +1,334 @@
+""" Batched persistence of decoded responses.
+
+A sink buffers decoded results in memory and a background thread writes them
+in batches, when batch_size rows are waiting or the oldest has waited
+flush_interval seconds, so the thread receiving notifications never waits
+on the disk. Every record type gets a table whose columns are derived from
+its decoder's fields:
+
+    timestamp, mac_address, <field>, ...
+
+with multi value fields spread over <field>_0, <field>_1, ... columns.
+
+Attach a sink to M365s or Fleets with sink.attach(), or replay a capture
+into it with m365capture.replay(path, sink.write). Rows are stamped with the
+wall clock time, replay() converts the monotonic timestamps of a capture to
+it, so live and replayed rows line up.
+"""
+
+import csv
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from .m365message import _clock
+from .m365decoder import get_decoder
+from .m365metrics import Histogram
+
+log = logging.getLogger('m365py')
+
+# seconds, upper bounds of the flush latency histogram
+FLUSH_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+# rows, upper bounds of the batch size histogram
+BATCH_BUCKETS = (1, 10, 100, 1000, 10000)
+
+def _table_name(record_type, attribute):
+    if record_type.__name__ == 'Record':  # decoders registered without a record name
+        return 'attribute_{:02x}'.format(attribute)
+    return re.sub(r'(?<!^)([A-Z])', r'_\1', record_type.__name__).lower()
+
+class Schema():
+    """ Table of one record type, derived from the fields of its decoder.
+
+    columns: list of (name, SQLite type), scaled fields are REAL, raw ones
+             INTEGER and transformed ones left without a type
+    """
+
+    def __init__(self, decoder, attribute):
+        self.table   = _table_name(decoder.record, attribute)
+        self.columns = [('timestamp', 'REAL'), ('mac_address', 'TEXT')]
+        self._fields = []
+        for field in decoder.fields:
+            kind = 'REAL' if field.scale is not None else ('' if field.transform is not None else 'INTEGER')
+            if field.count == 1:
+                self.columns.append((field.name, kind))
+            else:
+                self.columns.extend(('{}_{}'.format(field.name, i), kind) for i in range(field.count))
+            self._fields.append((field.name, field.count))
+
+    @property
+    def names(self):
+        return [name for name, _ in self.columns]
+
+    def row(self, mac_address, timestamp, record):
+        row = [timestamp, mac_address]
+        for name, count in self._fields:
+            if count == 1:
+                row.append(getattr(record, name))
+            else:
+                row.extend(getattr(record, name))
+        return row
+
+class Sink():
+    """ Base of the sinks, buffers rows and flushes them from a background thread.
+
+    batch_size:     rows that trigger a flush
+    flush_interval: seconds the oldest buffered row waits at most
+    max_buffered:   rows kept while flushes fall behind, the oldest are dropped beyond
+
+    Subclasses implement _write(batches), called with a list of
+    (schema, rows) pairs, and optionally _close().
+    """
+
+    def __init__(self, batch_size=500, flush_interval=1.0, max_buffered=100000):
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered   = max_buffered
+
+        self.rows_written  = 0
+        self.rows_dropped  = 0
+        self.batches       = 0
+        self.flush_errors  = 0
+        self.flush_seconds = Histogram(FLUSH_BUCKETS)
+        self.batch_rows    = Histogram(BATCH_BUCKETS)
+
+        # entries of (record, mac address, timestamp, direction, attribute, buffered at)
+        self._buffer     = deque()
+        self._schemas    = {}  # record type -> Schema
+        self._condition  = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread     = None
+        self._stopping   = False
+
+    def attach(self, *targets):
+        """ Writes every decoded response of the given M365s or Fleets. """
+        for target in targets:
+            target.add_sink(self)
+
+    def detach(self, *targets):
+        for target in targets:
+            target.remove_sink(self)
+
+    def write(self, mac_address, message, result, timestamp=None):
+        """ Buffers a decoded result, timestamp defaults to the wall clock time.
+
+        Has the signature of a m365capture.replay() callback, results of
+        frames without a decoder (None) are ignored.
+        """
+        if result is None:
+            return
+        if self._thread is None:
+            self.start()
+        if timestamp is None:
+            timestamp = time.time()
+
+        entry = (result, mac_address, timestamp, message.direction, message.attribute, _clock())
+        with self._condition:
+            buffer = self._buffer
+            if len(buffer) >= self.max_buffered:
+                buffer.popleft()
+                self.rows_dropped += 1
+            buffer.append(entry)
+            if len(buffer) >= self.batch_size:
+                self._condition.notify()
+
+    @property
+    def buffered(self):
+        """ Rows waiting to be written. """
+        return len(self._buffer)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'buffered':      len(self._buffer),
+                'rows_written':  self.rows_written,
+                'rows_dropped':  self.rows_dropped,
+                'batches':       self.batches,
+                'flush_errors':  self.flush_errors,
+                'flush_seconds': self.flush_seconds.snapshot(),
+                'batch_rows':    self.batch_rows.snapshot(),
+            }
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='m365-sink')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def flush(self):
+        """ Writes every buffered row, returns the number of rows written. """
+        with self._flush_lock:
+            with self._condition:
+                entries, self._buffer = self._buffer, deque()
+            if not entries:
+                return 0
+
+            groups = {}
+            for record, mac_address, timestamp, direction, attribute, _ in entries:
+                kind = type(record)
+                schema = self._schemas.get(kind)
+                if schema is None:
+                    schema = self._schemas[kind] = Schema(get_decoder(direction, attribute), attribute)
+                groups.setdefault(schema, []).append(schema.row(mac_address, timestamp, record))
+
+            started = _clock()
+            try:
+                self._write(list(groups.items()))
+            except Exception:
+                log.exception('Sink dropped a batch of {} rows'.format(len(entries)))
+                with self._condition:
+                    self.flush_errors += 1
+                    self.rows_dropped += len(entries)
+                return 0
+            elapsed = _clock() - started
+
+            with self._condition:
+                self.rows_written += len(entries)
+                self.batches += 1
+                self.flush_seconds.observe(elapsed)
+                self.batch_rows.observe(len(entries))
+            return len(entries)
+
+    def close(self):
+        """ Stops the flush thread after writing the buffered rows. """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _due(self):
+        # seconds until the oldest buffered row has waited flush_interval, 0 if a flush is due
+        buffer = self._buffer
+        if not buffer:
+            return None
+        if len(buffer) >= self.batch_size:
+            return 0
+        return max(0.0, buffer[0][5] + self.flush_interval - _clock())
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    due = self._due()
+                    if due == 0:
+                        break
+                    self._condition.wait(due)
+                if self._stopping:
+                    return
+            self.flush()
+
+    def _write(self, batches):
+        raise NotImplementedError()
+
+    def _close(self):
+        pass
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+class SQLiteSink(Sink):
+    """ Writes to a SQLite database in WAL mode, each flush is one transaction
+    with an executemany per table. Tables are created when first written. """
+
+    def __init__(self, path, **kwargs):
+        Sink.__init__(self, **kwargs)
+        import sqlite3
+        self.path = path
+        # only the flush thread or a flush() caller holding the flush lock uses it
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._inserts = {}  # Schema -> INSERT statement
+
+    def _insert(self, schema):
+        insert = self._inserts.get(schema)
+        if insert is None:
+            # field names are user defined, e.g. 'order', so identifiers are quoted
+            self._connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+                _quote(schema.table), ', '.join('{} {}'.format(_quote(name), kind).strip()
+                                                for name, kind in schema.columns)))
+            insert = self._inserts[schema] = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                _quote(schema.table), ', '.join(_quote(name) for name in schema.names),
+                ', '.join('?' * len(schema.columns)))
+        return insert
+
+    def _write(self, batches):
+        with self._connection:
+            for schema, rows in batches:
+                self._connection.executemany(self._insert(schema), rows)
+
+    def _close(self):
+        self._connection.close()
+
+class CSVSink(Sink):
+    """ Appends to one <table>.csv file per table in directory, with a header
+    row when a file is created. """
+
+    def __init__(self, directory, **kwargs):
+        Sink.__init__(self, **kwargs)
+        self.directory = directory
+        self._files = {}  # Schema -> (file, csv writer)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _writer(self, schema):
+        entry = self._files.get(schema)
+        if entry is None:
+            path = os.path.join(self.directory, schema.table + '.csv')
+            new = not os.path.exists(path) or os.path.getsize(path) == 0
+            f = open(path, 'a', newline='')
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(schema.names)
+            entry = self._files[schema] = (f, writer)
+        return entry
+
+    def _write(self, batches):
+        for schema, rows in batches:
+            f, writer = self._writer(schema)
+            writer.writerows(rows)
+            f.flush()
+
+    def _close(self):
+        for f, _ in self._files.values():
+            f.close()
+        self._files = {}
+
+class NDJSONSink(Sink):
+    """ Appends one JSON object per row to a file, with the table name under 'table'. """
+
+    def __init__(self, path, **kwargs):
+        Sink.__init__(self, **kwargs)
+        self.path  = path
+        self._file = open(path, 'a')
+
+    def _write(self, batches):
+        lines = []
+        for schema, rows in batches:
+            names = schema.names
+            for row in rows:
+                item = dict(zip(names, row))
+                item['table'] = schema.table
+                lines.append(json.dumps(item, separators=(',', ':')))
+        self._file.write('\n'.join(lines) + '\n')
+        self._file.flush()
+
+    def _close(self):
+        self._file.close()
@@ -0,0 +1,292 @@
+""" Transports carrying frames between M365 and a scooter.
+
+A transport moves raw bytes, framing, checksums and decoding stay in M365:
+
+    connect()              opens the link
+    disconnect()           closes it
+    send_frame(data)       sends one complete frame
+    receive_bytes(timeout) returns bytes received within timeout seconds, b'' if none
+
+Received bytes may hold any part of one or more frames. Link failures are
+raised as exceptions, which M365 answers by reconnecting when auto_reconnect
+is set. Optional dependencies (bluepy, pyserial) are only imported when the
+transport needing them is created.
+"""
+
+import json
+import os
+import threading
+from collections import deque
+
+# Nordic UART service characteristics of the scooter's BLE module
+RX_CHARACTERISTIC = '6e400003-b5a3-f393-e0a9-e50e24dcca9e'
+TX_CHARACTERISTIC = '6e400002-b5a3-f393-e0a9-e50e24dcca9e'
+
+# bluepy.btle.ADDR_TYPE_RANDOM
+ADDR_TYPE_RANDOM = 'random'
+
+# the client characteristic configuration descriptor follows the RX value handle
+CCCD_OFFSET          = 1
+ENABLE_NOTIFICATIONS = b'\x01\x00'
+
+class HandleCache():
+    """ TX and RX characteristic value handles per MAC address, so reconnects can
+    skip service discovery.
+
+    With a path the cache is loaded from and saved to a JSON file, letting
+    handles survive restarts. Safe to share between transports.
+    """
+
+    def __init__(self, path=None):
+        self.path     = os.path.expanduser(path) if path is not None else None
+        self._lock    = threading.Lock()
+        self._handles = {}
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path) as f:
+                self._handles = dict((mac, tuple(handles)) for mac, handles in json.load(f).items())
+
+    def get(self, mac_address):
+        """ Returns (tx handle, rx handle) or None. """
+        return self._handles.get(mac_address.upper())
+
+    def put(self, mac_address, tx_handle, rx_handle):
+        with self._lock:
+            self._handles[mac_address.upper()] = (tx_handle, rx_handle)
+            self._save()
+
+    def discard(self, mac_address):
+        with self._lock:
+            if self._handles.pop(mac_address.upper(), None) is not None:
+                self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(self._handles, f, indent=1, sort_keys=True)
+        os.replace(temporary, self.path)
+
+# shared by transports not given a cache of their own
+default_handle_cache = HandleCache()
+
+class Transport():
+    def connect(self):
+        raise NotImplementedError()
+
+    def disconnect(self):
+        raise NotImplementedError()
+
+    def send_frame(self, data):
+        raise NotImplementedError()
+
+    def receive_bytes(self, timeout):
+        raise NotImplementedError()
+
+class BluepyTransport(Transport):
+    """ BLE link through bluepy, frames are written to the TX characteristic and
+    received as notifications of the RX characteristic.
+
+    peripheral is anything implementing the bluepy Peripheral interface,
+    e.g. m365sim.SimulatedPeripheral, a new bluepy Peripheral by default.
+    Characteristic handles found on the first connect are kept in handle_cache,
+    default_handle_cache by default, and reused instead of discovering them again.
+    Notifications are enabled through the descriptor following the RX handle.
+    """
+
+    def __init__(self, mac_address, iface=None, peripheral=None, handle_cache=None):
+        if peripheral is None:
+            from bluepy.btle import Peripheral
+            peripheral = Peripheral()
+        self.mac_address  = mac_address
+        self.iface        = iface
+        self.peripheral   = peripheral
+        self.handle_cache = handle_cache if handle_cache is not None else default_handle_cache
+
+        self._received  = deque()
+        self._tx_handle = None
+        self._rx_handle = None
+        # cached handles not yet proven by a successful write on this connection
+        self._unverified = False
+
+    @staticmethod
+    def _find_characteristic(uuid, chars):
+        results = filter(lambda x: x.uuid == uuid, chars)
+        for result in results:  # return the first match
+            return result
+        return None
+
+    def connect(self):
+        self._received.clear()
+        self.peripheral.connect(self.mac_address, addrType=ADDR_TYPE_RANDOM, iface=self.iface)
+        self.peripheral.withDelegate(self)
+
+        handles = self.handle_cache.get(self.mac_address)
+        if handles is not None and handles[1] is None:
+            handles = None  # cached without an RX handle, notifications could not be enabled
+        self._unverified = handles is not None
+        if handles is None:
+            chars = self.peripheral.getCharacteristics()
+            tx_char = BluepyTransport._find_characteristic(TX_CHARACTERISTIC, chars)
+            rx_char = BluepyTransport._find_characteristic(RX_CHARACTERISTIC, chars)
+            if tx_char is None or rx_char is None:
+                raise IOError('{} has no M365 {} characteristic'.format(
+                    self.mac_address, 'TX' if tx_char is None else 'RX'))
+            handles = (tx_char.getHandle(), rx_char.getHandle())
+            self.handle_cache.put(self.mac_address, *handles)
+        self._tx_handle, self._rx_handle = handles
+
+        # Turn on notifications, otherwise there won't be any notification
+        try:
+            self.peripheral.writeCharacteristic(self._rx_handle + CCCD_OFFSET, ENABLE_NOTIFICATIONS, True)
+        except Exception:
+            self._discard_unverified()
+            raise
+
+    def disconnect(self):
+        self.peripheral.disconnect()
+
+    def send_frame(self, data):
+        try:
+            self.peripheral.writeCharacteristic(self._tx_handle, data, False)
+        except Exception:
+            self._discard_unverified()
+            raise
+        self._unverified = False
+
+    def _discard_unverified(self):
+        if self._unverified:
+            # the handles may be stale, e.g. after a firmware update, discover them on reconnect
+            self.handle_cache.discard(self.mac_address)
+            self._unverified = False
+
+    def receive_bytes(self, timeout):
+        if not self._received:
+            self.peripheral.waitForNotifications(timeout)
+        return self._received.popleft() if self._received else b''
+
+    # bluepy delegate interface
+    def handleNotification(self, cHandle, data):
+        self._received.append(bytes(data))
+
+    def handleDiscovery(self, scanEntry, isNewDev, isNewData):
+        pass
+
+class SerialTransport(Transport):
+    """ Wired UART link to the scooter's ESC bus through pyserial.
+
+    The bus runs the same frames as BLE at 115200 baud without the 20 byte
+    notification limit. Requests echoed back by a half-duplex adapter are
+    ignored by M365.
+    """
+
+    def __init__(self, port, baudrate=115200, read_size=512):
+        self.port      = port
+        self.baudrate  = baudrate
+        self.read_size = read_size
+        self._serial   = None
+
+    def connect(self):
+        import serial
+        self._serial = serial.Serial(self.port, self.baudrate, timeout=0)
+        self._serial.reset_input_buffer()
+
+    def disconnect(self):
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+
+    def send_frame(self, data):
+        self._serial.write(data)
+
+    def receive_bytes(self, timeout):
+        self._serial.timeout = timeout
+        data = self._serial.read(1)
+        if data and self._serial.in_waiting:
+            data += self._serial.read(min(self._serial.in_waiting, self.read_size))
+        return bytes(data)
+
+class SocketTransport(Transport):
+    """ Stream socket link, address is a (host, port) tuple or a unix socket path.
+
+    Useful for serial-to-network bridges and local stand-ins.
+    """
+
+    def __init__(self, address, read_size=4096):
+        self.address   = address
+        self.read_size = read_size
+        self._socket   = None
+
+    def connect(self):
+        import select, socket
+        self._select = select.select
+        family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            # frames are small and latency bound, do not wait to coalesce them
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self._socket.connect(self.address)
+        except Exception:
+            self.disconnect()
+            raise
+
+    def disconnect(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def send_frame(self, data):
+        self._socket.sendall(data)
+
+    def receive_bytes(self, timeout):
+        readable, _, _ = self._select([self._socket], [], [], timeout)
+        if not readable:
+            return b''
+        data = self._socket.recv(self.read_size)
+        if not data:
+            raise IOError('Connection to {} closed'.format(self.address))
+        return data
+
+class PtyTransport(Transport):
+    """ Link over a pseudo terminal, in raw mode so bytes pass unchanged.
+
+    path opens an existing terminal, e.g. one end of a socat pty pair. Without
+    a path a new pty pair is created and peer_name holds the path of the other
+    end for a stand-in to open. POSIX only.
+    """
+
+    def __init__(self, path=None, read_size=512):
+        self.path      = path
+        self.read_size = read_size
+        self.peer_name = None
+        self._fd       = None
+        self._peer_fd  = None
+
+    def connect(self):
+        import select, tty
+        self._select = select.select
+        if self.path is None:
+            self._fd, self._peer_fd = os.openpty()
+            tty.setraw(self._peer_fd)
+            self.peer_name = os.ttyname(self._peer_fd)
+        else:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self._fd)
+
+    def disconnect(self):
+        for fd in (self._fd, self._peer_fd):
+            if fd is not None:
+                os.close(fd)
+        self._fd = self._peer_fd = None
+
+    def send_frame(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+
+    def receive_bytes(self, timeout):
+        readable, _, _ = self._select([self._fd], [], [], timeout)
+        if not readable:
+            return b''
+        return os.read(self._fd, self.read_size)
@@ -0,0 +1,165 @@
+""" Delivery of decoded messages to the user callback on worker threads.
+
+Responses are decoded on the thread processing notifications and queued, so a
+slow callback, e.g. one writing to a database, does not hold up reception.
+"""
+
+import logging
+import threading
+from collections import deque, OrderedDict
+
+from .m365message import _clock
+
+log = logging.getLogger('m365py')
+
+class OverflowPolicy():
+    DROP_OLDEST = 'drop_oldest'  # the oldest queued message is dropped to make room
+    COALESCE    = 'coalesce'     # a queued message of the same attribute is replaced by the newer one
+    BLOCK       = 'block'        # the I/O thread waits for room, up to block_timeout
+
+class CallbackWorker():
+    """ Calls callback(m365, message, result) from worker threads.
+
+    max_queued:    messages waiting for the callback before the policy applies
+    policy:        an OverflowPolicy. COALESCE keeps only the latest message per
+                   scooter and attribute and drops the oldest when max_queued
+                   distinct attributes are waiting
+    block_timeout: seconds BLOCK waits for room before dropping the oldest
+                   message, None waits indefinitely. A callback calling back into
+                   the same M365 while the I/O thread waits would deadlock
+    workers:       number of threads, more than one gives no ordering guarantee
+
+    Pass it as M365(..., callback_worker=worker), without a callback of its own
+    it calls the M365's callback, if any. One worker can serve several scooters.
+    """
+
+    def __init__(self, callback=None, max_queued=256, policy=OverflowPolicy.DROP_OLDEST, block_timeout=None,
+                 workers=1):
+        if policy not in (OverflowPolicy.DROP_OLDEST, OverflowPolicy.COALESCE, OverflowPolicy.BLOCK):
+            raise ValueError('Unknown overflow policy {}'.format(policy))
+        self.callback      = callback
+        self.max_queued    = max_queued
+        self.policy        = policy
+        self.block_timeout = block_timeout
+        self.workers       = workers
+
+        self.submitted = 0
+        self.delivered = 0
+        self.dropped   = 0
+        self.coalesced = 0
+        self.errors    = 0
+        self.max_depth = 0
+
+        # COALESCE: (id(m365), direction, attribute) -> entry, otherwise a deque of entries
+        self._queue     = OrderedDict() if policy == OverflowPolicy.COALESCE else deque()
+        self._condition = threading.Condition()
+        self._threads   = []
+        self._stopping  = False
+
+    @property
+    def depth(self):
+        """ Messages waiting for the callback. """
+        return len(self._queue)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'depth':     len(self._queue),
+                'max_depth': self.max_depth,
+                'submitted': self.submitted,
+                'delivered': self.delivered,
+                'dropped':   self.dropped,
+                'coalesced': self.coalesced,
+                'errors':    self.errors,
+            }
+
+    def start(self):
+        with self._condition:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name='m365-callback-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, drain=True):
+        """ Stops the worker threads, after delivering queued messages if drain. """
+        with self._condition:
+            if not drain:
+                self.dropped += len(self._queue)
+                self._queue.clear()
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, m365, message, result):
+        """ Queues a decoded message, called on the I/O thread. """
+        if not self._threads:
+            self.start()
+
+        entry = (m365, message, result)
+        with self._condition:
+            self.submitted += 1
+            queue = self._queue
+            if self.policy == OverflowPolicy.COALESCE:
+                key = (id(m365), message.direction, message.attribute)
+                if key in queue:
+                    queue[key] = entry  # keeps its place in line
+                    self.coalesced += 1
+                    return
+                if len(queue) >= self.max_queued:
+                    queue.popitem(last=False)
+                    self.dropped += 1
+                queue[key] = entry
+            else:
+                if len(queue) >= self.max_queued and self.policy == OverflowPolicy.BLOCK:
+                    self._condition.wait_for(lambda: len(queue) < self.max_queued or self._stopping,
+                                             self.block_timeout)
+                if len(queue) >= self.max_queued:
+                    queue.popleft()
+                    self.dropped += 1
+                queue.append(entry)
+
+            if len(queue) > self.max_depth:
+                self.max_depth = len(queue)
+            self._condition.notify_all()
+
+    def _next(self):
+        with self._condition:
+            while not self._queue:
+                if self._stopping:
+                    return None
+                self._condition.wait()
+            if self.policy == OverflowPolicy.COALESCE:
+                _, entry = self._queue.popitem(last=False)
+            else:
+                entry = self._queue.popleft()
+            self._condition.notify_all()  # room for a blocked submit
+            return entry
+
+    def _work(self):
+        while True:
+            entry = self._next()
+            if entry is None:
+                return
+            m365, message, result = entry
+            callback = self.callback
+            elapsed = None
+            if callback is not None:
+                started = _clock()
+                try:
+                    callback(m365, message, result)
+                except Exception:
+                    log.exception('Callback failed for attribute {:#04x}'.format(message.attribute))
+                    with self._condition:
+                        self.errors += 1
+                elapsed = _clock() - started
+            with self._condition:
+                # workers share the scooters' metrics, observe them under the lock
+                if elapsed is not None:
+                    m365.metrics.callback_seconds.observe(elapsed)
+                self.delivered += 1
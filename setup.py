@@ -6,7 +6,12 @@ setup(
     author='Anton Håkansson',
     author_email='anton.hakansson98@gmail.com',
     packages=['m365py'],
+    python_requires='>=3',
     install_requires=['bluepy'],
+    extras_require={
+        'batch': ['numpy'],
+        'serial': ['pyserial'],
+    },
     version='0.1',
     license='MIT',
     description='A library to receive parsed BLE Xiaomi M365 scooter(Version=V1.3.8) messages using bluepy',
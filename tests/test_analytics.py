@@ -0,0 +1,23 @@
+import struct
+import unittest
+
+from m365py.m365analytics import RideAnalytics
+from m365py.m365decoder import get_decoder
+from m365py.m365message import Direction, Attribute
+
+class RideAnalyticsTest(unittest.TestCase):
+    def test_cell_spread_in_volts(self):
+        decoder = get_decoder(Direction.BATTERY_TO_MASTER, Attribute.BATTERY_CELL_VOLTAGES)
+        cells = [4100] * 10  # millivolts, as sent by the battery
+        cells[3] = 4050
+        cells[7] = 4150
+        result = decoder.decode(struct.pack('<10H7x', *cells))
+
+        analytics = RideAnalytics()
+        analytics.scooter('C2:00:00:00:00:01').update(result, 0.0)
+        live = analytics.live()['C2:00:00:00:00:01']
+        self.assertAlmostEqual(live['cell_spread_v'], 0.1)
+        self.assertEqual(live['lowest_cell'], 3)
+
+if __name__ == '__main__':
+    unittest.main()
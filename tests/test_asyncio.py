@@ -0,0 +1,63 @@
+import asyncio
+import unittest
+
+from m365py import m365message
+from m365py.m365asyncio import AsyncM365
+from m365py.m365sim import SimulatedPeripheral
+
+class AsyncM365Test(unittest.TestCase):
+    def test_iteration_ends_after_disconnect(self):
+        # created outside the loop that runs it
+        scooter = AsyncM365('C2:00:00:00:00:01', peripheral=SimulatedPeripheral(seed=1))
+
+        async def consume():
+            return [item async for item in scooter]
+
+        async def main():
+            await scooter.connect()
+            consumer = asyncio.ensure_future(consume())
+            await scooter.request(m365message.motor_info)
+            await scooter.disconnect()
+            return await asyncio.wait_for(consumer, 5.0)
+
+        received = asyncio.run(main())
+        self.assertEqual([message.attribute for message, _ in received], [m365message.Attribute.MOTOR_INFO])
+
+    def test_lost_link_fails_requests_and_ends_iteration(self):
+        peripheral = SimulatedPeripheral(seed=1, latency=0.5)
+        scooter = AsyncM365('C2:00:00:00:00:01', peripheral=peripheral, auto_reconnect=False)
+
+        async def consume():
+            return [item async for item in scooter]
+
+        async def main():
+            await scooter.connect()
+            consumer = asyncio.ensure_future(consume())
+            request = asyncio.ensure_future(scooter.request(m365message.motor_info))
+            await asyncio.sleep(0.1)
+            peripheral.drop_connection()
+            with self.assertRaises(Exception):
+                await asyncio.wait_for(request, 5.0)
+            received = await asyncio.wait_for(consumer, 5.0)
+            self.assertTrue(scooter._thread.is_alive())
+
+            # the I/O thread still runs calls, e.g. a reconnect
+            await scooter.connect()
+            result = await asyncio.wait_for(scooter.request(m365message.motor_info), 5.0)
+            await scooter.disconnect()
+            return received, result
+
+        received, result = asyncio.run(main())
+        self.assertEqual(received, [])
+        self.assertIsNotNone(result)
+
+    def test_iteration_before_connect(self):
+        scooter = AsyncM365('C2:00:00:00:00:01', peripheral=SimulatedPeripheral(seed=1))
+
+        async def main():
+            return [item async for item in scooter]
+
+        self.assertEqual(asyncio.run(main()), [])
+
+if __name__ == '__main__':
+    unittest.main()
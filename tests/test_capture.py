@@ -0,0 +1,71 @@
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+
+from m365py import m365message
+from m365py.m365capture import CaptureWriter, CaptureReader, MAGIC, replay
+from m365py.m365message import _clock
+from m365py.m365py import M365
+from m365py.m365transport import PtyTransport
+from m365py.m365sim import SimulatedPeripheral
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'ride.m365cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_ids_that_are_not_mac_addresses(self):
+        with CaptureWriter(self.path) as writer:
+            writer.write('esc', b'\x55\xaa', 1.0)
+            writer.write('C2:00:00:00:00:01', b'\x01', 2.0)
+        with CaptureReader(self.path) as reader:
+            records = [(timestamp, mac_address, bytes(data)) for timestamp, mac_address, data in reader]
+        self.assertEqual(records, [(1.0, 'esc', b'\x55\xaa'), (2.0, 'C2:00:00:00:00:01', b'\x01')])
+
+    def test_appending_after_the_clock_restarted(self):
+        # a file created before a reboot, when the monotonic clock was 1000s ahead
+        with open(self.path, 'wb') as f:
+            f.write(struct.pack('<8sd', MAGIC, time.time() - _clock() - 1000.0))
+        with CaptureWriter(self.path) as writer:
+            writer.write('esc', b'\x01')
+        with CaptureReader(self.path) as reader:
+            (timestamp, _, _), = list(reader)
+            self.assertLess(abs(timestamp + reader.clock_offset - time.time()), 1.0)
+
+    @unittest.skipUnless(hasattr(os, 'openpty'), 'needs a pseudo terminal')
+    def test_records_a_pty_link(self):
+        import threading
+        transport = PtyTransport()
+        scooter = M365('esc', transport=transport, auto_reconnect=False)
+        scooter.connect()
+        stop = threading.Event()
+        peer = os.open(transport.peer_name, os.O_RDWR)
+        server = threading.Thread(target=SimulatedPeripheral(seed=1).serve_fd, args=(peer, stop))
+        server.start()
+        try:
+            with CaptureWriter(self.path) as writer:
+                scooter.set_recorder(writer)
+                self.assertIn('speed_kmh', scooter.request(m365message.motor_info, timeout=2.0).result())
+                scooter.set_recorder(None)
+        finally:
+            stop.set()
+            server.join()
+            scooter.disconnect()
+            try:
+                os.close(peer)
+            except OSError:
+                pass
+
+        frames = []
+        replay(self.path, lambda mac_address, frame, result, timestamp: frames.append((mac_address, result)))
+        self.assertEqual(frames[0][0], 'esc')
+        self.assertIn('speed_kmh', frames[0][1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from m365py import m365message
+from m365py.m365message import Message
+from m365py.m365py import M365
+from m365py.m365sim import SimulatedPeripheral
+
+class SlowVoltagePeripheral(SimulatedPeripheral):
+    """ Answers single reads of the battery voltage after a second, everything else at once. """
+
+    def _receive(self, data):
+        _, frame = Message.parse_from_bytes(data)
+        slow = frame.attribute == m365message.Attribute.BATTERY_VOLTAGE and frame.payload[0] == 2
+        self.latency = 1.0 if slow else 0.05
+        SimulatedPeripheral._receive(self, data)
+
+class CoalescedReadTest(unittest.TestCase):
+    def setUp(self):
+        self.scooter = M365('C2:00:00:00:00:01', peripheral=SlowVoltagePeripheral(seed=1), auto_reconnect=False)
+        self.scooter.connect()
+
+    def tearDown(self):
+        self.scooter.disconnect()
+
+    def test_split_does_not_complete_direct_request(self):
+        coalesced = self.scooter.request_coalesced([
+            m365message.battery_percentage,
+            m365message.battery_ampere,
+            m365message.battery_voltage,
+        ], timeout=5.0)
+        direct = self.scooter.request(m365message.battery_voltage, timeout=5.0)
+
+        values = [pending.result(timeout=2.0) for pending in coalesced]
+        self.assertIn('battery_voltage', values[2])
+        self.assertFalse(direct.done())
+        self.assertEqual(self.scooter._in_flight, 1)
+
+        self.assertIn('battery_voltage', direct.result(timeout=3.0))
+        self.assertEqual(self.scooter._in_flight, 0)
+        self.assertGreater(direct.latency, 0.9)
+
+if __name__ == '__main__':
+    unittest.main()
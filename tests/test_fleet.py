@@ -0,0 +1,27 @@
+import threading
+import unittest
+
+from m365py.m365fleet import Fleet
+
+class FleetTest(unittest.TestCase):
+    def test_keep_connected_beyond_capacity_is_rejected(self):
+        with self.assertRaises(ValueError):
+            Fleet.simulated(3, adapters=(0,), connections_per_adapter=2, keep_connected=True)
+
+    def test_stop_while_waiting_for_an_adapter(self):
+        fleet = Fleet.simulated(2, interval=0.05, adapters=(0,), connections_per_adapter=1, workers=2,
+                                keep_connected=False)
+        fleet._adapter_load[0] = 1  # the only connection slot is taken for good
+
+        stopped = threading.Event()
+        def run():
+            fleet.run(0.2)
+            stopped.set()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(stopped.wait(5.0))
+        self.assertEqual(sum(stats.polls for stats in fleet._stats.values()), 0)
+
+if __name__ == '__main__':
+    unittest.main()
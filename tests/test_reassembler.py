@@ -0,0 +1,53 @@
+import struct
+import unittest
+
+from m365py.m365message import Message, FrameReassembler, Direction, ReadWrite, Attribute
+
+def response(payload):
+    return Message()                                   \
+        .set_direction(Direction.MOTOR_TO_MASTER)      \
+        .set_read_write(ReadWrite.READ)                \
+        .set_attribute(Attribute.SPEED)                \
+        .set_payload(payload)                          \
+        .build()._raw_bytes
+
+def frame_with_checksum_ending_in_header_byte():
+    # the high checksum byte comes last, it is 0x55 once the bytes sum to 0xAA00 - 0xAAFF
+    for length in range(160, 180):
+        for value in range(0x100):
+            raw = response(b'\xff' * length + struct.pack('<B', value))
+            if raw[-1:] == b'\x55':
+                return raw
+    raise AssertionError('no payload gives a checksum ending in 0x55')
+
+class FrameReassemblerTest(unittest.TestCase):
+    def test_fragmented_frame(self):
+        raw = response(b'\x10\x00')
+        reassembler = FrameReassembler()
+        self.assertEqual(reassembler.feed(raw[:4], now=0.0), [])
+        messages = reassembler.feed(raw[4:], now=0.1)
+        self.assertEqual([bytes(m.payload) for m in messages], [b'\x10\x00'])
+        self.assertEqual(len(reassembler), 0)
+
+    def test_checksum_ending_in_header_byte(self):
+        raw = frame_with_checksum_ending_in_header_byte()
+        reassembler = FrameReassembler(max_fragment_age=1.0)
+
+        self.assertEqual(len(reassembler.feed(raw, now=0.0)), 1)
+        self.assertEqual(len(reassembler), 0)
+        self.assertEqual(reassembler.discarded_bytes, 0)
+
+        # a later frame is neither a stale fragment nor preceded by a stray byte
+        self.assertEqual(len(reassembler.feed(response(b'\x00\x00'), now=5.0)), 1)
+        self.assertEqual(reassembler.stale_fragments, 0)
+        self.assertEqual(reassembler.discarded_bytes, 0)
+
+    def test_trailing_header_byte_is_kept(self):
+        raw = response(b'\x01\x00')
+        reassembler = FrameReassembler()
+        self.assertEqual(reassembler.feed(b'\x00' + raw[:1], now=0.0), [])
+        self.assertEqual(reassembler.discarded_bytes, 1)
+        self.assertEqual(len(reassembler.feed(raw[1:], now=0.1)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
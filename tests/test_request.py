@@ -0,0 +1,44 @@
+import unittest
+
+from m365py import m365message
+from m365py.m365py import M365, ReconnectPolicy
+from m365py.m365sim import SimulatedPeripheral
+
+class RequestTest(unittest.TestCase):
+    def test_failed_reconnect_frees_in_flight_slot(self):
+        peripheral = SimulatedPeripheral(seed=1)
+        scooter = M365('C2:00:00:00:00:01', peripheral=peripheral,
+                       reconnect_policy=ReconnectPolicy(initial_delay=0.0, jitter=0.0, max_attempts=2))
+        scooter.connect()
+
+        peripheral.drop_connection()
+        peripheral.connect_failure_rate = 1.0
+        with self.assertRaises(IOError):
+            scooter.request(m365message.motor_info)
+        self.assertEqual(scooter._in_flight, 0)
+
+    def test_timeout_defaults_to_request_timeout(self):
+        scooter = M365('C2:00:00:00:00:01', peripheral=SimulatedPeripheral(seed=1, drop_rate=1.0),
+                       auto_reconnect=False, request_timeout=0.1)
+        scooter.connect()
+        pending = scooter.request(m365message.motor_info)
+        self.assertEqual(pending.timeout, 0.1)
+        self.assertRaises(Exception, pending.result)
+        self.assertEqual(scooter._in_flight, 0)
+
+    def test_get_from_a_callback_while_getting(self):
+        received = []
+        def callback(m365, message, result):
+            if message.attribute == m365message.Attribute.MOTOR_INFO and not received:
+                received.append(m365.get('battery_voltage', max_age=0))
+
+        scooter = M365('C2:00:00:00:00:01', callback=callback, peripheral=SimulatedPeripheral(seed=1, latency=0.05),
+                       max_in_flight=1, request_timeout=None)
+        scooter.connect()
+        scooter.request(m365message.motor_info)  # fills the window, its response arrives while get() waits
+        scooter.get('speed_kmh', max_age=0)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(scooter._in_flight, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,21 @@
+import unittest
+
+from m365py.m365py import M365
+from m365py.m365scheduler import ONCE, DEFAULT_RETRY_INTERVAL
+from m365py.m365sim import SimulatedPeripheral
+
+class PollSchedulerTest(unittest.TestCase):
+    def test_once_without_request_timeout(self):
+        scooter = M365('C2:00:00:00:00:01', peripheral=SimulatedPeripheral(seed=1), request_timeout=None)
+        scooter.connect()
+        scheduler = scooter.scheduler({'general_info': ONCE, 'speed': 10.0})
+        scheduler.run(0.3)
+        scooter.disconnect()
+
+        self.assertEqual(scheduler.retry_interval, DEFAULT_RETRY_INTERVAL)
+        stats = scheduler.stats()
+        self.assertEqual(stats['general_info']['received'], 1)
+        self.assertGreater(stats['speed']['received'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
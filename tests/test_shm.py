@@ -0,0 +1,39 @@
+import unittest
+
+from m365py import m365message
+from m365py.m365message import Direction, Attribute
+from m365py.m365py import M365
+from m365py.m365sim import SimulatedPeripheral
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+@unittest.skipIf(shared_memory is None, 'multiprocessing.shared_memory needs Python 3.8+')
+class SharedStateTest(unittest.TestCase):
+    def test_default_sections_are_written(self):
+        from m365py.m365shm import SharedStateWriter, SharedStateReader
+
+        scooter = M365('C2:00:00:00:00:01', peripheral=SimulatedPeripheral(seed=1), auto_reconnect=False)
+        scooter.connect()
+        with SharedStateWriter(slots=1) as writer:
+            scooter.set_publisher(writer)
+            messages = [m365message.motor_info, m365message.trip_info, m365message.battery_info,
+                        m365message.battery_cell_voltages, m365message.supplementary]
+            for pending in [scooter.request(message, timeout=2.0) for message in messages]:
+                pending.result()
+
+            reader = SharedStateReader(writer.name)
+            try:
+                snapshot = reader.snapshot(scooter.mac_address)
+                for direction, attribute in writer.sections:
+                    self.assertIsNotNone(snapshot.record(direction, attribute), hex(attribute))
+                supplementary = snapshot.record(Direction.BATTERY_TO_MASTER, Attribute.SUPPLEMENTARY)
+                self.assertIn('kers_mode', supplementary)
+            finally:
+                reader.close()
+        scooter.disconnect()
+
+if __name__ == '__main__':
+    unittest.main()
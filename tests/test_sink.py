@@ -0,0 +1,61 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from m365py import m365message
+from m365py.m365capture import CaptureWriter, replay
+from m365py.m365decoder import Decoder, Field, register_decoder, unregister_decoder
+from m365py.m365message import Direction
+from m365py.m365py import M365
+from m365py.m365sim import SimulatedPeripheral
+from m365py.m365sink import SQLiteSink
+
+class SQLiteSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'telemetry.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_live_and_replayed_rows_share_the_clock(self):
+        capture = os.path.join(self.directory, 'ride.m365cap')
+        sink = SQLiteSink(self.path)
+        scooter = M365('C2:00:00:00:00:01', peripheral=SimulatedPeripheral(seed=1))
+        scooter.set_recorder(CaptureWriter(capture))
+        sink.attach(scooter)
+        scooter.connect()
+        scooter.request(m365message.motor_info).result()
+        scooter.disconnect()
+        scooter._recorder.close()
+        sink.detach(scooter)
+        replay(capture, sink.write)
+        sink.close()
+
+        with sqlite3.connect(self.path) as conn:
+            live, replayed = [row[0] for row in conn.execute('SELECT timestamp FROM motor_info ORDER BY rowid')]
+        self.assertLess(abs(live - replayed), 1.0)
+        self.assertLess(abs(live - time.time()), 60.0)
+
+    def test_keyword_field_names(self):
+        attribute = 0x7E
+        decoder = Decoder('<HH', [Field('order'), Field('group')], record='Select')
+        register_decoder(Direction.MOTOR_TO_MASTER, attribute, decoder)
+        try:
+            frame = m365message.Frame(Direction.MOTOR_TO_MASTER, 0x01, attribute, b'\x01\x00\x02\x00', b'')
+            sink = SQLiteSink(self.path)
+            sink.write('C2:00:00:00:00:01', frame, decoder.decode(frame.payload))
+            sink.close()
+        finally:
+            unregister_decoder(Direction.MOTOR_TO_MASTER, attribute)
+
+        self.assertEqual(sink.rows_written, 1)
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute('SELECT "order", "group" FROM "select"').fetchone()
+        self.assertEqual(row, (1, 2))
+
+if __name__ == '__main__':
+    unittest.main()
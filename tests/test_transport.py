@@ -0,0 +1,39 @@
+import unittest
+
+from m365py import m365message
+from m365py.m365py import M365
+from m365py.m365sim import SimulatedPeripheral
+from m365py.m365transport import BluepyTransport, HandleCache
+
+class MovedHandlesPeripheral(SimulatedPeripheral):
+    """ A unit whose characteristics sit at other handles than the usual ones. """
+    RX_HANDLE = 0x20
+    TX_HANDLE = 0x23
+
+    def __init__(self, **kwargs):
+        SimulatedPeripheral.__init__(self, **kwargs)
+        self.writes = []
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        self.writes.append(handle)
+        SimulatedPeripheral.writeCharacteristic(self, handle, val, withResponse)
+
+class BluepyTransportTest(unittest.TestCase):
+    def test_notifications_enabled_at_the_discovered_rx_handle(self):
+        cache = HandleCache()
+        peripheral = MovedHandlesPeripheral(seed=1)
+        scooter = M365('C2:00:00:00:00:01', transport=BluepyTransport('C2:00:00:00:00:01', peripheral=peripheral,
+                                                                      handle_cache=cache))
+        for _ in range(2):  # discovered, then from the cache
+            scooter.connect()
+            self.assertIn('speed_kmh', scooter.request(m365message.motor_info, timeout=2.0).result())
+            scooter.disconnect()
+
+        self.assertEqual(cache.get('C2:00:00:00:00:01'), (0x23, 0x20))
+        self.assertEqual(peripheral.discoveries, 1)
+        self.assertNotIn(0x0c, peripheral.writes)
+        self.assertNotIn(0x12, peripheral.writes)
+        self.assertEqual(peripheral.writes.count(0x21), 2)
+
+if __name__ == '__main__':
+    unittest.main()
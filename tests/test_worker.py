@@ -0,0 +1,32 @@
+import unittest
+
+from m365py import m365message
+from m365py.m365py import M365
+from m365py.m365sim import SimulatedPeripheral
+from m365py.m365worker import CallbackWorker
+
+class CallbackWorkerTest(unittest.TestCase):
+    def test_without_callback(self):
+        worker = CallbackWorker()
+        scooter = M365('C2:00:00:00:00:01', peripheral=SimulatedPeripheral(seed=1), callback_worker=worker)
+        scooter.connect()
+        scooter.request(m365message.motor_info).result()
+        worker.stop()
+        scooter.disconnect()
+
+        self.assertEqual(worker.delivered, 1)
+        self.assertEqual(worker.errors, 0)
+        self.assertEqual(scooter.metrics.callback_seconds.count, 0)
+
+    def test_callback_time_from_several_workers(self):
+        worker = CallbackWorker(lambda m365, message, result: None, max_queued=10000, workers=4)
+        scooter = M365('C2:00:00:00:00:01', peripheral=SimulatedPeripheral(seed=1), callback_worker=worker)
+        for _ in range(2000):
+            worker.submit(scooter, m365message.motor_info, None)
+        worker.stop()
+
+        self.assertEqual(worker.delivered, 2000)
+        self.assertEqual(scooter.metrics.callback_seconds.count, 2000)
+
+if __name__ == '__main__':
+    unittest.main()